@@ -1,21 +1,45 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, Response, session
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.exceptions import HTTPException
 import uuid
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask_dance.contrib.google import make_google_blueprint, google
-from flask_dance.consumer import oauth_authorized
-from flask_dance.consumer.storage.sqla import SQLAlchemyStorage
+from datetime import date, datetime, timedelta
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
 from dotenv import load_dotenv
 from functools import wraps
-from PIL import Image
+from flask import g, get_flashed_messages, stream_with_context
+from flask.signals import before_render_template, template_rendered
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup, escape
+import base64
+import click
+import csv
+import hashlib
+import io
+import json
+import math
 import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
 import re
+import time
 import unicodedata
 import traceback
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations, groupby
+from urllib.parse import urlsplit
 
 # تحميل متغيرات البيئة من ملف .env
 load_dotenv()
@@ -23,86 +47,111 @@ load_dotenv()
 # Allow OAuth2 over HTTP in development only (set OAUTHLIB_INSECURE_TRANSPORT=1 in .env if needed)
 # في الإنتاج يجب استخدام HTTPS فقط
 
+# كائن التطبيق الوحيد الذي تُسجل عليه المسارات؛ الإعدادات والامتدادات تُربط في create_app()
 app = Flask(__name__)
 
-# إعداد ProxyFix للعمل خلف reverse proxy (Nginx)
-# هذا يضمن أن Flask يعرف أنه يعمل على HTTPS
-# ملاحظة: ProxyFix قد يسبب مشاكل في الجلسات المحلية، لذلك نفعله فقط للإنتاج
-server_name = os.environ.get('SERVER_NAME', '')
-if server_name and 'localhost' not in server_name and '127.0.0.1' not in server_name:
-    # فقط للإنتاج (ليس localhost)
-    app.wsgi_app = ProxyFix(
-        app.wsgi_app,
-        x_for=1,
-        x_proto=1,
-        x_host=1,
-        x_port=1,
-        x_prefix=1
-    )
+def load_config(app):
+    """قراءة إعدادات التطبيق من البيئة"""
+    # كاش bytecode للقوالب على القرص مشترك بين جميع العمال
+    # حتى لا يعيد كل عامل ترجمة القوالب بعد كل إعادة تشغيل
+    jinja_cache_dir = os.environ.get('JINJA_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+    os.makedirs(jinja_cache_dir, exist_ok=True)
+    # تُضبط على jinja_env مباشرة: decorators مثل template_global تنشئ البيئة عند الاستيراد،
+    # فلا يعود لتعديل jinja_options بعدها أي أثر
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(jinja_cache_dir)
 
-# SECRET_KEY يجب أن يكون ثابتاً لتجنب مشاكل الجلسات
-# إذا لم يكن موجوداً في البيئة، استخدم قيمة افتراضية ثابتة للتطوير فقط
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production-12345')
-
-# إعدادات الجلسات لضمان عمل OAuth بشكل صحيح
-# استخدام signed cookies مع إعدادات محسّنة لحل مشكلة state
-app.config['SESSION_COOKIE_SECURE'] = False  # للتطوير المحلي (HTTP)
-app.config['SESSION_COOKIE_HTTPONLY'] = True
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
-app.config['SESSION_COOKIE_NAME'] = 'bank_of_ideas_session'
-app.config['SESSION_COOKIE_DOMAIN'] = None  # لا نحدد domain للمحلي
-app.config['SESSION_COOKIE_PATH'] = '/'
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
-app.config['SESSION_REFRESH_EACH_REQUEST'] = True
-
-# إعدادات قاعدة البيانات
-# دعم SQLite للتطوير و PostgreSQL للإنتاج
-database_url = os.environ.get('DATABASE_URL')
-if database_url:
-    # PostgreSQL للإنتاج
-    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
-else:
-    # SQLite للتطوير
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///bank_of_ideas.db'
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_pre_ping': True,
-    'pool_recycle': 300,
-    'connect_args': {'check_same_thread': False} if not database_url else {}
-}
+    # إعداد ProxyFix للعمل خلف reverse proxy (Nginx)
+    # هذا يضمن أن Flask يعرف أنه يعمل على HTTPS
+    # ملاحظة: ProxyFix قد يسبب مشاكل في الجلسات المحلية، لذلك نفعله فقط للإنتاج
+    # TRUSTED_PROXY_HOPS: عدد الوكلاء الموثوقين أمام التطبيق؛ يُؤخذ IP العميل من آخر
+    # قيمة أضافها وكيل موثوق في X-Forwarded-For وليس من أول قيمة (التي يتحكم بها العميل)
+    proxy_hops = int(os.environ.get('TRUSTED_PROXY_HOPS', '1'))
+    server_name = os.environ.get('SERVER_NAME', '')
+    if server_name and 'localhost' not in server_name and '127.0.0.1' not in server_name:
+        # فقط للإنتاج (ليس localhost)
+        app.wsgi_app = ProxyFix(
+            app.wsgi_app,
+            x_for=proxy_hops,
+            x_proto=1,
+            x_host=1,
+            x_port=1,
+            x_prefix=1
+        )
+    elif proxy_hops:
+        # محلياً: تصحيح عنوان العميل فقط دون المخطط والمضيف
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops)
+
+    # SECRET_KEY يجب أن يكون ثابتاً لتجنب مشاكل الجلسات
+    # إذا لم يكن موجوداً في البيئة، استخدم قيمة افتراضية ثابتة للتطوير فقط
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production-12345')
 
-# Google OAuth configuration
-app.config['GOOGLE_OAUTH_CLIENT_ID'] = os.environ.get('GOOGLE_OAUTH_CLIENT_ID')
-app.config['GOOGLE_OAUTH_CLIENT_SECRET'] = os.environ.get('GOOGLE_OAUTH_CLIENT_SECRET')
-
-# إعداد SERVER_NAME لـ OAuth redirect URI
-# في الإنتاج، استخدم domain أو IP مع المنفذ
-server_name = os.environ.get('SERVER_NAME')
-if server_name:
-    app.config['SERVER_NAME'] = server_name
-    # إعداد SESSION_COOKIE_DOMAIN بناءً على SERVER_NAME
-    if 'localhost' in server_name or '127.0.0.1' in server_name:
-        # للمحلي، لا نحدد domain
-        app.config['SESSION_COOKIE_DOMAIN'] = None
+    # إعدادات الجلسات لضمان عمل OAuth بشكل صحيح
+    # استخدام signed cookies مع إعدادات محسّنة لحل مشكلة state
+    app.config['SESSION_COOKIE_SECURE'] = False  # للتطوير المحلي (HTTP)
+    app.config['SESSION_COOKIE_HTTPONLY'] = True
+    app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+    app.config['SESSION_COOKIE_NAME'] = 'bank_of_ideas_session'  # يستخدمه nginx لتجاوز اللقطات (docs/ARCHITECTURE.md)
+    app.config['SESSION_COOKIE_DOMAIN'] = None  # لا نحدد domain للمحلي
+    app.config['SESSION_COOKIE_PATH'] = '/'
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
+    app.config['SESSION_REFRESH_EACH_REQUEST'] = True
+
+    # إعدادات قاعدة البيانات
+    # دعم SQLite للتطوير و PostgreSQL للإنتاج
+    database_url = os.environ.get('DATABASE_URL')
+    if database_url:
+        # PostgreSQL للإنتاج
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_url
     else:
-        # للإنتاج، استخدم domain فقط (بدون port)
-        domain = server_name.split(':')[0]
-        app.config['SESSION_COOKIE_DOMAIN'] = domain
-
-# إعداد URL scheme (http أو https)
-# في الإنتاج، استخدم https
-preferred_url_scheme = os.environ.get('PREFERRED_URL_SCHEME', 'http')
-app.config['PREFERRED_URL_SCHEME'] = preferred_url_scheme
-
-# إعداد OAuth للعمل خلف reverse proxy
-# إذا كان OAUTHLIB_INSECURE_TRANSPORT=1، سيسمح بـ HTTP (للتطوير فقط)
-# في الإنتاج، يجب أن يكون HTTPS ويعمل خلف Nginx الذي يمرر X-Forwarded-Proto
-if os.environ.get('OAUTHLIB_INSECURE_TRANSPORT') == '1':
-    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
-
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+        # SQLite للتطوير
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///bank_of_ideas.db'
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_pre_ping': True,
+        'pool_recycle': 300,
+        'connect_args': {'check_same_thread': False} if not database_url else {}
+    }
+
+    # Google OAuth configuration
+    app.config['GOOGLE_OAUTH_CLIENT_ID'] = os.environ.get('GOOGLE_OAUTH_CLIENT_ID')
+    app.config['GOOGLE_OAUTH_CLIENT_SECRET'] = os.environ.get('GOOGLE_OAUTH_CLIENT_SECRET')
+
+    # إعداد SERVER_NAME لـ OAuth redirect URI
+    # في الإنتاج، استخدم domain أو IP مع المنفذ
+    server_name = os.environ.get('SERVER_NAME')
+    if server_name:
+        app.config['SERVER_NAME'] = server_name
+        # إعداد SESSION_COOKIE_DOMAIN بناءً على SERVER_NAME
+        if 'localhost' in server_name or '127.0.0.1' in server_name:
+            # للمحلي، لا نحدد domain
+            app.config['SESSION_COOKIE_DOMAIN'] = None
+        else:
+            # للإنتاج، استخدم domain فقط (بدون port)
+            domain = server_name.split(':')[0]
+            app.config['SESSION_COOKIE_DOMAIN'] = domain
+
+    # إعداد URL scheme (http أو https)
+    # في الإنتاج، استخدم https
+    preferred_url_scheme = os.environ.get('PREFERRED_URL_SCHEME', 'http')
+    app.config['PREFERRED_URL_SCHEME'] = preferred_url_scheme
+
+    # إعداد OAuth للعمل خلف reverse proxy
+    # إذا كان OAUTHLIB_INSECURE_TRANSPORT=1، سيسمح بـ HTTP (للتطوير فقط)
+    # في الإنتاج، يجب أن يكون HTTPS ويعمل خلف Nginx الذي يمرر X-Forwarded-Proto
+    if os.environ.get('OAUTHLIB_INSECURE_TRANSPORT') == '1':
+        os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+
+    app.config['UPLOAD_FOLDER'] = 'static/uploads'
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+    # لقطات HTML ثابتة للصفحات العامة يقدمها nginx للزوار غير المسجلين
+    app.config['SNAPSHOT_ENABLED'] = os.environ.get('SNAPSHOT_ENABLED', '0') == '1'
+    app.config['SNAPSHOT_DIR'] = os.environ.get('SNAPSHOT_DIR') or os.path.join(app.instance_path, 'snapshots')
+    # ضغط الاستجابات داخل التطبيق؛ يمكن تعطيله إذا كان الـ proxy يضغط بنفسه
+    app.config['COMPRESSION_ENABLED'] = os.environ.get('COMPRESSION_ENABLED', '1') == '1'
+    # عرض لوحة التحكم وصفحة الفكرة كاستجابة متدفقة (انظر stream_page)
+    app.config['STREAM_RENDERING'] = os.environ.get('STREAM_RENDERING', '1') == '1'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
 def allowed_file(filename):
@@ -115,6 +164,8 @@ def compress_image(image_path, max_size=(800, 800), quality=85):
     :param max_size: الحجم الأقصى (عرض، ارتفاع)
     :param quality: جودة الصورة (1-100)
     """
+    # Pillow يُستورد عند أول ضغط فقط (في العامل غالباً) حتى لا يدفع كل عامل ويب كلفة استيراده
+    from PIL import Image
     try:
         with Image.open(image_path) as img:
             # تحويل RGBA إلى RGB إذا كانت PNG بها شفافية
@@ -154,6 +205,201 @@ def get_browser_name(user_agent):
     else:
         return 'Other'
 
+# تعابير الـ slug مترجمة مرة واحدة بدلاً من ترجمتها مع كل استدعاء
+SLUG_WHITESPACE_RE = re.compile(r'\s+')
+SLUG_INVALID_CHARS_RE = re.compile(r'[^\w\s-]')
+SLUG_DASHES_RE = re.compile(r'-+')
+
+def make_slug(title):
+    """إنشاء slug عربي من العنوان"""
+    if not title:
+        return ''
+    slug = title.lower()
+    # استبدال المسافات بشرطات
+    slug = SLUG_WHITESPACE_RE.sub('-', slug)
+    # إزالة الأحرف الخاصة
+    slug = SLUG_INVALID_CHARS_RE.sub('', slug)
+    # إزالة الشرطات المتعددة
+    slug = SLUG_DASHES_RE.sub('-', slug)
+    # إزالة الشرطات من البداية والنهاية
+    return slug.strip('-')
+
+# إعدادات الرواج: عمر النصف بالساعات ووزن كل حدث
+TRENDING_HALF_LIFE_HOURS = float(os.environ.get('TRENDING_HALF_LIFE_HOURS', 24))
+TRENDING_VIEW_WEIGHT = 1.0
+TRENDING_COMMENT_WEIGHT = 5.0
+TRENDING_EPOCH = datetime(2024, 1, 1)
+
+def trending_event_score(weight, when=None):
+    """درجة حدث واحد بصيغة log2: log2(weight) + عدد أعمار النصف منذ TRENDING_EPOCH
+
+    بدلاً من إنقاص درجات جميع الأفكار مع مرور الوقت، تُضخّم الأحداث الجديدة بنفس المعامل،
+    فيبقى الترتيب صحيحاً ولا تحتاج الأفكار القديمة إلى أي تحديث.
+    """
+    when = when or datetime.utcnow()
+    half_lives = (when - TRENDING_EPOCH).total_seconds() / (TRENDING_HALF_LIFE_HOURS * 3600)
+    return math.log2(weight) + half_lives
+
+def add_trending_scores(current, event):
+    """جمع درجتين بصيغة log2 دون تجاوز حدود float"""
+    if current is None:
+        return event
+    high, low = max(current, event), min(current, event)
+    return high + math.log2(1 + 2 ** (low - high))
+
+# كشف الأفكار المتشابهة: توقيع MinHash لمقاطع حرفية من النص بعد توحيد الكتابة العربية،
+# ثم LSH بتقسيم التوقيع إلى نطاقات (bands) فلا تُقارن الفكرة إلا بالأفكار التي تشاركها نطاقاً
+MINHASH_PERMUTATIONS = 64
+# 16 نطاقاً × 4 قيم: احتمال الترشيح يتجاوز النصف عند تشابه (Jaccard) حوالي (1/16)^(1/4) ≈ 0.5
+LSH_BANDS = 16
+LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+SHINGLE_SIZE = 5
+DUPLICATE_THRESHOLD = 0.5
+_MINHASH_PRIME = (1 << 61) - 1
+# بذرة ثابتة: التوقيعات المخزنة في قاعدة البيانات يجب أن تبقى قابلة للمقارنة بين الإصدارات
+_minhash_rng = random.Random(20240101)
+MINHASH_PARAMS = [(_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME))
+                  for _ in range(MINHASH_PERMUTATIONS)]
+ARABIC_DIACRITICS_RE = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+ARABIC_LETTERS_MAP = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ة': 'ه', 'ؤ': 'و', 'ئ': 'ي'})
+NON_WORD_RE = re.compile(r'[\W_]+')
+
+def normalize_arabic(text):
+    """توحيد الكتابة: إزالة التشكيل والتطويل وتوحيد الألف والياء والتاء المربوطة"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = ARABIC_DIACRITICS_RE.sub('', text).translate(ARABIC_LETTERS_MAP)
+    return NON_WORD_RE.sub(' ', text).strip()
+
+def text_shingles(text, size=SHINGLE_SIZE):
+    """مقاطع حرفية متداخلة بطول size من النص الموحد"""
+    text = normalize_arabic(text)
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+def minhash_signature(shingles):
+    """توقيع MinHash (قيم 32 بت) أو None إذا لم يكن هناك نص"""
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+    if not hashes:
+        return None
+    return [min((a * h + b) % _MINHASH_PRIME for h in hashes) & 0xffffffff for a, b in MINHASH_PARAMS]
+
+def lsh_band_hashes(signature):
+    """قيمة hash لكل نطاق من التوقيع (31 بت لتناسب عمود Integer)"""
+    return [zlib.crc32(array('I', signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]).tobytes()) & 0x7fffffff
+            for band in range(LSH_BANDS)]
+
+def signature_similarity(a, b):
+    """تقدير تشابه Jaccard من نسبة القيم المتطابقة في التوقيعين"""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+class BloomFilter:
+    """مرشح Bloom: عضوية تقريبية بذاكرة ثابتة (لا سلبيات كاذبة، وإيجابيات كاذبة بنسبة error_rate)"""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing: k مواضع من hash واحد بطول 128 بت
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+class RotatingBloomFilter:
+    """مرشحات Bloom متعاقبة تغطي نافذة زمنية: كل جيل يغطي window/generations ثانية
+
+    المفتاح يُتذكر بين (generations - 1) / generations من النافذة والنافذة كاملة، ثم يُنسى مع تدوير الأجيال.
+    """
+
+    def __init__(self, window_seconds, capacity, error_rate, generations=4):
+        self.generation_seconds = window_seconds / generations
+        self.capacity = capacity
+        # الإيجابية الكاذبة تتراكم عبر الأجيال المفحوصة
+        self.error_rate = error_rate / generations
+        self._filters = [BloomFilter(capacity, self.error_rate) for _ in range(generations)]
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def _rotate(self, now):
+        generation = int(now // self.generation_seconds)
+        if self._generation is None:
+            self._generation = generation
+        elapsed = min(generation - self._generation, len(self._filters))
+        for _ in range(max(elapsed, 0)):
+            self._filters.pop(0)
+            self._filters.append(BloomFilter(self.capacity, self.error_rate))
+        self._generation = max(self._generation, generation)
+
+    def __contains__(self, key):
+        with self._lock:
+            return any(key in bloom for bloom in self._filters)
+
+    def add_if_new(self, key, now=None):
+        """إضافة المفتاح وإرجاع True إذا لم يُرَ خلال النافذة"""
+        with self._lock:
+            self._rotate(now if now is not None else time.time())
+            if any(key in bloom for bloom in self._filters):
+                return False
+            self._filters[-1].add(key)
+            return True
+
+# تصنيف الزواحف والبوتات من User-Agent (تعبير واحد مترجم مسبقاً)
+BOT_USER_AGENT_RE = re.compile(
+    r'bot|crawl|spider|slurp|bingpreview|facebookexternalhit|embedly|whatsapp|telegram|'
+    r'curl|wget|python-requests|python-urllib|httpx|aiohttp|go-http-client|java/|okhttp|'
+    r'scrapy|headless|phantomjs|lighthouse|pingdom|uptime|monitor|semrush|ahrefs|mj12|dotbot|petalbot',
+    re.IGNORECASE
+)
+
+def is_bot_user_agent(user_agent):
+    """هل الطلب من زاحف/بوت معروف؟ (الطلب بدون User-Agent يعتبر بوت)"""
+    if not user_agent:
+        return True
+    return bool(BOT_USER_AGENT_RE.search(user_agent))
+
+# تصنيف مصادر الزيارات من Referer
+TRAFFIC_SOURCES = ('direct', 'organic', 'social', 'referral', 'internal')
+SEARCH_ENGINE_HOST_RE = re.compile(r'(^|\.)(google|bing|yahoo|yandex|duckduckgo|baidu|ecosia|qwant|search\.brave)\.')
+SOCIAL_HOST_RE = re.compile(
+    r'(^|\.)(facebook\.com|fb\.com|fb\.me|t\.co|twitter\.com|x\.com|instagram\.com|linkedin\.com|lnkd\.in|'
+    r'youtube\.com|youtu\.be|reddit\.com|whatsapp\.com|wa\.me|t\.me|telegram\.org|tiktok\.com|snapchat\.com|pinterest\.com)$'
+)
+
+def classify_referrer(referrer, site_host=None):
+    """تحليل Referer إلى (المضيف، مصدر الزيارة)"""
+    if not referrer:
+        return None, 'direct'
+    host = (urlsplit(referrer).hostname or '').lower()
+    if not host:
+        return None, 'direct'
+    if host.startswith('www.'):
+        host = host[4:]
+    host = host[:255]
+    if site_host:
+        site_host = site_host.split(':')[0].lower()
+        if site_host.startswith('www.'):
+            site_host = site_host[4:]
+        if host == site_host:
+            return host, 'internal'
+    if SEARCH_ENGINE_HOST_RE.search(host):
+        return host, 'organic'
+    if SOCIAL_HOST_RE.search(host):
+        return host, 'social'
+    return host, 'referral'
+
+def get_client_ip():
+    """عنوان IP الحقيقي للعميل (يصححه ProxyFix من X-Forwarded-For الموثوق فقط)"""
+    return request.remote_addr
+
 def get_device_type(user_agent):
     """تحديد نوع الجهاز من User-Agent"""
     if not user_agent:
@@ -165,9 +411,8 @@ def get_device_type(user_agent):
         return 'Mobile'
     return 'Desktop'
 
-db = SQLAlchemy(app)
+db = SQLAlchemy()
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 # Models
@@ -184,9 +429,15 @@ class User(UserMixin, db.Model):
     website = db.Column(db.String(200), nullable=True)
     is_admin = db.Column(db.Boolean, default=False, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # يُعيَّن عند بدء حذف الحساب: لا تسجيل دخول ولا جلسات ولا تعليقات جديدة حتى ينتهي الحذف
+    deactivated_at = db.Column(db.DateTime, nullable=True)
     ideas = db.relationship('Idea', backref='author', lazy=True)
     comments = db.relationship('Comment', backref='author', lazy=True)
 
+    @property
+    def is_active(self):
+        return self.deactivated_at is None
+
 class OAuth(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     provider = db.Column(db.String(50), nullable=False)
@@ -195,29 +446,59 @@ class OAuth(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('oauth', lazy=True))
 
+class Category(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)
+    slug = db.Column(db.String(100), unique=True, nullable=False)
+    # عدد الأفكار في التصنيف، يُحدّث تزايدياً مع كل إضافة/تعديل/حذف (انظر adjust_category_count)
+    idea_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
 class Idea(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
+    slug = db.Column(db.String(100), nullable=True, index=True)  # يُحسب مرة واحدة عند الكتابة
     description = db.Column(db.Text, nullable=False)
+    # اسم التصنيف منسوخ من Category للعرض فقط؛ التصفية والعدادات على category_id
     category = db.Column(db.String(50), nullable=False)
+    # بدون فهرس منفرد: ix_idea_category_id_trending يبدأ بـ category_id ويغطي البحث به
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     views = db.Column(db.Integer, default=0)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # درجة الرواج المتناقصة زمنياً (log2 لمجموع الأوزان المُطبّعة - انظر bump_trending)
+    trending_score = db.Column(db.Float, nullable=True, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # توقيع MinHash المضغوط (b'' للنص الفارغ، NULL = لم يُحسب بعد)؛ لا يُحمّل مع الفكرة إلا عند الطلب
+    minhash = db.deferred(db.Column(db.LargeBinary, nullable=True))
     comments = db.relationship('Comment', backref='idea', lazy=True)
-    
+
+    __table_args__ = (
+        db.Index('ix_idea_category_id_trending', 'category_id', 'trending_score'),
+    )
+
+    @db.validates('title')
+    def _update_slug(self, key, title):
+        """تحديث الـ slug المخزن مع كل تغيير للعنوان"""
+        self.slug = make_slug(title)
+        return title
+
+    def set_category(self, category):
+        """ربط الفكرة بتصنيف مع تحديث عدادي التصنيف القديم والجديد"""
+        if self.category_id != category.id:
+            adjust_category_count(self.category_id, -1)
+            adjust_category_count(category.id, 1)
+            self.category_id = category.id
+        self.category = category.name
+
+    def bump_trending(self, weight, when=None):
+        """تحديث درجة الرواج تزايدياً عند حدث مشاهدة أو تعليق"""
+        self.trending_score = add_trending_scores(self.trending_score, trending_event_score(weight, when))
+
     def get_slug(self):
-        """إنشاء slug عربي من عنوان الفكرة"""
-        # تحويل العنوان إلى slug عربي
-        slug = self.title.lower()
-        # استبدال المسافات بشرطات
-        slug = re.sub(r'\s+', '-', slug)
-        # إزالة الأحرف الخاصة
-        slug = re.sub(r'[^\w\s-]', '', slug)
-        # إزالة الشرطات المتعددة
-        slug = re.sub(r'-+', '-', slug)
-        # إزالة الشرطات من البداية والنهاية
-        slug = slug.strip('-')
-        return slug
+        """إرجاع slug الفكرة المخزن (مع حساب احتياطي للأفكار غير المحدّثة)"""
+        if self.slug is None:
+            return make_slug(self.title)
+        return self.slug
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -225,8 +506,13 @@ class Comment(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, nullable=True)
     is_published = db.Column(db.Boolean, default=True, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    idea_id = db.Column(db.Integer, db.ForeignKey('idea.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    idea_id = db.Column(db.Integer, db.ForeignKey('idea.id'), nullable=False, index=True)
+
+    __table_args__ = (
+        # صفحات التعليقات المنشورة لفكرة، مرتبة بالتاريخ
+        db.Index('ix_comment_idea_published_created', 'idea_id', 'is_published', 'created_at'),
+    )
 
 class Visit(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -236,136 +522,1475 @@ class Visit(db.Model):
     device_type = db.Column(db.String(50), nullable=True)  # mobile, desktop, tablet
     page_path = db.Column(db.String(500), nullable=True)
     referrer = db.Column(db.String(500), nullable=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    # المرجع مُحلَّل مرة واحدة عند التسجيل (انظر classify_referrer)
+    referrer_host = db.Column(db.String(255), nullable=True, index=True)
+    traffic_source = db.Column(db.String(20), nullable=True)  # direct, organic, social, referral, internal
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user = db.relationship('User', backref=db.backref('visits', lazy=True))
 
-# Google OAuth blueprint
-# تحقق من أن القيم موجودة قبل إنشاء blueprint
-google_oauth_enabled = bool(app.config.get('GOOGLE_OAUTH_CLIENT_ID') and app.config.get('GOOGLE_OAUTH_CLIENT_SECRET'))
-
-if not google_oauth_enabled:
-    app.logger.warning('⚠️ تحذير: GOOGLE_OAUTH_CLIENT_ID أو GOOGLE_OAUTH_CLIENT_SECRET غير موجودة في البيئة!')
-    app.logger.warning(f'GOOGLE_OAUTH_CLIENT_ID: {app.config.get("GOOGLE_OAUTH_CLIENT_ID")}')
-    app.logger.warning(f'GOOGLE_OAUTH_CLIENT_SECRET: {"***" if app.config.get("GOOGLE_OAUTH_CLIENT_SECRET") else "None"}')
-    google_bp = None
-else:
-    # بناء redirect URL بشكل صحيح
-    if app.config.get('SERVER_NAME'):
-        # إذا كان SERVER_NAME موجود، استخدمه مع scheme
-        # للمحلي: http، للإنتاج: https
-        scheme = app.config.get('PREFERRED_URL_SCHEME', 'https')
-        # إذا كان localhost، استخدم http دائماً
-        if 'localhost' in app.config['SERVER_NAME'] or '127.0.0.1' in app.config['SERVER_NAME']:
-            scheme = 'http'
-        redirect_url = f"{scheme}://{app.config['SERVER_NAME']}/login/google/authorized"
-    else:
-        # إذا لم يكن موجود، استخدم القيمة الافتراضية
-        redirect_url = None
-    
-    # التأكد من أن القيم ليست None أو فارغة
-    client_id = app.config['GOOGLE_OAUTH_CLIENT_ID']
-    client_secret = app.config['GOOGLE_OAUTH_CLIENT_SECRET']
-    
-    if not client_id or not client_secret:
-        app.logger.error('❌ خطأ: GOOGLE_OAUTH_CLIENT_ID أو CLIENT_SECRET فارغة!')
-        google_bp = None
-    else:
-        # بناء معاملات blueprint بشكل صريح
-        blueprint_kwargs = {
-            'client_id': client_id,
-            'client_secret': client_secret,
-            'scope': [
-                'https://www.googleapis.com/auth/userinfo.email',
-                'https://www.googleapis.com/auth/userinfo.profile',
-                'openid'
-            ],
-            'storage': SQLAlchemyStorage(OAuth, db.session, user=current_user),
-            'offline': False
-        }
-        
+    __table_args__ = (
+        # سجل الزيارات في لوحة التحكم: ترقيم keyset وتصفية مع الترتيب الزمني
+        db.Index('ix_visit_created_id', 'created_at', 'id'),
+        db.Index('ix_visit_path_created', 'page_path', 'created_at'),
+        db.Index('ix_visit_ip_created', 'ip_address', 'created_at'),
+        db.Index('ix_visit_browser_created', 'browser', 'created_at'),
+        db.Index('ix_visit_device_created', 'device_type', 'created_at'),
+        db.Index('ix_visit_source_created', 'traffic_source', 'created_at'),
+        db.Index('ix_visit_source_path', 'traffic_source', 'page_path'),
+    )
+
+class IdeaBand(db.Model):
+    """نطاقات LSH لتوقيع كل فكرة: الأفكار التي تشترك في (band, hash) مرشحة للتشابه"""
+    id = db.Column(db.Integer, primary_key=True)
+    idea_id = db.Column(db.Integer, db.ForeignKey('idea.id'), nullable=False, index=True)
+    band = db.Column(db.SmallInteger, nullable=False)
+    hash = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_idea_band_lookup', 'band', 'hash'),
+    )
+
+class DuplicateCluster(db.Model):
+    """مجموعة أفكار متشابهة ناتجة عن مهمة cluster_duplicate_ideas"""
+    id = db.Column(db.Integer, primary_key=True)
+    idea_ids = db.Column(db.JSON, nullable=False)
+    similarity = db.Column(db.Float, nullable=False)  # أعلى تشابه بين زوج في المجموعة
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class IdeaDailyStat(db.Model):
+    """عدادات يومية لكل فكرة (مشاهدات، زوار فريدون، تعليقات) تُحدّث تزايدياً"""
+    id = db.Column(db.Integer, primary_key=True)
+    idea_id = db.Column(db.Integer, db.ForeignKey('idea.id'), nullable=False)
+    # صاحب الفكرة مكرر هنا حتى يُقرأ رسم البروفايل من نطاق واحد على (user_id, day)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    views = db.Column(db.Integer, nullable=False, default=0)
+    visitors = db.Column(db.Integer, nullable=False, default=0)
+    comments = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_idea_daily_stat_idea_day', 'idea_id', 'day', unique=True),
+        db.Index('ix_idea_daily_stat_user_day', 'user_id', 'day'),
+    )
+
+class IdeaDailyVisitor(db.Model):
+    """زوار الفكرة في يوم واحد حتى يُحتسب الزائر مرة واحدة عبر جميع العمال (تُحذف الأيام السابقة يومياً)"""
+    id = db.Column(db.Integer, primary_key=True)
+    idea_id = db.Column(db.Integer, db.ForeignKey('idea.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False, index=True)
+    visitor_hash = db.Column(db.String(16), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_idea_daily_visitor_unique', 'idea_id', 'day', 'visitor_hash', unique=True),
+    )
+
+class UserDeletion(db.Model):
+    """تتبع حذف مستخدم وبياناته على دفعات في الخلفية"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)  # بدون FK لأن المستخدم سيُحذف
+    username = db.Column(db.String(80), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, failed
+    total_rows = db.Column(db.Integer, nullable=False, default=0)
+    deleted_rows = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    @property
+    def progress(self):
+        """نسبة التقدم المئوية"""
+        if self.status == 'done':
+            return 100
+        if not self.total_rows:
+            return 0
+        return min(99, int(self.deleted_rows * 100 / self.total_rows))
+
+class Job(db.Model):
+    """مهمة خلفية في طابور (تُنفَّذ بواسطة flask worker)"""
+    id = db.Column(db.Integer, primary_key=True)
+    queue = db.Column(db.String(50), nullable=False, default='default')
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.JSON, nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # آخر دليل على أن العامل ما زال ينفذ المهمة
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_job_claim', 'status', 'queue', 'run_at'),
+    )
+
+# النماذج التي تُرسل تغييراتها على ناقل الإبطال
+INVALIDATION_TOPICS = {Idea: 'idea', Comment: 'comment', User: 'user', Category: 'category'}
+
+REDUNDANT_INDEXES = ['ix_idea_category_id']
+
+def upgrade_schema():
+    """إضافة الأعمدة والفهارس الجديدة إلى الجداول الموجودة (بديل خفيف عن Flask-Migrate)"""
+    db.create_all()
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as conn:
+                conn.execute(db.text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+            app.logger.info(f'تمت إضافة العمود {table.name}.{column.name}')
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    # فهارس قديمة أصبحت زائدة لأن فهرساً مركباً يبدأ بنفس العمود
+    with db.engine.begin() as conn:
+        for index_name in REDUNDANT_INDEXES:
+            conn.execute(db.text(f'DROP INDEX IF EXISTS "{index_name}"'))
+
+def backfill_idea_slugs(batch_size=500):
+    """حساب slug للأفكار القديمة على دفعات"""
+    updated = 0
+    while True:
+        rows = db.session.query(Idea.id, Idea.title).filter(Idea.slug.is_(None)).limit(batch_size).all()
+        if not rows:
+            break
+        db.session.execute(
+            db.update(Idea),
+            [{'id': idea_id, 'slug': make_slug(title)} for idea_id, title in rows]
+        )
+        invalidation_bus.publish_many('idea', [idea_id for idea_id, _ in rows])
+        db.session.commit()
+        updated += len(rows)
+    return updated
+
+def backfill_trending_scores(batch_size=500):
+    """حساب درجة رواج أولية للأفكار القديمة من المشاهدات والتعليقات المسجلة"""
+    updated = 0
+    while True:
+        ideas = Idea.query.filter(Idea.trending_score.is_(None)).limit(batch_size).all()
+        if not ideas:
+            break
+        comment_times = db.session.query(Comment.idea_id, Comment.created_at)\
+            .filter(Comment.idea_id.in_([idea.id for idea in ideas])).all()
+        for idea in ideas:
+            # لا نعرف توقيت المشاهدات القديمة، فنحسبها كلها عند إنشاء الفكرة
+            idea.bump_trending(TRENDING_VIEW_WEIGHT * max(idea.views or 0, 1), idea.created_at)
+        ideas_by_id = {idea.id: idea for idea in ideas}
+        for idea_id, created_at in comment_times:
+            ideas_by_id[idea_id].bump_trending(TRENDING_COMMENT_WEIGHT, created_at)
+        db.session.commit()
+        updated += len(ideas)
+    return updated
+
+# ناقل إبطال الكاش بين العمال والخوادم
+# كل كاش في ذاكرة العامل يشترك في topics (idea, comment, user, category) ويُفرغ عند وصول حدث منها.
+# الأحداث تُجمع أثناء transaction (تغييرات ORM تلقائياً، والجمل الجماعية عبر publish) وتُرسل بعد commit فقط:
+# تُطبق فوراً في العامل الحالي، وتصل للبقية عبر PostgreSQL LISTEN/NOTIFY أو ملف سجل مشترك (SQLite/التطوير)
+INVALIDATION_CHANNEL = 'cache_invalidation'
+INVALIDATION_MAX_EVENTS = 100  # أكثر من ذلك في transaction واحدة يُرسل كإبطال كامل للـ topic (حد NOTIFY 8000 بايت)
+INVALIDATION_POLL_SECONDS = 0.5
+INVALIDATION_RETRY_SECONDS = 5
+INVALIDATION_LOG_MAX_BYTES = 1024 * 1024
+INVALIDATION_SESSION_KEY = 'pending_invalidations'
+
+class InvalidationBus:
+    """نشر أحداث التغيير لجميع العمال وتوزيعها على الكاشات المشتركة"""
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.origin = f'{socket.gethostname()}-{uuid.uuid4().hex[:8]}'
+        self._handlers = {}
+        self._listener_pid = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic, handler):
+        """handler(key): key هو معرف السجل المتغير أو None للـ topic كاملاً"""
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def has_subscribers(self, topic):
+        return topic in self._handlers
+
+    def publish(self, topic, key=None):
+        """تسجيل حدث في transaction الحالية (أو إرساله فوراً خارج أي transaction)"""
+        self.publish_many(topic, [key])
+
+    def publish_many(self, topic, keys):
+        """أحداث لعدة سجلات من جملة جماعية (أكثر من INVALIDATION_MAX_EVENTS تصبح إبطالاً كاملاً للـ topic)"""
+        if not self.has_subscribers(topic):
+            return
+        keys = set(keys)
+        if not keys:
+            return
+        if len(keys) > INVALIDATION_MAX_EVENTS:
+            keys = {None}
+        session = db.session()
+        if session.in_transaction():
+            session.info.setdefault(INVALIDATION_SESSION_KEY, set()).update((topic, key) for key in keys)
+        else:
+            self.dispatch({(topic, key) for key in keys})
+
+    def dispatch(self, events):
+        if len(events) > INVALIDATION_MAX_EVENTS:
+            events = {(topic, None) for topic, _ in events}
+        self._deliver(events)
+        payload = json.dumps({'origin': self.origin, 'events': sorted(events, key=str)}, ensure_ascii=False)
         try:
-            # بناء redirect_url بشكل ديناميكي بناءً على البيئة
-            if app.config.get('SERVER_NAME'):
-                scheme = app.config.get('PREFERRED_URL_SCHEME', 'http')
-                redirect_url = f"{scheme}://{app.config['SERVER_NAME']}/login/google/authorized"
-                blueprint_kwargs['redirect_url'] = redirect_url
-            
-            # التحقق من أن client_id و client_secret موجودان قبل إنشاء blueprint
-            if not client_id or not client_secret:
-                app.logger.error('خطأ: client_id أو client_secret فارغة قبل إنشاء blueprint!')
-                google_bp = None
+            if db.engine.dialect.name == 'postgresql':
+                with db.engine.connect() as conn:
+                    conn.execute(db.text('SELECT pg_notify(:channel, :payload)'),
+                                 {'channel': INVALIDATION_CHANNEL, 'payload': payload})
+                    conn.commit()
             else:
-                app.logger.info('إنشاء Google OAuth blueprint...')
-                
-                google_bp = make_google_blueprint(**blueprint_kwargs)
-                app.logger.info('تم إنشاء Google OAuth blueprint بنجاح')
-                
-                # التحقق من أن blueprint تم إنشاؤه بشكل صحيح
-                if google_bp:
-                    app.register_blueprint(google_bp, url_prefix='/login')
-                    app.logger.info('تم تسجيل Google OAuth blueprint بنجاح')
-                else:
-                    app.logger.error('خطأ: blueprint لم يتم إنشاؤه!')
-                    google_bp = None
+                self._append_log(payload)
         except Exception as e:
-            app.logger.error(f'خطأ في إنشاء Google OAuth blueprint: {e}', exc_info=True)
-            google_bp = None
+            # العمال الآخرون يعتمدون على TTL الاحتياطي لكاشاتهم
+            app.logger.warning(f'تعذر إرسال أحداث الإبطال: {e}')
+
+    def _deliver(self, events):
+        for topic, key in events:
+            for handler in self._handlers.get(topic, ()):
+                handler(key)
+
+    def _deliver_all(self):
+        # بعد انقطاع الاستماع قد تكون أحداث فاتتنا: إفراغ كل الكاشات
+        self._deliver({(topic, None) for topic in self._handlers})
+
+    def _receive(self, payload):
+        message = json.loads(payload)
+        if message['origin'] != self.origin:
+            self._deliver({(topic, key) for topic, key in message['events']})
+
+    def _append_log(self, payload):
+        os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+        fd = os.open(self.log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size > INVALIDATION_LOG_MAX_BYTES:
+                os.ftruncate(fd, 0)
+            # سطر واحد بكتابة واحدة مع O_APPEND: لا تتداخل أسطر العمال
+            os.write(fd, payload.encode('utf-8') + b'\n')
+        finally:
+            os.close(fd)
+
+    def ensure_listener(self):
+        """تشغيل خيط الاستماع مرة لكل عملية (أي بعد fork في gunicorn --preload)"""
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+        with self._lock:
+            if self._listener_pid == pid:
+                return
+            self._listener_pid = pid
+        # الأحداث التي سبقت بدء الاستماع في هذه العملية لا تصلها
+        self._deliver_all()
+        target = self._listen_postgres if db.engine.dialect.name == 'postgresql' else self._listen_log
+        threading.Thread(target=target, daemon=True).start()
+
+    def _listen_postgres(self):
+        import select
+        import psycopg2
+        while True:
+            try:
+                with app.app_context():
+                    dsn = db.engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+                conn = psycopg2.connect(dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f'LISTEN {INVALIDATION_CHANNEL}')
+                self._deliver_all()
+                while True:
+                    if select.select([conn], [], [], INVALIDATION_RETRY_SECONDS) != ([], [], []):
+                        conn.poll()
+                        while conn.notifies:
+                            self._receive(conn.notifies.pop(0).payload)
+            except Exception as e:
+                app.logger.warning(f'انقطع الاستماع لأحداث الإبطال: {e}')
+                time.sleep(INVALIDATION_RETRY_SECONDS)
+
+    def _listen_log(self):
+        offset = os.path.getsize(self.log_file) if os.path.exists(self.log_file) else 0
+        while True:
+            time.sleep(INVALIDATION_POLL_SECONDS)
+            try:
+                size = os.path.getsize(self.log_file)
+            except FileNotFoundError:
+                continue
+            if size < offset:
+                # الملف قُص: لا نعرف ما فاتنا
+                offset = 0
+                self._deliver_all()
+            if size == offset:
+                continue
+            with open(self.log_file, 'rb') as f:
+                f.seek(offset)
+                data = f.read(size - offset)
+            # سطر غير مكتمل يُقرأ في الدورة التالية
+            complete = data.rfind(b'\n') + 1
+            offset += complete
+            for line in data[:complete].splitlines():
+                try:
+                    self._receive(line)
+                except (ValueError, KeyError):
+                    continue
+
+invalidation_bus = InvalidationBus(os.environ.get('INVALIDATION_LOG') or os.path.join(app.instance_path, 'invalidation.log'))
+
+@db.event.listens_for(db.session, 'after_flush')
+def _collect_invalidations(session, flush_context):
+    """تسجيل السجلات المضافة/المعدلة/المحذوفة من النماذج التي لها topic"""
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        topic = INVALIDATION_TOPICS.get(type(instance))
+        if invalidation_bus.has_subscribers(topic):
+            session.info.setdefault(INVALIDATION_SESSION_KEY, set()).add((topic, instance.id))
+
+@db.event.listens_for(db.session, 'after_commit')
+def _dispatch_invalidations(session):
+    events = session.info.pop(INVALIDATION_SESSION_KEY, None)
+    if events:
+        invalidation_bus.dispatch(events)
+
+@db.event.listens_for(db.session, 'after_rollback')
+def _discard_invalidations(session):
+    session.info.pop(INVALIDATION_SESSION_KEY, None)
+
+class InvalidatedCache:
+    """قيمة محسوبة في ذاكرة العامل تُفرغ عند أحداث topics المشترك فيها (مع TTL احتياطي طويل)"""
+
+    def __init__(self, loader, topics, max_age):
+        self.loader = loader
+        self.max_age = max_age
+        self._value = None
+        self._loaded_at = 0.0
+        self._version = 0
+        for topic in topics:
+            invalidation_bus.subscribe(topic, self.clear)
+
+    def get(self):
+        invalidation_bus.ensure_listener()
+        value = self._value
+        if value is None or time.monotonic() - self._loaded_at > self.max_age:
+            version = self._version
+            value = self.loader()
+            # إبطال وصل أثناء التحميل: لا نخزن قيمة قد تكون قديمة
+            if version == self._version:
+                self._value, self._loaded_at = value, time.monotonic()
+        return value
+
+    def clear(self, key=None):
+        self._version += 1
+        self._value = None
+
+# التصنيفات: جدول Category مع عداد أفكار يُحدّث تزايدياً
+# صفحات القوائم تقرأ التصنيفات وعداداتها من نسخة مخزنة في ذاكرة العامل بدون مسح جدول idea
+DEFAULT_CATEGORIES = [
+    'أعمال', 'إدارة', 'اجتماعي', 'بيئة', 'تجارة', 'تحليل', 'تسويق', 'تصميم', 'تعليم', 'تقنية',
+    'تكنولوجيا', 'صحة', 'عمارة', 'فن', 'قراءة', 'كتابة', 'مجتمع', 'محتوى', 'نشر', 'أخرى',
+]
+# الكاش يُفرغ بأحداث category من ناقل الإبطال؛ المدة احتياط فقط إذا فات حدث
+CATEGORY_CACHE_SECONDS = 600
+CategoryFacet = namedtuple('CategoryFacet', ['id', 'name', 'slug', 'idea_count'])
+
+def load_categories():
+    rows = db.session.query(Category.id, Category.name, Category.slug, Category.idea_count).order_by(Category.id)
+    return [CategoryFacet(*row) for row in rows]
+
+_category_cache = InvalidatedCache(load_categories, topics=('category',), max_age=CATEGORY_CACHE_SECONDS)
+
+def get_categories():
+    """التصنيفات مع عدد أفكار كل منها (مرتبة حسب المعرف)"""
+    return _category_cache.get()
+
+def invalidate_categories(category_id=None):
+    """إبطال كاش التصنيفات في جميع العمال بعد commit التغيير"""
+    invalidation_bus.publish('category', category_id)
+
+def find_category(value):
+    """البحث عن تصنيف بالمعرف، أو بالـ slug/الاسم للروابط القديمة"""
+    if not value:
+        return None
+    for category in get_categories():
+        if str(category.id) == value or value in (category.slug, category.name):
+            return category
+    return None
+
+def adjust_category_count(category_id, delta):
+    """تعديل عداد أفكار التصنيف ذرياً ضمن transaction الجلسة الحالية"""
+    if not category_id or not delta:
+        return
+    db.session.execute(
+        db.update(Category).where(Category.id == category_id)
+        .values(idea_count=Category.idea_count + delta)
+        .execution_options(synchronize_session=False)
+    )
+    invalidate_categories(category_id)
+
+def release_idea_categories(idea_ids):
+    """إنقاص عدادات التصنيفات لأفكار على وشك الحذف (استعلام تجميعي واحد)"""
+    rows = db.session.query(Idea.category_id, db.func.count(Idea.id))\
+        .filter(Idea.id.in_(idea_ids), Idea.category_id.isnot(None))\
+        .group_by(Idea.category_id).all()
+    for category_id, count in rows:
+        adjust_category_count(category_id, -count)
+
+def recount_categories():
+    """إعادة حساب عدادات التصنيفات من جدول الأفكار (بعد الترحيل أو لتصحيح أي انحراف)"""
+    counts = db.select(db.func.count(Idea.id)).where(Idea.category_id == Category.id).correlate(Category).scalar_subquery()
+    db.session.execute(db.update(Category).values(idea_count=counts).execution_options(synchronize_session=False))
+    invalidate_categories()
+    db.session.commit()
+
+def _unique_category_slug(name, taken):
+    base = make_slug(name) or 'category'
+    slug, suffix = base, 2
+    while slug in taken:
+        slug, suffix = f'{base}-{suffix}', suffix + 1
+    taken.add(slug)
+    return slug
+
+def backfill_categories():
+    """إنشاء التصنيفات الافتراضية وترحيل قيم Idea.category النصية إلى category_id"""
+    categories = {category.name: category for category in Category.query.all()}
+    taken_slugs = {category.slug for category in categories.values()}
+    legacy_names = [name for (name,) in db.session.query(Idea.category).filter(Idea.category_id.is_(None)).distinct()]
+    for name in DEFAULT_CATEGORIES + legacy_names:
+        if name not in categories:
+            categories[name] = Category(name=name, slug=_unique_category_slug(name, taken_slugs))
+            db.session.add(categories[name])
+    db.session.flush()
+
+    linked = 0
+    for name in legacy_names:
+        result = db.session.execute(
+            db.update(Idea).where(Idea.category_id.is_(None), Idea.category == name)
+            .values(category_id=categories[name].id)
+            .execution_options(synchronize_session=False)
+        )
+        linked += result.rowcount
+    if linked:
+        invalidation_bus.publish('idea')
+    db.session.commit()
+    recount_categories()
+    return linked
+
+# فهرس الأفكار المتشابهة (MinHash + LSH) في جدول idea_band
+DUPLICATE_CANDIDATES_LIMIT = 200
+DUPLICATE_MAX_BUCKET = 50
+
+def idea_signature(title, description):
+    return minhash_signature(text_shingles(f'{title or ""} {description or ""}'))
+
+def index_idea_minhash(idea):
+    """تحديث توقيع الفكرة ونطاقاتها بعد الإضافة أو التعديل (الفكرة يجب أن يكون لها id)"""
+    signature = idea_signature(idea.title, idea.description)
+    IdeaBand.query.filter(IdeaBand.idea_id == idea.id).delete(synchronize_session=False)
+    if signature is None:
+        idea.minhash = b''
+        return
+    idea.minhash = array('I', signature).tobytes()
+    db.session.execute(db.insert(IdeaBand), [
+        {'idea_id': idea.id, 'band': band, 'hash': value}
+        for band, value in enumerate(lsh_band_hashes(signature))
+    ])
+
+def load_signatures(idea_ids):
+    """توقيعات مجموعة من الأفكار {id: [قيم]} على دفعات"""
+    signatures = {}
+    idea_ids = list(idea_ids)
+    for start in range(0, len(idea_ids), 500):
+        rows = db.session.query(Idea.id, Idea.minhash).filter(Idea.id.in_(idea_ids[start:start + 500]))
+        for idea_id, packed in rows:
+            if packed:
+                signatures[idea_id] = array('I', packed).tolist()
+    return signatures
+
+def find_similar_ideas(title, description, exclude_id=None, limit=5, threshold=DUPLICATE_THRESHOLD):
+    """الأفكار المحتمل تكرارها مع نسبة التشابه التقديرية [(فكرة، تشابه)]
+
+    المرشحون فقط من يشاركون النص نطاقاً واحداً على الأقل (فهرس ix_idea_band_lookup)،
+    فلا يمر البحث على جميع الأفكار.
+    """
+    signature = idea_signature(title, description)
+    if signature is None:
+        return []
+    candidates = db.session.query(IdeaBand.idea_id).filter(db.or_(*[
+        db.and_(IdeaBand.band == band, IdeaBand.hash == value)
+        for band, value in enumerate(lsh_band_hashes(signature))
+    ]))
+    if exclude_id:
+        candidates = candidates.filter(IdeaBand.idea_id != exclude_id)
+    candidate_ids = [idea_id for (idea_id,) in candidates.distinct().limit(DUPLICATE_CANDIDATES_LIMIT)]
+    scored = [(idea_id, signature_similarity(signature, other))
+              for idea_id, other in load_signatures(candidate_ids).items()]
+    scored = sorted((item for item in scored if item[1] >= threshold), key=lambda item: item[1], reverse=True)[:limit]
+    if not scored:
+        return []
+    ideas = {idea.id: idea for idea in Idea.query.filter(Idea.id.in_([idea_id for idea_id, _ in scored]))}
+    return [(ideas[idea_id], similarity) for idea_id, similarity in scored if idea_id in ideas]
+
+def backfill_idea_minhash(batch_size=200):
+    """حساب التوقيعات والنطاقات للأفكار القديمة على دفعات"""
+    updated = 0
+    while True:
+        ideas = Idea.query.filter(Idea.minhash.is_(None)).limit(batch_size).all()
+        if not ideas:
+            break
+        for idea in ideas:
+            index_idea_minhash(idea)
+        db.session.commit()
+        job_heartbeat()
+        updated += len(ideas)
+    return updated
+
+def cluster_duplicate_ideas(threshold=DUPLICATE_THRESHOLD, max_bucket=DUPLICATE_MAX_BUCKET):
+    """تجميع الأفكار المتشابهة الموجودة في مجموعات وحفظها في duplicate_cluster
+
+    الأزواج المرشحة من النطاقات المشتركة فقط، ثم union-find على الأزواج التي تتجاوز العتبة.
+    """
+    shared = db.session.query(IdeaBand.band, IdeaBand.hash)\
+        .group_by(IdeaBand.band, IdeaBand.hash).having(db.func.count(IdeaBand.id) > 1).subquery()
+    rows = db.session.query(IdeaBand.band, IdeaBand.hash, IdeaBand.idea_id)\
+        .join(shared, db.and_(IdeaBand.band == shared.c.band, IdeaBand.hash == shared.c.hash))\
+        .order_by(IdeaBand.band, IdeaBand.hash, IdeaBand.idea_id)
+    pairs = set()
+    for _, bucket in groupby(rows.yield_per(2000), key=lambda row: (row.band, row.hash)):
+        # النطاقات الضخمة (نص قالب متكرر) لا تفيد وتضاعف عدد الأزواج
+        pairs.update(combinations([row.idea_id for row in bucket][:max_bucket], 2))
+
+    signatures = load_signatures({idea_id for pair in pairs for idea_id in pair})
+    parent = {}
+
+    def find(idea_id):
+        parent.setdefault(idea_id, idea_id)
+        while parent[idea_id] != idea_id:
+            parent[idea_id] = parent[parent[idea_id]]
+            idea_id = parent[idea_id]
+        return idea_id
+
+    best = {}
+    for a, b in pairs:
+        if a not in signatures or b not in signatures:
+            continue
+        similarity = signature_similarity(signatures[a], signatures[b])
+        if similarity >= threshold:
+            root_a, root_b = find(a), find(b)
+            parent[root_a] = root_b
+            best[(a, b)] = similarity
+
+    clusters = {}
+    for idea_id in parent:
+        clusters.setdefault(find(idea_id), []).append(idea_id)
+    cluster_similarity = {}
+    for (a, b), similarity in best.items():
+        root = find(a)
+        cluster_similarity[root] = max(cluster_similarity.get(root, 0), similarity)
+
+    DuplicateCluster.query.delete(synchronize_session=False)
+    for root, idea_ids in clusters.items():
+        if len(idea_ids) > 1:
+            db.session.add(DuplicateCluster(idea_ids=sorted(idea_ids), similarity=cluster_similarity[root]))
+    db.session.commit()
+    return sum(1 for idea_ids in clusters.values() if len(idea_ids) > 1)
+
+# الإحصائيات اليومية للأفكار
+# صف واحد لكل (فكرة، يوم) يُزاد بـ INSERT ... ON CONFLICT DO UPDATE، والرسوم تقرأ آخر IDEA_STATS_DAYS يوماً من فهرس
+IDEA_STATS_DAYS = 30
+DailyStat = namedtuple('DailyStat', ['day', 'views', 'visitors', 'comments'])
+IDEA_STAT_FIELDS = ('views', 'visitors', 'comments')
+IDEA_PAGE_PATH = re.compile(r'^/idea/(\d+)(?:/([^/]+))?/?$')
+IDEA_PAGE_EXCLUDED_SLUGS = {'edit', 'comment', 'comments'}
+
+def _upsert_daily_stats(rows, increment=True):
+    """rows: قواميس (idea_id, user_id, day, views, visitors, comments)؛ increment=False يستبدل القيم"""
+    if not rows:
+        return
+    insert = postgresql_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    statement = insert(IdeaDailyStat).values(rows)
+    if increment:
+        updates = {field: getattr(IdeaDailyStat, field) + getattr(statement.excluded, field) for field in IDEA_STAT_FIELDS}
+    else:
+        updates = {field: getattr(statement.excluded, field) for field in IDEA_STAT_FIELDS}
+    db.session.execute(statement.on_conflict_do_update(index_elements=['idea_id', 'day'], set_=updates))
+
+def record_daily_visitor(idea, visitor, day=None):
+    """تسجيل زائر الفكرة لليوم بـ INSERT ... ON CONFLICT DO NOTHING؛ True إذا كان جديداً في أي عامل"""
+    insert = postgresql_insert if db.engine.dialect.name == 'postgresql' else sqlite_insert
+    visitor_hash = hashlib.blake2b(visitor.encode('utf-8'), digest_size=8).hexdigest()
+    statement = insert(IdeaDailyVisitor).values(idea_id=idea.id, day=day or datetime.utcnow().date(),
+                                                visitor_hash=visitor_hash)
+    result = db.session.execute(statement.on_conflict_do_nothing(index_elements=['idea_id', 'day', 'visitor_hash']))
+    return result.rowcount == 1
+
+def bump_idea_daily_stats(idea, views=0, visitors=0, comments=0):
+    """زيادة عدادات اليوم الحالي للفكرة ضمن transaction الجلسة الحالية"""
+    _upsert_daily_stats([{'idea_id': idea.id, 'user_id': idea.user_id, 'day': datetime.utcnow().date(),
+                          'views': views, 'visitors': visitors, 'comments': comments}])
+
+def discount_deleted_comments(comments):
+    """إنقاص عداد التعليقات في يوم إنشاء كل تعليق محذوف؛ comments أزواج (idea_id, created_at)"""
+    removed = Counter((idea_id, created_at.date()) for idea_id, created_at in comments)
+    if not removed:
+        return
+    table = IdeaDailyStat.__table__
+    count = db.bindparam('removed_count')
+    db.session.execute(
+        table.update()
+        .where(table.c.idea_id == db.bindparam('stat_idea_id'), table.c.day == db.bindparam('stat_day'))
+        .values(comments=db.case((table.c.comments > count, table.c.comments - count), else_=0)),
+        [{'stat_idea_id': idea_id, 'stat_day': day, 'removed_count': n} for (idea_id, day), n in removed.items()]
+    )
+
+def load_daily_stats(column, value, days=IDEA_STATS_DAYS):
+    """سلسلة آخر days يوماً (مع الأيام الفارغة) لفكرة أو لجميع أفكار مستخدم"""
+    start = datetime.utcnow().date() - timedelta(days=days - 1)
+    rows = db.session.query(
+        IdeaDailyStat.day, db.func.sum(IdeaDailyStat.views), db.func.sum(IdeaDailyStat.visitors),
+        db.func.sum(IdeaDailyStat.comments)
+    ).filter(column == value, IdeaDailyStat.day >= start).group_by(IdeaDailyStat.day)
+    by_day = {day: counts for day, *counts in rows}
+    series = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        series.append(DailyStat(day, *(int(count or 0) for count in by_day.get(day, (0, 0, 0)))))
+    return series
+
+def backfill_idea_daily_stats(batch_size=1000):
+    """ملء الأيام السابقة من جدولي الزيارات والتعليقات (مرة واحدة؛ اليوم الحالي يُحدّث مباشرة)"""
+    today = datetime.utcnow().date()
+    owners = dict(db.session.query(Idea.id, Idea.user_id))
+    stats = {}
+
+    def add(idea_id, day, **counts):
+        day = day if isinstance(day, date) else date.fromisoformat(day)
+        if idea_id not in owners or day >= today:
+            return
+        row = stats.setdefault((idea_id, day), {'idea_id': idea_id, 'user_id': owners[idea_id], 'day': day,
+                                                'views': 0, 'visitors': 0, 'comments': 0})
+        for field, count in counts.items():
+            row[field] += count
+
+    # المشاهدات القديمة من سجل الزيارات (مشاهدات خام، والزوار بعدد عناوين IP المختلفة لكل مسار)
+    visit_day = db.func.date(Visit.created_at)
+    visit_rows = db.session.query(
+        Visit.page_path, visit_day, db.func.count(Visit.id), db.func.count(db.func.distinct(Visit.ip_address))
+    ).filter(Visit.page_path.like('/idea/%')).group_by(Visit.page_path, visit_day)
+    for page_path, day, views, visitors in visit_rows:
+        match = IDEA_PAGE_PATH.match(page_path or '')
+        if match and match.group(2) not in IDEA_PAGE_EXCLUDED_SLUGS:
+            add(int(match.group(1)), day, views=views, visitors=visitors)
+
+    comment_day = db.func.date(Comment.created_at)
+    for idea_id, day, comments in db.session.query(Comment.idea_id, comment_day, db.func.count(Comment.id))\
+            .group_by(Comment.idea_id, comment_day):
+        add(idea_id, day, comments=comments)
+
+    rows = list(stats.values())
+    for start in range(0, len(rows), batch_size):
+        _upsert_daily_stats(rows[start:start + batch_size], increment=False)
+        db.session.commit()
+        job_heartbeat()
+    return len(rows)
+
+# حذف المستخدمين على دفعات
+# كل دفعة في transaction قصيرة حتى لا تُقفل جداول visit و comment لفترة طويلة
+USER_DELETION_CHUNK_SIZE = int(os.environ.get('USER_DELETION_CHUNK_SIZE', 1000))
+
+def _user_deletion_targets(user_id):
+    """الاستعلامات التي تحدد الصفوف المطلوب حذفها بالترتيب (التوابع أولاً)"""
+    user_idea_ids = db.select(Idea.id).where(Idea.user_id == user_id)
+    return [
+        # تعليقات المستخدم وتعليقات الآخرين على أفكاره في شرط واحد حتى لا يُعد الصف مرتين في total_rows
+        (Comment, db.or_(Comment.user_id == user_id, Comment.idea_id.in_(user_idea_ids))),
+        (Visit, Visit.user_id == user_id),
+        (OAuth, OAuth.user_id == user_id),
+        (IdeaBand, IdeaBand.idea_id.in_(user_idea_ids)),
+        (IdeaDailyStat, IdeaDailyStat.user_id == user_id),
+        (IdeaDailyVisitor, IdeaDailyVisitor.idea_id.in_(user_idea_ids)),
+        (Idea, Idea.user_id == user_id),
+    ]
+
+def start_user_deletion(user):
+    """تعطيل الحساب وتسجيل عملية حذفه وإضافتها إلى طابور المهام الخلفية
+
+    التعطيل في نفس transaction: لا يمكن للمستخدم تسجيل الدخول أو إضافة أفكار وتعليقات
+    أثناء الحذف، ولا يمكن لغيره التعليق على أفكاره، فلا تظهر صفوف جديدة بعد حساب total_rows.
+    """
+    user.deactivated_at = datetime.utcnow()
+    deletion = UserDeletion(user_id=user.id, username=user.username)
+    db.session.add(deletion)
+    db.session.flush()
+    enqueue_job('delete_user', {'deletion_id': deletion.id}, queue='maintenance')
+    db.session.commit()
+    return deletion
+
+def run_user_deletion(deletion_id, chunk_size=None):
+    """تنفيذ حذف مستخدم على دفعات (يمكن استئنافها بأمان إذا توقفت)"""
+    chunk_size = chunk_size or USER_DELETION_CHUNK_SIZE
+    deletion = db.session.get(UserDeletion, deletion_id)
+    if not deletion or deletion.status == 'done':
+        return
+    try:
+        targets = _user_deletion_targets(deletion.user_id)
+        if deletion.status == 'pending':
+            deletion.total_rows = sum(model.query.filter(condition).count() for model, condition in targets)
+        deletion.status = 'running'
+        db.session.commit()
+
+        for model, condition in targets:
+            while True:
+                ids = [row_id for (row_id,) in db.session.query(model.id).filter(condition).limit(chunk_size)]
+                if not ids:
+                    break
+                if model is Idea:
+                    # في نفس transaction الحذف حتى لا تنحرف عدادات التصنيفات
+                    release_idea_categories(ids)
+                    schedule_snapshots(ids)
+                elif model is Comment:
+                    removed = db.session.query(Comment.idea_id, Comment.created_at).filter(Comment.id.in_(ids)).all()
+                    schedule_snapshots({idea_id for idea_id, _ in removed}, listings=False)
+                    # تعليقاته على أفكار الآخرين تُطرح من عداداتهم اليومية (صفوف أفكاره تُحذف لاحقاً)
+                    discount_deleted_comments(removed)
+                model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+                # الحذف الجماعي لا يمر بأحداث ORM
+                topic = INVALIDATION_TOPICS.get(model)
+                if topic:
+                    invalidation_bus.publish_many(topic, ids)
+                deletion.deleted_rows += len(ids)
+                db.session.commit()
+                job_heartbeat()
+
+        user = db.session.get(User, deletion.user_id)
+        if user:
+            # حذف الصورة الشخصية إن وجدت
+            if user.profile_picture:
+                old_file_path = os.path.join(app.config['UPLOAD_FOLDER'], user.profile_picture)
+                if os.path.exists(old_file_path):
+                    os.remove(old_file_path)
+            db.session.delete(user)
+        deletion.status = 'done'
+        deletion.finished_at = datetime.utcnow()
+        db.session.commit()
+    except JobLockLost:
+        # عامل آخر يكمل الحذف من حيث توقف
+        db.session.rollback()
+        raise
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'خطأ في حذف المستخدم {deletion.username}: {e}', exc_info=True)
+        deletion.status = 'failed'
+        deletion.error = str(e)
+        db.session.commit()
+        raise
+
+def backfill_visit_sources(site_host=None, batch_size=5000):
+    """تصنيف مصادر الزيارات القديمة على دفعات حسب id (كل دفعة في transaction قصيرة)"""
+    site_host = site_host or app.config.get('SERVER_NAME')
+    updated = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(Visit.id, Visit.referrer)\
+            .filter(Visit.id > last_id, Visit.traffic_source.is_(None))\
+            .order_by(Visit.id).limit(batch_size).all()
+        if not rows:
+            break
+        updates = []
+        for visit_id, referrer in rows:
+            referrer_host, traffic_source = classify_referrer(referrer, site_host)
+            updates.append({'id': visit_id, 'referrer_host': referrer_host, 'traffic_source': traffic_source})
+        db.session.execute(db.update(Visit), updates)
+        db.session.commit()
+        job_heartbeat()
+        updated += len(rows)
+        last_id = rows[-1][0]
+    return updated
+
+def traffic_source_counts(since=None):
+    """عدد الزيارات لكل مصدر (GROUP BY على فهرس traffic_source)"""
+    query = db.session.query(Visit.traffic_source, db.func.count(Visit.id))
+    if since:
+        query = query.filter(Visit.created_at >= since)
+    counts = dict.fromkeys(TRAFFIC_SOURCES, 0)
+    counts.update({source: count for source, count in query.group_by(Visit.traffic_source).all() if source})
+    return counts
+
+# المهام الخلفية (Jobs)
+# طابور في قاعدة البيانات بدون broker خارجي: flask worker يلتقط المهام المستحقة وينفذها
+JOB_HANDLERS = {}
+PERIODIC_JOBS = {}
+# الحد الأقصى للمهام المتزامنة لكل طابور (عبر جميع العمال)
+JOB_QUEUE_CONCURRENCY = {'default': 4, 'maintenance': 1}
+JOB_RETRY_BASE_SECONDS = 30
+# المهمة running تعتبر متروكة (توقف العامل) وتعاد للطابور إذا انقطع heartbeat الخاص بها
+# JOB_HEARTBEAT_TIMEOUT، أو إذا لم ترسل أي heartbeat خلال JOB_LOCK_TIMEOUT من حجزها
+# المعالجات الطويلة تستدعي job_heartbeat() بعد كل دفعة حتى لا تُعاد وهي ما زالت تعمل
+JOB_LOCK_TIMEOUT = timedelta(minutes=30)
+JOB_HEARTBEAT_INTERVAL = 30  # ثوانٍ بين كتابتين للـ heartbeat
+JOB_HEARTBEAT_TIMEOUT = timedelta(minutes=5)
+JOB_STALE_CHECK_INTERVAL = 60  # ثوانٍ بين فحصين للمهام المتروكة داخل حلقة العامل
+JOB_POLL_INTERVAL = 2
+
+def job_handler(name, queue='default', max_attempts=3, every=None):
+    """تسجيل دالة كمعالج لمهمة خلفية (every: تكرار دوري كـ timedelta)"""
+    def decorator(func):
+        JOB_HANDLERS[name] = {'func': func, 'queue': queue, 'max_attempts': max_attempts}
+        if every:
+            PERIODIC_JOBS[name] = every
+        return func
+    return decorator
+
+def enqueue_job(name, payload=None, queue=None, run_at=None, max_attempts=None):
+    """إضافة مهمة إلى الطابور (تُحفظ مع commit الجلسة الحالية)"""
+    handler = JOB_HANDLERS[name]
+    job = Job(
+        name=name,
+        payload=payload or {},
+        queue=queue or handler['queue'],
+        run_at=run_at or datetime.utcnow(),
+        max_attempts=max_attempts or handler['max_attempts']
+    )
+    db.session.add(job)
+    return job
+
+def ensure_periodic_jobs():
+    """التأكد من وجود نسخة مجدولة لكل مهمة دورية"""
+    for name in PERIODIC_JOBS:
+        exists = db.session.query(Job.id).filter(
+            Job.name == name, Job.status.in_(['queued', 'running'])
+        ).first()
+        if not exists:
+            enqueue_job(name)
+    db.session.commit()
+
+class JobLockLost(Exception):
+    """المهمة أعيدت للطابور أو حجزها عامل آخر أثناء تنفيذها"""
+
+def job_heartbeat():
+    """تسجيل أن المهمة الجارية ما زالت تعمل (تستدعيه المعالجات الطويلة بعد كل دفعة)
+
+    يُكتب في اتصال مستقل حتى لا يُلزم عمل الدفعة، مرة كل JOB_HEARTBEAT_INTERVAL على الأكثر.
+    خارج العامل (أوامر CLI) لا يفعل شيئاً. يرفع JobLockLost إذا لم تعد المهمة محجوزة لهذا العامل.
+    """
+    current = g.get('current_job')
+    if not current:
+        return
+    now = time.monotonic()
+    if now - current['beat'] < JOB_HEARTBEAT_INTERVAL:
+        return
+    with db.engine.begin() as conn:
+        updated = conn.execute(
+            db.update(Job)
+            .where(Job.id == current['id'], Job.status == 'running', Job.locked_by == current['worker_id'])
+            .values(heartbeat_at=datetime.utcnow())
+        ).rowcount
+    if not updated:
+        raise JobLockLost(f"المهمة #{current['id']} لم تعد محجوزة للعامل {current['worker_id']}")
+    current['beat'] = now
+
+def requeue_stale_jobs(worker_name=None):
+    """إعادة المهام المتروكة من عمال توقفوا إلى الطابور
+
+    worker_name: اسم العامل الذي يبدأ الآن (host:pid)؛ أي مهمة ما زالت محجوزة باسمه تركتها
+    عملية سابقة بنفس الاسم (مثل حاوية أعيد تشغيلها) فتُعاد فوراً دون انتظار المهلة.
+    """
+    now = datetime.utcnow()
+    stale = db.or_(
+        Job.heartbeat_at < now - JOB_HEARTBEAT_TIMEOUT,
+        db.and_(Job.heartbeat_at.is_(None), Job.locked_at < now - JOB_LOCK_TIMEOUT),
+    )
+    if worker_name:
+        stale = db.or_(stale, Job.locked_by.startswith(f'{worker_name}:', autoescape=True))
+    count = Job.query.filter(Job.status == 'running', stale)\
+        .update({'status': 'queued', 'locked_by': None, 'locked_at': None, 'heartbeat_at': None},
+                synchronize_session=False)
+    db.session.commit()
+    return count
+
+_next_stale_check = {'at': 0.0}
+_stale_check_lock = threading.Lock()
+
+def requeue_stale_jobs_if_due():
+    """فحص دوري للمهام المتروكة من حلقة العامل (خيط واحد كل JOB_STALE_CHECK_INTERVAL)
+
+    بدونه لا يتحرر مكان طابور maintenance (حد تزامن 1) إذا توقف عامل أثناء مهمة
+    إلا عند إعادة تشغيل عامل آخر.
+    """
+    now = time.monotonic()
+    with _stale_check_lock:
+        if now < _next_stale_check['at']:
+            return 0
+        _next_stale_check['at'] = now + JOB_STALE_CHECK_INTERVAL
+    return requeue_stale_jobs()
+
+def claim_job(queues, worker_id):
+    """حجز مهمة مستحقة واحدة مع احترام حد التزامن لكل طابور
+
+    على PostgreSQL يُستخدم FOR UPDATE SKIP LOCKED حتى لا يتنافس العمال على نفس الصف.
+    حد JOB_QUEUE_CONCURRENCY يُفرض داخل UPDATE الحجز نفسه (عدّ running كشرط)، وعلى PostgreSQL
+    بعد قفل advisory للطابور حتى لا يرى عاملان نفس العدد ويحجزا معاً. على SQLite الكتابة متسلسلة
+    أصلاً، فيكفي الشرط داخل UPDATE واحد.
+    """
+    now = datetime.utcnow()
+    # فلتر أولي بدون قفل لتخطي الطوابير الممتلئة؛ الفحص الملزم في UPDATE أدناه
+    running = dict(db.session.query(Job.queue, db.func.count(Job.id))
+                   .filter(Job.status == 'running', Job.queue.in_(queues))
+                   .group_by(Job.queue).all())
+    available = [q for q in queues if running.get(q, 0) < JOB_QUEUE_CONCURRENCY.get(q, 1)]
+    if not available:
+        return None
+
+    candidate = db.session.execute(
+        db.select(Job.id, Job.queue)
+        .where(Job.status == 'queued', Job.queue.in_(available), Job.run_at <= now)
+        .order_by(Job.run_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).first()
+    if candidate is None:
+        db.session.rollback()
+        return None
+    job_id, queue = candidate
+
+    if db.engine.dialect.name == 'postgresql':
+        # يُحرَّر تلقائياً مع commit؛ العامل الآخر ينتظره ثم يرى حجز هذا العامل في العدّ
+        db.session.execute(db.select(db.func.pg_advisory_xact_lock(db.func.hashtext(f'job_queue:{queue}'))))
+    running_in_queue = db.select(db.func.count(Job.id))\
+        .where(Job.status == 'running', Job.queue == queue).scalar_subquery()
+    claimed = Job.query.filter(
+        Job.id == job_id,
+        Job.status == 'queued',
+        running_in_queue < JOB_QUEUE_CONCURRENCY.get(queue, 1)
+    ).update({
+        'status': 'running',
+        'locked_by': worker_id,
+        'locked_at': now,
+        'heartbeat_at': now,
+        'started_at': now,
+        'attempts': Job.attempts + 1,
+    }, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return None
+    return db.session.get(Job, job_id)
+
+def execute_job(job):
+    """تنفيذ مهمة محجوزة مع إعادة المحاولة بتأخير متزايد عند الفشل"""
+    handler = JOB_HANDLERS.get(job.name)
+    g.current_job = {'id': job.id, 'worker_id': job.locked_by, 'beat': time.monotonic()}
+    try:
+        if handler is None:
+            raise RuntimeError(f'لا يوجد معالج للمهمة {job.name}')
+        handler['func'](**(job.payload or {}))
+        job.status = 'done'
+        job.last_error = None
+    except JobLockLost as e:
+        # عامل آخر يملك المهمة الآن: لا نعدّل صفها
+        db.session.rollback()
+        app.logger.warning(f'توقف تنفيذ المهمة {job.name}#{job.id}: {e}')
+        return
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'فشلت المهمة {job.name}#{job.id}: {e}', exc_info=True)
+        job.last_error = traceback.format_exc()[-2000:]
+        if job.attempts < job.max_attempts:
+            backoff = JOB_RETRY_BASE_SECONDS * (2 ** (job.attempts - 1))
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(seconds=backoff * random.uniform(0.8, 1.2))
+        else:
+            job.status = 'failed'
+    finally:
+        g.pop('current_job', None)
+    job.locked_by = None
+    job.locked_at = None
+    job.heartbeat_at = None
+    if job.status != 'queued':
+        job.finished_at = datetime.utcnow()
+        # جدولة التكرار التالي للمهام الدورية
+        if job.name in PERIODIC_JOBS:
+            enqueue_job(job.name, job.payload, run_at=datetime.utcnow() + PERIODIC_JOBS[job.name])
+    db.session.commit()
+
+def run_worker_loop(queues, worker_id, stop_event, once=False):
+    """حلقة عامل واحد: حجز ثم تنفيذ حتى طلب الإيقاف"""
+    with app.app_context():
+        while not stop_event.is_set():
+            try:
+                requeued = requeue_stale_jobs_if_due()
+                if requeued:
+                    app.logger.warning(f'أعيدت {requeued} مهمة متروكة إلى الطابور')
+                job = claim_job(queues, worker_id)
+                if job:
+                    execute_job(job)
+                    continue
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f'خطأ في العامل {worker_id}: {e}', exc_info=True)
+            finally:
+                db.session.remove()
+            if once:
+                break
+            stop_event.wait(JOB_POLL_INTERVAL)
+
+@job_handler('delete_user', queue='maintenance', max_attempts=5)
+def delete_user_job(deletion_id):
+    run_user_deletion(deletion_id)
+
+@job_handler('compress_image')
+def compress_image_job(path, max_size=(800, 800), quality=85):
+    compress_image(path, max_size=tuple(max_size), quality=quality)
+
+@job_handler('backfill_visit_sources', queue='maintenance')
+def backfill_visit_sources_job(site_host=None):
+    backfill_visit_sources(site_host)
+
+@job_handler('backfill_idea_minhash', queue='maintenance')
+def backfill_idea_minhash_job():
+    backfill_idea_minhash()
+
+@job_handler('backfill_idea_daily_stats', queue='maintenance')
+def backfill_idea_daily_stats_job():
+    backfill_idea_daily_stats()
+
+@job_handler('cluster_duplicate_ideas', queue='maintenance', every=timedelta(days=1))
+def cluster_duplicate_ideas_job():
+    """إعادة تجميع الأفكار المتشابهة لصفحة الأدمن"""
+    cluster_duplicate_ideas()
+
+@job_handler('cleanup_jobs', queue='maintenance', every=timedelta(hours=1))
+def cleanup_jobs_job(keep_days=7):
+    """حذف سجلات المهام المنتهية القديمة"""
+    cutoff = datetime.utcnow() - timedelta(days=keep_days)
+    Job.query.filter(Job.status == 'done', Job.finished_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+@job_handler('prune_daily_visitors', queue='maintenance', every=timedelta(days=1))
+def prune_daily_visitors_job():
+    """حذف زوار الأيام السابقة (يكفي اليوم الحالي، وأمس لطلبات حول منتصف الليل)"""
+    cutoff = datetime.utcnow().date() - timedelta(days=1)
+    IdeaDailyVisitor.query.filter(IdeaDailyVisitor.day < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+@job_handler('recount_categories', queue='maintenance', every=timedelta(days=1))
+def recount_categories_job():
+    """تصحيح دوري لعدادات التصنيفات"""
+    recount_categories()
+
+# لقطات ثابتة للصفحات العامة
+# كل صفحة تُعرض كزائر غير مسجل (بدون before_request: لا تُسجل زيارة ولا تزيد المشاهدات)
+# وتُكتب ذرياً في SNAPSHOT_DIR؛ nginx يقدمها مباشرة لمن لا يملك cookie جلسة
+# صفحة الفكرة تُعاد عند تعديلها أو تعديل تعليقاتها، والقوائم تُعاد معها ودورياً (عدد المشاهدات)
+SNAPSHOT_LISTING_PATHS = ['/', '/latest', '/most-viewed', '/most-commented', '/trending', '/sitemap.xml', '/robots.txt']
+SNAPSHOT_REFRESH = timedelta(minutes=int(os.environ.get('SNAPSHOT_REFRESH_MINUTES', 10)))
+
+def snapshot_file(path):
+    """مسار ملف اللقطة: / -> index.html، ‏/latest -> latest.html، ‏/sitemap.xml كما هو"""
+    name = path.strip('/') or 'index'
+    if not os.path.splitext(name)[1]:
+        name += '.html'
+    return os.path.join(app.config['SNAPSHOT_DIR'], name)
+
+def idea_snapshot_paths(idea):
+    return [f'/idea/{idea.id}', f'/idea/{idea.id}/{idea.get_slug()}']
+
+def render_snapshot(path):
+    """عرض صفحة عامة كزائر غير مسجل وإرجاع محتواها (None إذا لم تكن 200)"""
+    base_url = f"{app.config['PREFERRED_URL_SCHEME']}://{app.config.get('SERVER_NAME') or 'localhost'}"
+    # app context مستقل: g وجلسة قاعدة البيانات منفصلان عن المهمة التي تستدعيه
+    with app.app_context(), app.test_request_context(path, base_url=base_url):
+        if request.routing_exception is not None:
+            return None
+        g.is_bot = True  # لا تزيد المشاهدات
+        # عرض كامل وليس متدفقاً: فشل أي قسم يرفع استثناء فلا تُحفظ صفحة فيها رسالة خطأ
+        g.render_buffered = True
+        try:
+            response = app.make_response(app.view_functions[request.endpoint](**request.view_args))
+        except HTTPException:
+            return None
+        return response.get_data() if response.status_code == 200 else None
+
+def write_snapshot(path):
+    """إعادة كتابة لقطة صفحة واحدة ذرياً، أو حذفها إذا لم تعد الصفحة موجودة"""
+    target = snapshot_file(path)
+    content = render_snapshot(path)
+    if content is None:
+        if os.path.exists(target):
+            os.remove(target)
+        # فكرة محذوفة: حذف لقطات جميع روابطها (slug قديم أو جديد)
+        idea_dir = os.path.splitext(target)[0]
+        if path.startswith('/idea/') and os.path.isdir(idea_dir):
+            shutil.rmtree(idea_dir, ignore_errors=True)
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f'{target}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, target)
+    return True
+
+def schedule_snapshots(idea_ids=(), paths=(), listings=True):
+    """جدولة إعادة لقطات الأفكار المتأثرة (تُحفظ مع commit التغيير نفسه)"""
+    if not app.config['SNAPSHOT_ENABLED']:
+        return
+    paths = list(paths) + (SNAPSHOT_LISTING_PATHS if listings else [])
+    enqueue_job('regenerate_snapshots', {'idea_ids': sorted(set(idea_ids)), 'paths': paths})
+
+def regenerate_snapshots(idea_ids=(), paths=()):
+    """إعادة لقطات الأفكار المحددة والمسارات الإضافية (الأفكار المحذوفة تُحذف لقطاتها)"""
+    ideas = Idea.query.filter(Idea.id.in_(idea_ids)).all() if idea_ids else []
+    found = {idea.id for idea in ideas}
+    paths = [path for idea in ideas for path in idea_snapshot_paths(idea)] \
+        + [f'/idea/{idea_id}' for idea_id in idea_ids if idea_id not in found] + list(paths)
+    return sum(write_snapshot(path) for path in dict.fromkeys(paths))
+
+def build_all_snapshots(batch_size=500):
+    """بناء لقطات جميع الصفحات العامة (القوائم وكل الأفكار)"""
+    written = sum(write_snapshot(path) for path in SNAPSHOT_LISTING_PATHS)
+    last_id = 0
+    while True:
+        ideas = Idea.query.filter(Idea.id > last_id).order_by(Idea.id).limit(batch_size).all()
+        if not ideas:
+            return written
+        last_id = ideas[-1].id
+        written += sum(write_snapshot(path) for idea in ideas for path in idea_snapshot_paths(idea))
+        db.session.expunge_all()
+
+@job_handler('regenerate_snapshots')
+def regenerate_snapshots_job(idea_ids=(), paths=()):
+    regenerate_snapshots(idea_ids, paths)
+
+@job_handler('refresh_snapshot_listings', queue='maintenance', every=SNAPSHOT_REFRESH)
+def refresh_snapshot_listings_job():
+    """تحديث دوري للقوائم (ترتيب المشاهدات والرواج يتغير دون تعديل الأفكار)"""
+    if app.config['SNAPSHOT_ENABLED']:
+        regenerate_snapshots(paths=SNAPSHOT_LISTING_PATHS)
+
+# تصدير البيانات بشكل متدفق (CSV/JSONL) مع ضغط gzip أثناء الإرسال
+# الذاكرة ثابتة مهما كان عدد الصفوف: الصفوف تُقرأ بـ yield_per (server-side cursor في PostgreSQL)
+EXPORT_BATCH_SIZE = 2000
+EXPORT_MODELS = {
+    'visits': (Visit, ['id', 'ip_address', 'user_agent', 'browser', 'device_type', 'page_path', 'referrer', 'user_id', 'created_at']),
+    'ideas': (Idea, ['id', 'title', 'slug', 'description', 'category', 'category_id', 'views', 'user_id', 'created_at']),
+    'comments': (Comment, ['id', 'content', 'is_published', 'user_id', 'idea_id', 'created_at', 'updated_at']),
+    'users': (User, ['id', 'username', 'email', 'full_name', 'location', 'website', 'is_admin', 'created_at']),
+}
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+def parse_export_fields(kind, fields):
+    """التحقق من الحقول المطلوبة (كلمات المرور وغيرها غير قابلة للتصدير)"""
+    allowed = EXPORT_MODELS[kind][1]
+    if not fields:
+        return allowed
+    requested = [field.strip() for field in fields.split(',') if field.strip()]
+    invalid = [field for field in requested if field not in allowed]
+    if invalid:
+        raise ValueError(f'حقول غير مسموحة: {", ".join(invalid)}')
+    return requested
+
+def iter_export_rows(kind, fields, start=None, end=None):
+    """قراءة الصفوف كـ tuples بدون تحميل كائنات ORM"""
+    model = EXPORT_MODELS[kind][0]
+    query = db.select(*[getattr(model, field) for field in fields]).order_by(model.id)
+    if start:
+        query = query.where(model.created_at >= start)
+    if end:
+        query = query.where(model.created_at < end)
+    result = db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for partition in result.partitions():
+        yield from partition
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def iter_export(kind, fields, fmt='csv', start=None, end=None):
+    """توليد محتوى التصدير كقطع نصية (قطعة لكل دفعة)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(fields)
+    rows_in_buffer = 0
+    for row in iter_export_rows(kind, fields, start, end):
+        if writer:
+            writer.writerow([_export_value(value) for value in row])
+        else:
+            record = {field: _export_value(value) for field, value in zip(fields, row)}
+            buffer.write(json.dumps(record, ensure_ascii=False) + '\n')
+        rows_in_buffer += 1
+        if rows_in_buffer >= EXPORT_BATCH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            rows_in_buffer = 0
+    yield buffer.getvalue()
+
+def gzip_chunks(chunks):
+    """ضغط القطع بصيغة gzip أثناء توليدها"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = ترويسة gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def parse_export_date(value):
+    """تحويل تاريخ بصيغة YYYY-MM-DD (أو ISO كامل)"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
-
-# تسجيل معالج OAuth فقط إذا كان blueprint موجود
-if google_bp:
-    @oauth_authorized.connect_via(google_bp)
-    def google_logged_in(blueprint, token):
-        if not token:
-            flash('فشل تسجيل الدخول باستخدام Google', 'danger')
+    user = User.query.get(int(user_id))
+    # الجلسات القائمة لحساب معطل تنتهي فوراً
+    return user if user and user.is_active else None
+
+# Google OAuth: Flask-Dance يُستورد ويُسجل في init_google_oauth فقط عند توفر بيانات الاعتماد
+google_oauth_enabled = False
+google_bp = None
+
+def google_logged_in(blueprint, token):
+    """ربط حساب Google بمستخدم محلي (أو إنشاؤه) بعد نجاح التفويض"""
+    from flask_dance.contrib.google import google
+    if not token:
+        flash('فشل تسجيل الدخول باستخدام Google', 'danger')
+        return redirect(url_for('login'))
+
+    try:
+        resp = google.get('/oauth2/v2/userinfo')
+        
+        if not resp.ok:
+            flash('فشل في الحصول على معلومات المستخدم من Google', 'danger')
             return redirect(url_for('login'))
 
-        try:
-            resp = google.get('/oauth2/v2/userinfo')
-            
-            if not resp.ok:
-                flash('فشل في الحصول على معلومات المستخدم من Google', 'danger')
-                return redirect(url_for('login'))
-
-            google_info = resp.json()
-            google_id = google_info['id']
-            email = google_info['email']
-            username = email.split('@')[0]
-
-            # Check if user exists
-            user = User.query.filter_by(google_id=google_id).first()
-            if not user:
-                # Check if email exists
-                user = User.query.filter_by(email=email).first()
-                if user:
-                    # Update existing user with Google ID
-                    user.google_id = google_id
-                else:
-                    # Create new user
-                    user = User(
-                        username=username,
-                        email=email,
-                        google_id=google_id
-                    )
-                    db.session.add(user)
-                    db.session.commit()
+        google_info = resp.json()
+        google_id = google_info['id']
+        email = google_info['email']
+        username = email.split('@')[0]
 
-            login_user(user)
-            flash('تم تسجيل الدخول بنجاح باستخدام Google!', 'success')
-            # إرجاع redirect بدلاً من False لتجنب redirect loop
-            return redirect(url_for('home'))
-        except Exception as e:
-            app.logger.error(f'خطأ في تسجيل الدخول باستخدام Google: {e}', exc_info=True)
-            flash('حدث خطأ أثناء تسجيل الدخول باستخدام Google', 'danger')
+        # Check if user exists
+        user = User.query.filter_by(google_id=google_id).first()
+        if not user:
+            # Check if email exists
+            user = User.query.filter_by(email=email).first()
+            if user:
+                # Update existing user with Google ID
+                user.google_id = google_id
+            else:
+                # Create new user
+                user = User(
+                    username=username,
+                    email=email,
+                    google_id=google_id
+                )
+                db.session.add(user)
+                db.session.commit()
+
+        if not user.is_active:
+            flash('هذا الحساب قيد الحذف ولا يمكن تسجيل الدخول به', 'danger')
             return redirect(url_for('login'))
+        login_user(user)
+        flash('تم تسجيل الدخول بنجاح باستخدام Google!', 'success')
+        # إرجاع redirect بدلاً من False لتجنب redirect loop
+        return redirect(url_for('home'))
+    except Exception as e:
+        app.logger.error(f'خطأ في تسجيل الدخول باستخدام Google: {e}', exc_info=True)
+        flash('حدث خطأ أثناء تسجيل الدخول باستخدام Google', 'danger')
+        return redirect(url_for('login'))
+
+def init_google_oauth(app):
+    """إنشاء وتسجيل blueprint لـ Google OAuth إذا كانت بيانات الاعتماد موجودة"""
+    global google_oauth_enabled, google_bp
+    client_id = app.config.get('GOOGLE_OAUTH_CLIENT_ID')
+    client_secret = app.config.get('GOOGLE_OAUTH_CLIENT_SECRET')
+    google_oauth_enabled = bool(client_id and client_secret)
+    if not google_oauth_enabled:
+        app.logger.warning('⚠️ تحذير: GOOGLE_OAUTH_CLIENT_ID أو GOOGLE_OAUTH_CLIENT_SECRET غير موجودة في البيئة! تسجيل الدخول عبر Google معطل')
+        return None
+
+    from flask_dance.consumer import oauth_authorized
+    from flask_dance.consumer.storage.sqla import SQLAlchemyStorage
+    from flask_dance.contrib.google import make_google_blueprint
+
+    # بناء معاملات blueprint بشكل صريح
+    blueprint_kwargs = {
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'scope': [
+            'https://www.googleapis.com/auth/userinfo.email',
+            'https://www.googleapis.com/auth/userinfo.profile',
+            'openid'
+        ],
+        'storage': SQLAlchemyStorage(OAuth, db.session, user=current_user),
+        'offline': False
+    }
+    # بناء redirect_url بشكل ديناميكي بناءً على البيئة
+    if app.config.get('SERVER_NAME'):
+        scheme = app.config.get('PREFERRED_URL_SCHEME', 'http')
+        blueprint_kwargs['redirect_url'] = f"{scheme}://{app.config['SERVER_NAME']}/login/google/authorized"
+
+    try:
+        google_bp = make_google_blueprint(**blueprint_kwargs)
+        app.register_blueprint(google_bp, url_prefix='/login')
+    except Exception as e:
+        app.logger.error(f'خطأ في إنشاء Google OAuth blueprint: {e}', exc_info=True)
+        google_bp = None
+        return None
+    oauth_authorized.connect_via(google_bp)(google_logged_in)
+    return google_bp
 
 # ملاحظة: تم إزالة @app.errorhandler(Exception) لأنه كان يسبب حلقة إعادة توجيه
 # الأخطاء يتم معالجتها في الـ routes نفسها
 
+# ضغط الاستجابات النصية (brotli أو gzip حسب Accept-Encoding)
+# - الاستجابات الأصغر من COMPRESSION_MIN_SIZE تُرسل كما هي
+# - الاستجابات المتدفقة تُضغط قطعة بقطعة مع flush بعد كل قطعة حتى لا يتأخر وصولها
+# - الاستجابات القابلة للكاش (بدون no-store/private) يُحفظ ناتج ضغطها في ذاكرة العامل حسب hash المحتوى
+# - لا تُضغط text/event-stream ولا الملفات (direct_passthrough) ولا ما له Content-Encoding مسبقاً
+# brotli اختيارية (pip install Brotli)؛ بدونها يُستخدم gzip فقط
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/xml', 'text/javascript',
+    'application/xml', 'application/json', 'application/javascript', 'application/x-ndjson', 'image/svg+xml',
+}
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 5))
+# الاستجابات المتدفقة تُضغط بجودة أقل لأن كل قطعة تُضغط فور توليدها
+COMPRESSION_STREAM_BROTLI_QUALITY = 4
+COMPRESSION_CACHE_BYTES = int(os.environ.get('COMPRESSION_CACHE_MB', 16)) * 1024 * 1024
+
+compression_stats = {'compressed': 0, 'streamed': 0, 'cache_hits': 0, 'skipped_small': 0, 'bytes_in': 0, 'bytes_out': 0}
+_compression_stats_lock = threading.Lock()
+
+def _count_compression(**amounts):
+    with _compression_stats_lock:
+        for key, amount in amounts.items():
+            compression_stats[key] += amount
+
+class CompressedBodyCache:
+    """LRU محدود بالحجم للأجسام المضغوطة: المفتاح (الترميز، hash المحتوى الأصلي)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = {}  # ترتيب الإدخال في dict يُستخدم كترتيب LRU
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.pop(key, None)
+            if body is not None:
+                self.entries[key] = body
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes // 8:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.pop(next(iter(self.entries))))
+
+compressed_bodies = CompressedBodyCache(COMPRESSION_CACHE_BYTES)
+
+def negotiate_encoding(accept_encodings):
+    """اختيار br ثم gzip حسب جودة كل منهما في Accept-Encoding (q=0 يعني مرفوض)"""
+    candidates = (['br'] if brotli is not None else []) + ['gzip']
+    best = max(candidates, key=lambda encoding: accept_encodings[encoding])
+    return best if accept_encodings[best] > 0 else None
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip_bytes(body, COMPRESSION_GZIP_LEVEL)
+
+def gzip_bytes(body, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31 = ترويسة gzip
+    return compressor.compress(body) + compressor.flush()
+
+def compress_stream(chunks, encoding):
+    """ضغط استجابة متدفقة مع flush بعد كل قطعة (المتصفح يعرض ما وصل فوراً)"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESSION_STREAM_BROTLI_QUALITY)
+        compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield compress(chunk) + flush()
+        yield finish()
+    finally:
+        # إغلاق المولد الأصلي (stream_with_context) حتى عند انقطاع الاتصال
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def _weaken_etag(response):
+    """الـ ETag القوي يصف البايتات الأصلية؛ بعد الضغط يصبح ضعيفاً (كما يفعل nginx)"""
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+# يُسجَّل قبل بقية after_request حتى يُنفَّذ بعدها جميعاً (Flask ينفذها بترتيب عكسي)
+@app.after_request
+def compress_response(response):
+    """ضغط استجابات HTML/XML/JSON الكبيرة حسب ما يقبله المتصفح"""
+    if not app.config['COMPRESSION_ENABLED']:
+        return response
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or request.method == 'HEAD'):
+        return response
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = encoding
+        _weaken_etag(response)
+        _count_compression(streamed=1)
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESSION_MIN_SIZE:
+        _count_compression(skipped_small=1)
+        return response
+    cacheable = not (response.cache_control.no_store or response.cache_control.private)
+    compressed = None
+    if cacheable:
+        key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+        compressed = compressed_bodies.get(key)
+    cache_hit = compressed is not None
+    if not cache_hit:
+        compressed = compress_body(body, encoding)
+        if cacheable:
+            compressed_bodies.put(key, compressed)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    _weaken_etag(response)
+    _count_compression(compressed=1, cache_hits=int(cache_hit), bytes_in=len(body), bytes_out=len(compressed))
+    return response
+
 # إضافة cache headers للـ static files
 @app.after_request
 def add_cache_headers(response):
@@ -381,6 +2006,376 @@ def add_cache_headers(response):
         response.cache_control.must_revalidate = True
     return response
 
+# قياس زمن عرض كل قالب
+# الإحصائيات محفوظة في ذاكرة العامل: {اسم القالب: {'count', 'total_ms', 'max_ms'}}
+template_render_stats = {}
+SLOW_TEMPLATE_MS = float(os.environ.get('SLOW_TEMPLATE_MS', 200))
+
+@before_render_template.connect_via(app)
+def _start_template_timer(sender, template, context, **extra):
+    g.setdefault('template_timers', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _stop_template_timer(sender, template, context, **extra):
+    timers = g.get('template_timers')
+    if not timers:
+        return
+    elapsed_ms = (time.perf_counter() - timers.pop()) * 1000
+    name = template.name or 'string'
+    stats = template_render_stats.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+    stats['count'] += 1
+    stats['total_ms'] += elapsed_ms
+    stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+    g.setdefault('template_timings', []).append((name, elapsed_ms))
+    if elapsed_ms > SLOW_TEMPLATE_MS:
+        app.logger.warning(f'عرض بطيء للقالب {name}: {elapsed_ms:.1f}ms')
+
+@app.after_request
+def add_server_timing_header(response):
+    """إضافة زمن عرض القوالب إلى ترويسة Server-Timing (تظهر في أدوات المطور)"""
+    timings = g.get('template_timings')
+    if timings:
+        metrics = [
+            f'tpl-{re.sub(r"[^A-Za-z0-9_-]", "_", name)};dur={elapsed_ms:.2f}'
+            for name, elapsed_ms in timings
+        ]
+        response.headers.add('Server-Timing', ', '.join(metrics))
+    return response
+
+# عرض متدفق للصفحات الثقيلة (لوحة التحكم وصفحة الفكرة)
+# - القالب يُرسل على دفعات: كل ما قبل {{ stream_flush() }} يُرسل فوراً، فيصل head وروابط CSS
+#   وهيكل الصفحة للمتصفح قبل حساب الأقسام الثقيلة
+# - الأقسام تُحسب عند أول وصول إليها من القالب عبر PageSections
+# - الجلسة تُحفظ قبل إرسال الجسم، لذلك رسائل flash تُقرأ قبل بدء البث
+# - زمن أول بايت (TTFB) والزمن الكلي لكل صفحة في page_timing_stats، للمقارنة بين الوضعين
+STREAM_FLUSH_MARKER = '<!-- flush -->'
+STREAM_ERROR_HTML = '<div class="alert alert-danger">حدث خطأ في تحميل بقية الصفحة. يرجى إعادة المحاولة.</div>'
+page_timing_stats = {}
+
+class PageSections:
+    """أقسام صفحة تُحسب عند أول وصول إليها من القالب (sections.totals.total_users)"""
+
+    def __init__(self, **loaders):
+        self._loaders = loaders
+        self._values = {}
+
+    def __getattr__(self, name):
+        loaders = self.__dict__.get('_loaders', {})
+        if name not in loaders:
+            raise AttributeError(name)
+        if name not in self._values:
+            self._values[name] = loaders[name]()
+        return self._values[name]
+
+@app.before_request
+def _mark_request_start():
+    g.request_started = time.perf_counter()
+
+@app.template_global()
+def stream_flush():
+    """نقطة إرسال في القالب (لا تضيف شيئاً عند العرض العادي)"""
+    return Markup(STREAM_FLUSH_MARKER) if g.get('stream_rendering') else ''
+
+def _record_page_timing(endpoint, mode, ttfb_ms, total_ms):
+    stats = page_timing_stats.setdefault(f'{endpoint}:{mode}', {'count': 0, 'ttfb_ms': 0.0, 'total_ms': 0.0})
+    stats['count'] += 1
+    stats['ttfb_ms'] += ttfb_ms
+    stats['total_ms'] += total_ms
+
+def stream_page(template_name, **context):
+    """عرض قالب كاستجابة متدفقة تُرسل عند كل stream_flush()، أو كاملاً إذا كان STREAM_RENDERING معطلاً
+    أو طلب السياق ذلك (g.render_buffered، مثل اللقطات الثابتة)"""
+    endpoint = request.endpoint
+    started = g.get('request_started') or time.perf_counter()
+    if not app.config['STREAM_RENDERING'] or g.get('render_buffered'):
+        html = render_template(template_name, **context)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        _record_page_timing(endpoint, 'buffered', elapsed_ms, elapsed_ms)
+        return html
+
+    get_flashed_messages(with_categories=True)
+    template = app.jinja_env.get_or_select_template(template_name)
+    app.update_template_context(context)
+    before_render_template.send(app, _async_wrapper=app.ensure_sync, template=template, context=context)
+
+    def generate():
+        g.stream_rendering = True
+        ttfb_ms = None
+        buffer = []
+        try:
+            for chunk in template.generate(context):
+                if chunk != STREAM_FLUSH_MARKER:
+                    buffer.append(chunk)
+                    continue
+                if buffer:
+                    if ttfb_ms is None:
+                        ttfb_ms = (time.perf_counter() - started) * 1000
+                    yield ''.join(buffer)
+                    buffer = []
+        except Exception as e:
+            # الترويسات أُرسلت بـ 200: لا يمكن التحويل لصفحة خطأ، فتُنهى الصفحة برسالة ونهاية التخطيط.
+            # ما بعد آخر stream_flush() يُهمل لأنه قد ينتهي وسط وسم من القسم الذي فشل
+            app.logger.error(f'خطأ أثناء العرض المتدفق للقالب {template_name}: {e}', exc_info=True)
+            buffer = [STREAM_ERROR_HTML, app.jinja_env.get_template('_layout_tail.html').render(context)]
+        yield ''.join(buffer)
+        g.stream_rendering = False
+        template_rendered.send(app, _async_wrapper=app.ensure_sync, template=template, context=context)
+        total_ms = (time.perf_counter() - started) * 1000
+        _record_page_timing(endpoint, 'streamed', total_ms if ttfb_ms is None else ttfb_ms, total_ms)
+
+    # nginx يمرر الدفعات فور وصولها بدلاً من تجميع الاستجابة كاملة
+    return Response(stream_with_context(generate()), mimetype='text/html', headers={'X-Accel-Buffering': 'no'})
+
+# فلترة الطلبات قبل أي عمل على قاعدة البيانات
+# - تصنيف البوتات: لا تُسجَّل زياراتها ولا تزيد المشاهدات
+# - تحديد المعدل بـ token bucket لكل IP ونوع مسار؛ الطلب المرفوض يعاد بـ 429 قبل log_visit
+# المفاتيح: (معدل التعبئة بالثانية، السعة القصوى)
+RATE_LIMITS = {
+    'page': (float(os.environ.get('RATE_LIMIT_PAGE_RATE', 2)), int(os.environ.get('RATE_LIMIT_PAGE_BURST', 30))),
+    'api': (float(os.environ.get('RATE_LIMIT_API_RATE', 5)), int(os.environ.get('RATE_LIMIT_API_BURST', 60))),
+    'auth': (0.1, 10),  # تسجيل الدخول/التسجيل: 10 محاولات ثم محاولة كل 10 ثوانٍ
+    'write': (0.5, 20),
+}
+# البوتات تحصل على معدل أقل من المستخدمين
+BOT_RATE_FACTOR = 0.25
+
+ingress_counters = {'allowed': 0, 'bots': 0, 'rate_limited': 0}
+_ingress_counters_lock = threading.Lock()
+
+def _count_ingress(key):
+    with _ingress_counters_lock:
+        ingress_counters[key] += 1
+
+class MemoryRateLimiter:
+    """token bucket في ذاكرة العامل (كل عامل gunicorn له حدوده الخاصة)"""
+    max_keys = 100000
+
+    def __init__(self):
+        self.buckets = {}  # ترتيب الإدخال في dict يُستخدم كترتيب LRU
+        self.lock = threading.Lock()
+
+    def allow(self, key, rate, burst):
+        """استهلاك token واحد؛ يعيد (مسموح، ثوانٍ حتى التوفر)"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            # طرد الأقدم استخداماً بكلفة O(1) بدلاً من مسح كل المفاتيح
+            if len(self.buckets) > self.max_keys:
+                del self.buckets[next(iter(self.buckets))]
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+class RedisRateLimiter:
+    """token bucket مشترك بين العمال والخوادم عبر Redis (اختياري: RATE_LIMIT_REDIS_URL)"""
+    script = """
+        local tokens = tonumber(redis.call('HGET', KEYS[1], 't') or ARGV[2])
+        local updated = tonumber(redis.call('HGET', KEYS[1], 'u') or ARGV[3])
+        tokens = math.min(tonumber(ARGV[2]), tokens + (tonumber(ARGV[3]) - updated) * tonumber(ARGV[1]))
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 't', tokens, 'u', ARGV[3])
+        redis.call('EXPIRE', KEYS[1], 600)
+        return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.bucket = self.client.register_script(self.script)
+
+    def allow(self, key, rate, burst):
+        allowed, tokens = self.bucket(keys=[f'ratelimit:{key}'], args=[rate, burst, time.time()])
+        return bool(allowed), 0 if allowed else (1 - float(tokens)) / rate
+
+def make_rate_limiter():
+    redis_url = os.environ.get('RATE_LIMIT_REDIS_URL')
+    if redis_url:
+        try:
+            return RedisRateLimiter(redis_url)
+        except ImportError:
+            app.logger.warning('⚠️ RATE_LIMIT_REDIS_URL محدد لكن مكتبة redis غير مثبتة، سيتم استخدام الذاكرة المحلية')
+    return MemoryRateLimiter()
+
+rate_limiter = make_rate_limiter()
+
+def route_class():
+    """تصنيف المسار الحالي لاختيار حد المعدل المناسب"""
+    if request.path in ('/login', '/register') and request.method == 'POST':
+        return 'auth'
+    if request.path.startswith('/api/'):
+        return 'api'
+    if request.method not in ('GET', 'HEAD'):
+        return 'write'
+    return 'page'
+
+@app.before_request
+def ingress_filter():
+    """تصنيف البوتات وتطبيق حدود المعدل قبل تسجيل الزيارة أو أي استعلام"""
+    if request.path.startswith('/static') or request.endpoint == 'uploaded_file':
+        return
+
+    g.is_bot = is_bot_user_agent(request.headers.get('User-Agent', ''))
+    if g.is_bot:
+        _count_ingress('bots')
+
+    if app.config['RATE_LIMIT_ENABLED']:
+        kind = route_class()
+        rate, burst = RATE_LIMITS[kind]
+        if g.is_bot:
+            rate, burst = rate * BOT_RATE_FACTOR, max(1, int(burst * BOT_RATE_FACTOR))
+        try:
+            allowed, retry_after = rate_limiter.allow(f'{get_client_ip()}:{kind}', rate, burst)
+        except Exception as e:
+            # تعطل الـ backend المشترك لا يجب أن يوقف الموقع
+            app.logger.error(f'خطأ في محدد المعدل: {e}')
+            allowed, retry_after = True, 0
+        if not allowed:
+            _count_ingress('rate_limited')
+            response = Response('طلبات كثيرة جداً، يرجى المحاولة لاحقاً', status=429, mimetype='text/plain')
+            response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+            return response
+
+    _count_ingress('allowed')
+
+# نقاط تُحمَّل من داخل صفحات أخرى ولا تُسجَّل كزيارات
+NON_PAGE_ENDPOINTS = {'idea_comments', 'moderation_bulk'}
+
+# عدادات الزيارات الحية للوحة التحكم (SSE)
+# كل عامل يجمع زياراته في دلاء دقيقة في الذاكرة ويكتب لقطة منها كل بضع ثوان في LIVE_STATE_DIR،
+# وبث /dashboard/live يدمج لقطات العمال دون أي استعلام على جدول visit
+LIVE_WINDOW_MINUTES = 15
+LIVE_ACTIVE_MINUTES = 5
+LIVE_MAX_PAGES_PER_MINUTE = 200
+LIVE_PUBLISH_SECONDS = 2
+LIVE_STREAM_INTERVAL = 2
+# البث يُغلق دورياً ويعيد المتصفح الاتصال تلقائياً، حتى لا يحجز عاملاً أكثر من timeout
+LIVE_STREAM_MAX_SECONDS = 55
+
+class LiveTrafficAggregator:
+    """دلاء دقيقة للزيارات في ذاكرة العامل: العدد والصفحات والأجهزة والمتصفحات"""
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self._lock = threading.Lock()
+        self._minutes = {}
+        self._dirty = False
+        self._publisher_pid = None
+
+    @property
+    def state_file(self):
+        return os.path.join(self.state_dir, f'{socket.gethostname()}-{os.getpid()}.json')
+
+    def record(self, path, device, browser, now=None):
+        minute = int((now or time.time()) // 60)
+        with self._lock:
+            bucket = self._minutes.get(minute)
+            if bucket is None:
+                bucket = self._minutes[minute] = {'visits': 0, 'pages': {}, 'devices': {}, 'browsers': {}}
+                for old_minute in [m for m in self._minutes if m <= minute - LIVE_WINDOW_MINUTES]:
+                    del self._minutes[old_minute]
+            bucket['visits'] += 1
+            pages = bucket['pages']
+            if path not in pages and len(pages) >= LIVE_MAX_PAGES_PER_MINUTE:
+                path = 'أخرى'
+            pages[path] = pages.get(path, 0) + 1
+            bucket['devices'][device] = bucket['devices'].get(device, 0) + 1
+            bucket['browsers'][browser] = bucket['browsers'].get(browser, 0) + 1
+            self._dirty = True
+        self._ensure_publisher()
+
+    def export(self):
+        with self._lock:
+            return {str(minute): {'visits': bucket['visits'], 'pages': dict(bucket['pages']),
+                                  'devices': dict(bucket['devices']), 'browsers': dict(bucket['browsers'])}
+                    for minute, bucket in self._minutes.items()}
+
+    def publish(self):
+        """كتابة لقطة هذا العامل إلى ملفه (ذرياً عبر ملف مؤقت)"""
+        with self._lock:
+            self._dirty = False
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_path = f'{self.state_file}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.export(), f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_file)
+
+    def _ensure_publisher(self):
+        # خيط الكتابة يبدأ مع أول زيارة في كل عملية (أي بعد fork في gunicorn --preload)
+        pid = os.getpid()
+        if self._publisher_pid == pid:
+            return
+        with self._lock:
+            if self._publisher_pid == pid:
+                return
+            self._publisher_pid = pid
+        threading.Thread(target=self._publish_loop, daemon=True).start()
+
+    def _publish_loop(self):
+        while True:
+            time.sleep(LIVE_PUBLISH_SECONDS)
+            if self._dirty:
+                try:
+                    self.publish()
+                except OSError as e:
+                    app.logger.warning(f'تعذر حفظ لقطة الزيارات الحية: {e}')
+
+    def _worker_states(self, now):
+        states = [self.export()]
+        try:
+            names = os.listdir(self.state_dir)
+        except OSError:
+            return states
+        own_file = os.path.basename(self.state_file)
+        for name in names:
+            if not name.endswith('.json') or name == own_file:
+                continue
+            path = os.path.join(self.state_dir, name)
+            try:
+                if now - os.path.getmtime(path) > LIVE_WINDOW_MINUTES * 60:
+                    # عامل متوقف: كل دلائه خارج النافذة
+                    os.remove(path)
+                    continue
+                with open(path, encoding='utf-8') as f:
+                    states.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return states
+
+    def snapshot(self, now=None):
+        """دمج دلاء جميع العمال: زيارات كل دقيقة (الأقدم أولاً) والصفحات النشطة وتوزيع الأجهزة والمتصفحات"""
+        now = now or time.time()
+        current_minute = int(now // 60)
+        per_minute = [0] * LIVE_WINDOW_MINUTES
+        pages, devices, browsers = {}, {}, {}
+        states = self._worker_states(now)
+        for state in states:
+            for minute, bucket in state.items():
+                age = current_minute - int(minute)
+                if not 0 <= age < LIVE_WINDOW_MINUTES:
+                    continue
+                per_minute[LIVE_WINDOW_MINUTES - 1 - age] += bucket['visits']
+                if age < LIVE_ACTIVE_MINUTES:
+                    for merged, counts in ((pages, bucket['pages']), (devices, bucket['devices']), (browsers, bucket['browsers'])):
+                        for key, count in counts.items():
+                            merged[key] = merged.get(key, 0) + count
+        return {
+            'per_minute': per_minute,
+            'current_minute': per_minute[-1],
+            'active_pages': sorted(pages.items(), key=lambda item: item[1], reverse=True)[:10],
+            'devices': devices,
+            'browsers': browsers,
+            'workers': len(states),
+        }
+
+live_traffic = LiveTrafficAggregator(os.environ.get('LIVE_STATE_DIR') or os.path.join(app.instance_path, 'live'))
+
 # Routes
 @app.before_request
 def log_visit():
@@ -388,6 +2383,10 @@ def log_visit():
     # تجنب تسجيل الزيارات لملفات static
     if request.path.startswith('/static'):
         return
+
+    # البوتات لا تُسجَّل كزيارات (يحددها ingress_filter)
+    if g.get('is_bot'):
+        return
     
     # تجنب تسجيل زيارات dashboard
     if request.path.startswith('/dashboard'):
@@ -396,15 +2395,17 @@ def log_visit():
     # تجنب تسجيل زيارات الأدمن (صفحات الإدارة)
     if request.path.startswith('/admin'):
         return
+
+    # طلبات الـ API وأجزاء الصفحات (fragments) ليست مشاهدات صفحات
+    if request.path.startswith('/api/') or request.endpoint in NON_PAGE_ENDPOINTS:
+        return
     
     # تجنب تسجيل زيارات الأدمن (إذا كان المستخدم الحالي أدمن)
     if current_user.is_authenticated and current_user.is_admin:
         return
     
     # الحصول على IP Address
-    ip_address = request.remote_addr
-    if request.headers.get('X-Forwarded-For'):
-        ip_address = request.headers.get('X-Forwarded-For').split(',')[0].strip()
+    ip_address = get_client_ip()
     
     # الحصول على User-Agent
     user_agent = request.headers.get('User-Agent', '')
@@ -416,6 +2417,7 @@ def log_visit():
     # الحصول على المسار والمرجع
     page_path = request.path
     referrer = request.headers.get('Referer', '')
+    referrer_host, traffic_source = classify_referrer(referrer, request.host)
     
     # الحصول على معرف المستخدم إذا كان مسجل دخول
     user_id = current_user.id if current_user.is_authenticated else None
@@ -428,72 +2430,378 @@ def log_visit():
         device_type=device_type,
         page_path=page_path,
         referrer=referrer,
+        referrer_host=referrer_host,
+        traffic_source=traffic_source,
         user_id=user_id
     )
     db.session.add(visit)
     db.session.commit()
+    live_traffic.record(page_path, device_type, browser)
 
 @app.route('/')
 def home():
     return render_template('home.html')
 
+# نماذج قراءة خفيفة للقوائم: استعلام أعمدة فقط يُرجع tuples بدون كائنات ORM ولا identity map
+# الوصف يُقتطع في قاعدة البيانات لأن البطاقة تعرض أول 150 حرفاً فقط
+IDEA_CARD_EXCERPT = 150
+LISTING_LIMIT = 50
+
+class IdeaCard(namedtuple('IdeaCard', ['id', 'title', 'slug', 'description', 'category', 'category_id',
+                                       'views', 'created_at', 'comment_count', 'author_id', 'author_name'])):
+    """بطاقة فكرة في القوائم (الأعمدة التي تعرضها القوالب فقط)"""
+    __slots__ = ()
+
+    def get_slug(self):
+        return self.slug or make_slug(self.title)
+
+def idea_cards_select(comment_count=None):
+    """SELECT لأعمدة IdeaCard (comment_count: عمود عدد جاهز، وإلا subquery مرتبط)"""
+    if comment_count is None:
+        comment_count = db.select(db.func.count(Comment.id)).where(Comment.idea_id == Idea.id)\
+            .correlate(Idea).scalar_subquery()
+    return db.select(
+        Idea.id, Idea.title, Idea.slug, db.func.substr(Idea.description, 1, IDEA_CARD_EXCERPT + 1),
+        Idea.category, Idea.category_id, Idea.views, Idea.created_at,
+        comment_count.label('comment_count'), Idea.user_id, User.username
+    ).join(User, User.id == Idea.user_id)
+
+def load_idea_cards(stmt):
+    return [IdeaCard._make(row) for row in db.session.execute(stmt)]
+
+def listing_cards(order_by, category=None, where=None):
+    """أول LISTING_LIMIT بطاقة مرتبة (مع تصنيف اختياري)"""
+    stmt = idea_cards_select()
+    if where is not None:
+        stmt = stmt.where(where)
+    if category:
+        stmt = stmt.where(Idea.category_id == category.id)
+    return load_idea_cards(stmt.order_by(order_by).limit(LISTING_LIMIT))
+
 @app.route('/most-viewed')
 def most_viewed():
     try:
-        # جلب التصنيف من query parameter
-        category = request.args.get('category', None)
-        
-        # بناء الاستعلام
-        query = Idea.query
-        if category:
-            query = query.filter(Idea.category == category)
+        # جلب التصنيف من query parameter (معرف التصنيف)
+        category = find_category(request.args.get('category'))
         
-        # تحسين الاستعلام باستخدام eager loading
-        ideas = query.options(db.joinedload(Idea.author)).order_by(Idea.views.desc()).limit(50).all()
-        return render_template('most_viewed.html', ideas=ideas, selected_category=category)
+        ideas = listing_cards(Idea.views.desc(), category)
+        return render_template('most_viewed.html', ideas=ideas, selected_category=category, categories=get_categories())
     except Exception as e:
         print(f"Error in most_viewed route: {str(e)}")
-        return render_template('most_viewed.html', ideas=[], selected_category=None)
+        return render_template('most_viewed.html', ideas=[], selected_category=None, categories=[])
 
 @app.route('/latest')
 def latest_ideas():
     try:
-        # جلب التصنيف من query parameter
-        category = request.args.get('category', None)
-        
-        # بناء الاستعلام
-        query = Idea.query
-        if category:
-            query = query.filter(Idea.category == category)
+        # جلب التصنيف من query parameter (معرف التصنيف)
+        category = find_category(request.args.get('category'))
         
-        # تحسين الاستعلام باستخدام eager loading
-        ideas = query.options(db.joinedload(Idea.author)).order_by(Idea.created_at.desc()).limit(50).all()
-        return render_template('latest_ideas.html', ideas=ideas, selected_category=category)
+        ideas = listing_cards(Idea.created_at.desc(), category)
+        return render_template('latest_ideas.html', ideas=ideas, selected_category=category, categories=get_categories())
     except Exception as e:
         print(f"Error in latest_ideas route: {str(e)}")
-        return render_template('latest_ideas.html', ideas=[], selected_category=None)
+        return render_template('latest_ideas.html', ideas=[], selected_category=None, categories=[])
 
 @app.route('/most-commented')
 def most_commented():
     try:
-        # جلب التصنيف من query parameter
-        category = request.args.get('category', None)
-        
-        # بناء الاستعلام
-        query = db.session.query(Idea, db.func.count(Comment.id).label('comment_count'))\
-            .join(Comment)\
-            .group_by(Idea.id)
+        # جلب التصنيف من query parameter (معرف التصنيف)
+        category = find_category(request.args.get('category'))
         
+        # العد مجمّع مرة واحدة لكل فكرة لها تعليقات، ثم ربطه بأعمدة البطاقة
+        counts = db.select(Comment.idea_id, db.func.count(Comment.id).label('comment_count'))\
+            .group_by(Comment.idea_id).subquery()
+        stmt = idea_cards_select(counts.c.comment_count).join(counts, counts.c.idea_id == Idea.id)
         if category:
-            query = query.filter(Idea.category == category)
-        
-        # تحسين الاستعلام باستخدام eager loading
-        ideas_with_counts = query.options(db.joinedload(Idea.author)).order_by(db.desc('comment_count')).limit(50).all()
-        ideas = [idea for idea, _ in ideas_with_counts]
-        return render_template('most_commented.html', ideas=ideas, selected_category=category)
+            stmt = stmt.where(Idea.category_id == category.id)
+        ideas = load_idea_cards(stmt.order_by(counts.c.comment_count.desc()).limit(LISTING_LIMIT))
+        return render_template('most_commented.html', ideas=ideas, selected_category=category, categories=get_categories())
     except Exception as e:
         print(f"Error in most_commented route: {str(e)}")
-        return render_template('most_commented.html', ideas=[], selected_category=None)
+        return render_template('most_commented.html', ideas=[], selected_category=None, categories=[])
+
+@app.route('/trending')
+def trending():
+    """الأفكار الرائجة: قراءة مباشرة من فهرس trending_score (أو (category_id, trending_score) مع التصنيف)"""
+    try:
+        category = find_category(request.args.get('category'))
+
+        ideas = listing_cards(Idea.trending_score.desc(), category, where=Idea.trending_score.isnot(None))
+        return render_template('trending.html', ideas=ideas, selected_category=category, categories=get_categories())
+    except Exception as e:
+        print(f"Error in trending route: {str(e)}")
+        return render_template('trending.html', ideas=[], selected_category=None, categories=[])
+
+# JSON API (v1)
+# استعلامات أعمدة فقط بدون بناء كائنات ORM، مع ترقيم cursor واختيار الحقول و ETag
+API_DEFAULT_LIMIT = 20
+API_MAX_LIMIT = 100
+
+def _comment_count_column():
+    return db.select(db.func.count(Comment.id))\
+        .where(Comment.idea_id == Idea.id, Comment.is_published.is_(True))\
+        .correlate(Idea).scalar_subquery()
+
+API_IDEA_FIELDS = {
+    'id': lambda: Idea.id,
+    'title': lambda: Idea.title,
+    'slug': lambda: Idea.slug,
+    'description': lambda: Idea.description,
+    'category': lambda: Idea.category,
+    'category_id': lambda: Idea.category_id,
+    'views': lambda: Idea.views,
+    'created_at': lambda: Idea.created_at,
+    'author_id': lambda: Idea.user_id,
+    'author': lambda: User.username,
+    'comment_count': _comment_count_column,
+}
+API_IDEA_DEFAULT_FIELDS = ['id', 'title', 'slug', 'category', 'views', 'created_at', 'author', 'comment_count']
+
+API_COMMENT_FIELDS = {
+    'id': lambda: Comment.id,
+    'content': lambda: Comment.content,
+    'created_at': lambda: Comment.created_at,
+    'updated_at': lambda: Comment.updated_at,
+    'author_id': lambda: Comment.user_id,
+    'author': lambda: User.username,
+}
+API_COMMENT_DEFAULT_FIELDS = ['id', 'content', 'created_at', 'author']
+
+API_USER_FIELDS = {
+    'id': lambda: User.id,
+    'username': lambda: User.username,
+    'full_name': lambda: User.full_name,
+    'bio': lambda: User.bio,
+    'location': lambda: User.location,
+    'website': lambda: User.website,
+    'created_at': lambda: User.created_at,
+    'idea_count': lambda: db.select(db.func.count(Idea.id)).where(Idea.user_id == User.id).correlate(User).scalar_subquery(),
+}
+API_USER_DEFAULT_FIELDS = ['id', 'username', 'full_name', 'bio', 'location', 'website', 'created_at', 'idea_count']
+
+class ApiError(Exception):
+    """خطأ يُعاد للعميل كـ JSON"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def api_fields(available, default):
+    """قراءة ?fields=a,b والتحقق منها"""
+    requested = request.args.get('fields')
+    if not requested:
+        return default
+    fields = [field.strip() for field in requested.split(',') if field.strip()]
+    invalid = [field for field in fields if field not in available]
+    if invalid:
+        raise ApiError(f'حقول غير معروفة: {", ".join(invalid)}')
+    return fields
+
+def api_limit():
+    limit = request.args.get('limit', API_DEFAULT_LIMIT, type=int)
+    return max(1, min(limit, API_MAX_LIMIT))
+
+def encode_cursor(values):
+    """ترميز قيم آخر صف كـ cursor غير شفاف"""
+    raw = json.dumps([_export_value(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+class CursorError(ValueError):
+    """cursor تالف أو معدّل؛ الـ API يحوله إلى ApiError وصفحات HTML تعالجه بنفسها"""
+
+def decode_cursor(cursor, size=1):
+    """فك ترميز cursor والتحقق من عدد القيم"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise CursorError('cursor غير صالح')
+    if not isinstance(values, list) or len(values) != size:
+        raise CursorError('cursor غير صالح')
+    return values
+
+def decode_time_cursor(cursor):
+    """فك cursor من (created_at, id) المستخدم في صفحات keyset المرتبة زمنياً"""
+    created_at, row_id = decode_cursor(cursor, size=2)
+    try:
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (TypeError, ValueError):
+        raise CursorError('cursor غير صالح')
+
+def api_select(fields, available):
+    """بناء SELECT للحقول المطلوبة فقط"""
+    return db.select(*[available[field]().label(field) for field in fields])
+
+def api_rows(result, fields):
+    return [
+        {field: _export_value(value) for field, value in zip(fields, row)}
+        for row in result
+    ]
+
+def api_response(payload, status=200):
+    """JSON مضغوط مع ETag واستجابة 304 عند عدم التغيير"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    response = Response(body, status=status, mimetype='application/json')
+    if status == 200:
+        response.add_etag()
+        response.cache_control.public = True
+        response.cache_control.max_age = 30
+        response.make_conditional(request)
+    return response
+
+@app.errorhandler(ApiError)
+def handle_api_error(error):
+    return api_response({'error': error.message}, status=error.status)
+
+@app.route('/api/v1/ideas')
+def api_ideas():
+    """قائمة الأفكار (الأحدث أولاً) مع ترقيم cursor"""
+    fields = api_fields(API_IDEA_FIELDS, API_IDEA_DEFAULT_FIELDS)
+    limit = api_limit()
+    # نحتاج id دائماً لبناء الـ cursor
+    query_fields = fields if 'id' in fields else fields + ['id']
+    query = api_select(query_fields, API_IDEA_FIELDS).join(User, User.id == Idea.user_id)
+
+    if request.args.get('category'):
+        category = find_category(request.args.get('category'))
+        if not category:
+            raise ApiError('تصنيف غير معروف')
+        query = query.where(Idea.category_id == category.id)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            (last_id,) = decode_cursor(cursor)
+        except CursorError as e:
+            raise ApiError(str(e))
+        query = query.where(Idea.id < last_id)
+
+    rows = db.session.execute(query.order_by(Idea.id.desc()).limit(limit + 1)).all()
+    next_cursor = encode_cursor([rows[limit - 1].id]) if len(rows) > limit else None
+    items = api_rows(rows[:limit], query_fields)
+    if 'id' not in fields:
+        for item in items:
+            del item['id']
+    return api_response({'items': items, 'next_cursor': next_cursor})
+
+@app.route('/api/v1/ideas/<int:idea_id>')
+def api_idea(idea_id):
+    fields = api_fields(API_IDEA_FIELDS, API_IDEA_DEFAULT_FIELDS + ['description'])
+    query = api_select(fields, API_IDEA_FIELDS).join(User, User.id == Idea.user_id).where(Idea.id == idea_id)
+    row = db.session.execute(query).first()
+    if row is None:
+        raise ApiError('الفكرة غير موجودة', status=404)
+    return api_response(api_rows([row], fields)[0])
+
+@app.route('/api/v1/ideas/<int:idea_id>/comments')
+def api_idea_comments(idea_id):
+    """التعليقات المنشورة على فكرة (الأقدم أولاً) مع ترقيم cursor"""
+    fields = api_fields(API_COMMENT_FIELDS, API_COMMENT_DEFAULT_FIELDS)
+    limit = api_limit()
+    if db.session.execute(db.select(Idea.id).where(Idea.id == idea_id)).first() is None:
+        raise ApiError('الفكرة غير موجودة', status=404)
+
+    query_fields = fields if 'id' in fields else fields + ['id']
+    query = api_select(query_fields, API_COMMENT_FIELDS)\
+        .join(User, User.id == Comment.user_id)\
+        .where(Comment.idea_id == idea_id, Comment.is_published.is_(True))
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            (last_id,) = decode_cursor(cursor)
+        except CursorError as e:
+            raise ApiError(str(e))
+        query = query.where(Comment.id > last_id)
+
+    rows = db.session.execute(query.order_by(Comment.id).limit(limit + 1)).all()
+    next_cursor = encode_cursor([rows[limit - 1].id]) if len(rows) > limit else None
+    items = api_rows(rows[:limit], query_fields)
+    if 'id' not in fields:
+        for item in items:
+            del item['id']
+    return api_response({'items': items, 'next_cursor': next_cursor})
+
+@app.route('/api/v1/users/<int:user_id>')
+def api_user(user_id):
+    """البروفايل العام لمستخدم (بدون البريد الإلكتروني)"""
+    fields = api_fields(API_USER_FIELDS, API_USER_DEFAULT_FIELDS)
+    row = db.session.execute(api_select(fields, API_USER_FIELDS).where(User.id == user_id)).first()
+    if row is None:
+        raise ApiError('المستخدم غير موجود', status=404)
+    return api_response(api_rows([row], fields)[0])
+
+# تجزئة كلمات المرور خارج خيط الطلب
+# scrypt و pbkdf2 في hashlib تحرر الـ GIL، فتنفيذها في executor صغير يترك خيوط gunicorn الأخرى تعرض الصفحات.
+# عدد التجزئات المتزامنة محدود لكل عامل، والطلبات الزائدة تنتظر مهلة قصيرة ثم تُرفض (موجة تسجيل دخول لا تحجز العامل)
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+PASSWORD_HASH_CONCURRENCY = int(os.environ.get('PASSWORD_HASH_CONCURRENCY', 2))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 8))
+PASSWORD_HASH_WAIT_SECONDS = float(os.environ.get('PASSWORD_HASH_WAIT_SECONDS', 5))
+
+class PasswordHashBusy(Exception):
+    """طابور تجزئة كلمات المرور ممتلئ"""
+
+def normalize_hash_method(method):
+    """الصيغة الكاملة التي تخزنها Werkzeug في بداية الـ hash (scrypt -> scrypt:32768:8:1)"""
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        return ':'.join(['scrypt'] + (args or ['32768', '8', '1']))
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = args[1] if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    raise ValueError(f'طريقة تجزئة غير مدعومة: {method}')
+
+class PasswordHasher:
+    """تجزئة والتحقق من كلمات المرور في executor محدود مع طابور انتظار محدود"""
+
+    def __init__(self, method, concurrency, queue_size, wait_seconds):
+        self.method = normalize_hash_method(method)
+        self.concurrency = concurrency
+        self.wait_seconds = wait_seconds
+        self._slots = threading.BoundedSemaphore(concurrency + queue_size)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # الخيوط لا تنتقل عبر fork (gunicorn --preload): executor جديد في كل عملية
+        pid = os.getpid()
+        if self._executor_pid != pid:
+            with self._lock:
+                if self._executor_pid != pid:
+                    self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix='password-hash')
+                    self._executor_pid = pid
+        return self._executor
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(timeout=self.wait_seconds):
+            raise PasswordHashBusy()
+        try:
+            return self._get_executor().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        # مستخدمو Google بدون كلمة مرور
+        if not password_hash or not password:
+            return False
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method
+
+password_hasher = PasswordHasher(PASSWORD_HASH_METHOD, PASSWORD_HASH_CONCURRENCY,
+                                 PASSWORD_HASH_QUEUE, PASSWORD_HASH_WAIT_SECONDS)
+
+@app.errorhandler(PasswordHashBusy)
+def handle_password_hash_busy(error):
+    flash('الخادم مشغول حالياً، يرجى المحاولة بعد لحظات', 'warning')
+    response = redirect(request.url)
+    response.headers['Retry-After'] = '5'
+    return response
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -505,12 +2813,19 @@ def login():
         password = request.form.get('password')
         user = User.query.filter_by(email=email).first()
         
-        if user and check_password_hash(user.password, password):
+        # كلمة المرور تُتحقق أولاً: حالة الحذف لا تظهر إلا لمن يملك كلمة مرور الحساب
+        if not (user and password_hasher.verify(user.password, password)):
+            flash('البريد الإلكتروني أو كلمة المرور غير صحيحة', 'danger')
+        elif not user.is_active:
+            flash('هذا الحساب قيد الحذف ولا يمكن تسجيل الدخول به', 'danger')
+        else:
+            # ترقية الـ hash بكلمة المرور الصحيحة عند تغيير طريقة/تكلفة التجزئة
+            if password_hasher.needs_rehash(user.password):
+                user.password = password_hasher.hash(password)
+                db.session.commit()
             login_user(user)
             flash('تم تسجيل الدخول بنجاح!', 'success')
             return redirect(url_for('home'))
-        else:
-            flash('البريد الإلكتروني أو كلمة المرور غير صحيحة', 'danger')
     
     return render_template('login.html')
 
@@ -537,7 +2852,7 @@ def register():
             flash('البريد الإلكتروني موجود بالفعل', 'danger')
             return redirect(url_for('register'))
         
-        hashed_password = generate_password_hash(password)
+        hashed_password = password_hasher.hash(password)
         new_user = User(username=username, email=email, password=hashed_password)
         db.session.add(new_user)
         db.session.commit()
@@ -560,22 +2875,36 @@ def submit_idea():
     if request.method == 'POST':
         title = request.form.get('title')
         description = request.form.get('description')
-        category = request.form.get('category')
+        category = db.session.get(Category, request.form.get('category', type=int) or 0)
+        if not category:
+            flash('يرجى اختيار تصنيف صحيح', 'danger')
+            return render_template('submit_idea.html', categories=get_categories(), form=request.form)
+
+        # عرض الأفكار المشابهة أولاً؛ النشر يتم عند إعادة الإرسال بعد المراجعة
+        if not request.form.get('confirm_duplicate'):
+            similar_ideas = find_similar_ideas(title, description)
+            if similar_ideas:
+                return render_template('submit_idea.html', categories=get_categories(), form=request.form,
+                                       similar_ideas=similar_ideas)
         
         new_idea = Idea(
             title=title,
             description=description,
-            category=category,
             user_id=current_user.id
         )
+        new_idea.set_category(category)
+        new_idea.bump_trending(TRENDING_VIEW_WEIGHT)
         
         db.session.add(new_idea)
+        db.session.flush()
+        index_idea_minhash(new_idea)
+        schedule_snapshots([new_idea.id])
         db.session.commit()
         
         flash('تم نشر الفكرة بنجاح!', 'success')
         return redirect(url_for('home'))
     
-    return render_template('submit_idea.html')
+    return render_template('submit_idea.html', categories=get_categories(), form=request.form)
 
 @app.route('/idea/<int:idea_id>/edit', methods=['GET', 'POST'])
 @login_required
@@ -588,44 +2917,141 @@ def edit_idea(idea_id):
         return redirect(url_for('view_idea', idea_id=idea_id))
     
     if request.method == 'POST':
-        idea.title = request.form.get('title')
-        idea.description = request.form.get('description')
-        idea.category = request.form.get('category')
+        title = request.form.get('title')
+        description = request.form.get('description')
+        category = db.session.get(Category, request.form.get('category', type=int) or 0)
+        if not category:
+            flash('يرجى اختيار تصنيف صحيح', 'danger')
+            return render_template('edit_idea.html', idea=idea, categories=get_categories(), form=request.form)
+
+        text_changed = (title, description) != (idea.title, idea.description)
+        if text_changed and not request.form.get('confirm_duplicate'):
+            similar_ideas = find_similar_ideas(title, description, exclude_id=idea.id)
+            if similar_ideas:
+                return render_template('edit_idea.html', idea=idea, categories=get_categories(), form=request.form,
+                                       similar_ideas=similar_ideas)
+
+        old_paths = idea_snapshot_paths(idea)
+        idea.title = title
+        idea.description = description
+        idea.set_category(category)
+        if text_changed:
+            index_idea_minhash(idea)
+        # لقطة الـ slug القديم تُعاد أيضاً حتى لا تبقى نسخة قديمة من المحتوى
+        schedule_snapshots([idea.id], paths=old_paths)
         
         db.session.commit()
         flash('تم تحديث الفكرة بنجاح!', 'success')
         return redirect(url_for('view_idea', idea_id=idea_id, slug=idea.get_slug()))
     
-    return render_template('edit_idea.html', idea=idea)
+    return render_template('edit_idea.html', idea=idea, categories=get_categories(), form=request.form)
+
+COMMENTS_PER_PAGE = 20
+
+def load_comments_page(idea, cursor=None, per_page=COMMENTS_PER_PAGE):
+    """صفحة من التعليقات (الأحدث أولاً) بترقيم keyset على (created_at, id)
+
+    صاحب الفكرة يرى جميع التعليقات، والآخرون يرون المنشورة فقط (التصفية في SQL).
+    يعيد (التعليقات، cursor الصفحة التالية أو None).
+    """
+    query = Comment.query.options(db.joinedload(Comment.author)).filter(Comment.idea_id == idea.id)
+    if not (current_user.is_authenticated and current_user.id == idea.user_id):
+        query = query.filter(Comment.is_published.is_(True))
+    if cursor:
+        last_created_at, last_id = decode_time_cursor(cursor)
+        query = query.filter(db.or_(
+            Comment.created_at < last_created_at,
+            db.and_(Comment.created_at == last_created_at, Comment.id < last_id)
+        ))
+    comments = query.order_by(Comment.created_at.desc(), Comment.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(comments) > per_page:
+        comments = comments[:per_page]
+        next_cursor = encode_cursor([comments[-1].created_at, comments[-1].id])
+    return comments, next_cursor
+
+def count_visible_comments(idea):
+    query = db.session.query(db.func.count(Comment.id)).filter(Comment.idea_id == idea.id)
+    if not (current_user.is_authenticated and current_user.id == idea.user_id):
+        query = query.filter(Comment.is_published.is_(True))
+    return query.scalar()
+
+# المشاهدات الفريدة: نفس الزائر لنفس الفكرة يُحتسب مرة واحدة خلال النافذة
+# (مرشحات Bloom في ذاكرة كل عامل؛ زائر يصل إلى عاملين مختلفين قد يُحتسب مرتين كحد أقصى لكل عامل)
+UNIQUE_VIEW_WINDOW_MINUTES = int(os.environ.get('UNIQUE_VIEW_WINDOW_MINUTES', 30))
+UNIQUE_VIEW_CAPACITY = int(os.environ.get('UNIQUE_VIEW_CAPACITY', 100000))  # أزواج (زائر، فكرة) لكل جيل
+UNIQUE_VIEW_ERROR_RATE = 0.001
+unique_views = RotatingBloomFilter(UNIQUE_VIEW_WINDOW_MINUTES * 60, UNIQUE_VIEW_CAPACITY, UNIQUE_VIEW_ERROR_RATE)
+# الزوار الفريدون لكل يوم: العد الدقيق في جدول idea_daily_visitor المشترك بين العمال،
+# وهذا المرشح يتجنب الكتابة فيه لزائر سبق تسجيله في نفس العامل (جيلان بطول يوم والمفتاح يتضمن التاريخ)
+daily_visitors = RotatingBloomFilter(2 * 86400, UNIQUE_VIEW_CAPACITY, UNIQUE_VIEW_ERROR_RATE, generations=2)
+
+def visitor_key():
+    """معرف الزائر: رقم المستخدم، أو hash لـ IP و User-Agent للزوار غير المسجلين"""
+    if current_user.is_authenticated:
+        return f'u{current_user.id}'
+    raw = f"{get_client_ip()}|{request.headers.get('User-Agent', '')}"
+    return 'a' + hashlib.blake2b(raw.encode('utf-8'), digest_size=12).hexdigest()
+
+def is_prefetch_request():
+    """طلبات التحميل المسبق من المتصفح ليست مشاهدات"""
+    purpose = request.headers.get('Sec-Purpose') or request.headers.get('Purpose') or request.headers.get('X-Moz') or ''
+    return 'prefetch' in purpose.lower()
 
 @app.route('/idea/<int:idea_id>')
 @app.route('/idea/<int:idea_id>/<slug>')
 def view_idea(idea_id, slug=None):
     # تحسين الاستعلام باستخدام eager loading
-    idea = Idea.query.options(
-        db.joinedload(Idea.author),
-        db.joinedload(Idea.comments).joinedload(Comment.author)
-    ).get_or_404(idea_id)
-    # زيادة عدد المشاهدات
-    idea.views += 1
-    db.session.commit()
-    
-    # جلب جميع التعليقات (لصاحب الفكرة يمكنه رؤية غير المنشورة)
-    all_comments = idea.comments
-    if current_user.is_authenticated and current_user.id == idea.user_id:
-        # صاحب الفكرة يرى جميع التعليقات
-        comments = all_comments
-    else:
-        # الآخرون يرون فقط المنشورة
-        comments = [c for c in all_comments if c.is_published]
-    
-    # جلب الأفكار ذات الصلة (نفس التصنيف فقط، باستثناء الفكرة الحالية)
-    related_ideas = Idea.query.filter(
-        Idea.category == idea.category,
-        Idea.id != idea.id
-    ).order_by(Idea.views.desc()).limit(4).all()
+    idea = Idea.query.options(db.joinedload(Idea.author)).get_or_404(idea_id)
+    # زيادة عدد المشاهدات للمشاهدة الأولى فقط خلال النافذة (البوتات والتحميل المسبق لا تُحتسب)
+    if not g.get('is_bot') and not is_prefetch_request():
+        visitor = visitor_key()
+        counted_view = unique_views.add_if_new(f'{idea.id}:{visitor}')
+        today = datetime.utcnow().date()
+        new_visitor = daily_visitors.add_if_new(f'{today}:{idea.id}:{visitor}') and record_daily_visitor(idea, visitor, today)
+        if counted_view:
+            idea.views += 1
+            idea.bump_trending(TRENDING_VIEW_WEIGHT)
+        if counted_view or new_visitor:
+            bump_idea_daily_stats(idea, views=int(counted_view), visitors=int(new_visitor))
+            db.session.commit()
     
-    return render_template('view_idea.html', idea=idea, comments=comments, related_ideas=related_ideas)
+    # نص الفكرة يُرسل أولاً، وبقية الأقسام تُحسب عندما يصل إليها القالب
+    def load_comments():
+        # الصفحة الأولى من التعليقات فقط؛ الباقي يُحمّل عند الطلب من idea_comments
+        comments, next_comments_cursor = load_comments_page(idea)
+        return comments, next_comments_cursor, count_visible_comments(idea)
+
+    def load_related_ideas():
+        # الأفكار ذات الصلة (نفس التصنيف فقط، باستثناء الفكرة الحالية)
+        return Idea.query.filter(
+            Idea.category_id == idea.category_id,
+            Idea.id != idea.id
+        ).order_by(Idea.views.desc()).limit(4).all()
+
+    def load_idea_daily_stats():
+        # رسم المشاهدات اليومية لصاحب الفكرة فقط
+        if current_user.is_authenticated and current_user.id == idea.user_id:
+            return load_daily_stats(IdeaDailyStat.idea_id, idea.id)
+        return None
+
+    sections = PageSections(comments=load_comments, related_ideas=load_related_ideas,
+                            daily_stats=load_idea_daily_stats)
+    return stream_page('view_idea.html', idea=idea, sections=sections)
+
+@app.route('/idea/<int:idea_id>/comments')
+def idea_comments(idea_id):
+    """صفحة تالية من التعليقات كـ HTML fragment (الـ cursor التالي في ترويسة X-Next-Cursor)"""
+    idea = Idea.query.get_or_404(idea_id)
+    try:
+        comments, next_cursor = load_comments_page(idea, request.args.get('cursor'))
+    except CursorError as e:
+        # الـ fragment يُدرج في الصفحة، فالخطأ يعاد HTML وليس JSON
+        return Response(f'<div class="alert alert-danger">{escape(str(e))}</div>', status=400, mimetype='text/html')
+    response = Response(render_template('_comments_page.html', idea=idea, comments=comments), mimetype='text/html')
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 @app.route('/idea/<int:idea_id>/comment', methods=['POST'])
 @login_required
@@ -633,13 +3059,19 @@ def add_comment(idea_id):
     idea = Idea.query.get_or_404(idea_id)
     content = request.form.get('content')
     
-    if content:
+    if not idea.author.is_active:
+        # صاحب الفكرة قيد الحذف
+        flash('لا يمكن التعليق على هذه الفكرة حالياً', 'danger')
+    elif content:
         comment = Comment(
             content=content,
             user_id=current_user.id,
             idea_id=idea.id
         )
         db.session.add(comment)
+        idea.bump_trending(TRENDING_COMMENT_WEIGHT)
+        bump_idea_daily_stats(idea, comments=1)
+        schedule_snapshots([idea.id])
         db.session.commit()
         flash('تم إضافة التعليق بنجاح!', 'success')
     else:
@@ -662,6 +3094,7 @@ def edit_comment(comment_id):
         if content:
             comment.content = content
             comment.updated_at = datetime.utcnow()
+            schedule_snapshots([comment.idea_id], listings=False)
             db.session.commit()
             flash('تم تحديث التعليق بنجاح!', 'success')
             return redirect(url_for('view_idea', idea_id=comment.idea_id))
@@ -682,6 +3115,8 @@ def delete_comment(comment_id):
         return redirect(url_for('view_idea', idea_id=idea_id))
     
     db.session.delete(comment)
+    discount_deleted_comments([(idea_id, comment.created_at)])
+    schedule_snapshots([idea_id])
     db.session.commit()
     flash('تم حذف التعليق بنجاح!', 'success')
     return redirect(url_for('view_idea', idea_id=idea_id))
@@ -698,12 +3133,178 @@ def toggle_comment_publish(comment_id):
         return redirect(url_for('view_idea', idea_id=idea.id))
     
     comment.is_published = not comment.is_published
+    schedule_snapshots([idea.id])
     db.session.commit()
     
     status = 'نشر' if comment.is_published else 'إخفاء'
     flash(f'تم {status} التعليق بنجاح!', 'success')
     return redirect(url_for('view_idea', idea_id=idea.id))
 
+# طابور مراجعة التعليقات لصاحب الأفكار
+# القائمة أعمدة فقط بترقيم keyset، والإجراءات الجماعية جملة UPDATE/DELETE واحدة مقيدة بأفكار المستخدم
+# (يستفيد من الفهرس ix_comment_idea_published_created على (idea_id, is_published, created_at))
+MODERATION_PER_PAGE = 30
+MODERATION_RECENT_DAYS = 7
+MODERATION_FILTERS = ('hidden', 'recent')
+MODERATION_ACTIONS = {
+    'publish': ('نشر', {'is_published': True}),
+    'hide': ('إخفاء', {'is_published': False}),
+    'delete': ('حذف', None),
+}
+
+ModerationRow = namedtuple('ModerationRow', ['id', 'content', 'created_at', 'is_published', 'idea_id',
+                                             'idea_title', 'idea_slug', 'author_name'])
+
+def owned_idea_ids(user):
+    return db.select(Idea.id).where(Idea.user_id == user.id)
+
+def load_moderation_page(user, status, cursor=None, per_page=MODERATION_PER_PAGE):
+    """صفحة من تعليقات أفكار المستخدم (المخفية أو الأحدث) مع cursor الصفحة التالية"""
+    query = db.session.query(
+        Comment.id, Comment.content, Comment.created_at, Comment.is_published, Comment.idea_id,
+        Idea.title, Idea.slug, User.username
+    ).join(Idea, Idea.id == Comment.idea_id).join(User, User.id == Comment.user_id)\
+        .filter(Comment.idea_id.in_(owned_idea_ids(user)))
+    if status == 'hidden':
+        query = query.filter(Comment.is_published.is_(False))
+    else:
+        query = query.filter(Comment.created_at >= datetime.utcnow() - timedelta(days=MODERATION_RECENT_DAYS))
+    if cursor:
+        created_at, comment_id = decode_time_cursor(cursor)
+        query = query.filter(db.tuple_(Comment.created_at, Comment.id) < (created_at, comment_id))
+    rows = [ModerationRow._make(row) for row in query
+            .order_by(Comment.created_at.desc(), Comment.id.desc()).limit(per_page + 1)]
+    comments = rows[:per_page]
+    next_cursor = encode_cursor([comments[-1].created_at, comments[-1].id]) if len(rows) > per_page else None
+    return comments, next_cursor
+
+@app.route('/moderation')
+@login_required
+def moderation():
+    status = request.args.get('status', 'hidden')
+    if status not in MODERATION_FILTERS:
+        status = 'hidden'
+    try:
+        comments, next_cursor = load_moderation_page(current_user, status, request.args.get('cursor'))
+    except CursorError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('moderation', status=status))
+    return render_template('moderation.html', comments=comments, status=status, next_cursor=next_cursor,
+                           recent_days=MODERATION_RECENT_DAYS)
+
+@app.route('/moderation/bulk', methods=['POST'])
+@login_required
+def moderation_bulk():
+    """نشر/إخفاء/حذف التعليقات المحددة بجملة واحدة (لا يمر عبر view_idea فلا تزيد المشاهدات)"""
+    status = request.form.get('status', 'hidden')
+    action = MODERATION_ACTIONS.get(request.form.get('action'))
+    comment_ids = request.form.getlist('comment_ids', type=int)
+    if not action or not comment_ids:
+        flash('يرجى اختيار تعليقات وإجراء', 'danger')
+        return redirect(url_for('moderation', status=status))
+
+    label, values = action
+    condition = db.and_(Comment.id.in_(comment_ids), Comment.idea_id.in_(owned_idea_ids(current_user)))
+    if values is None:
+        statement = db.delete(Comment).where(condition)
+    else:
+        statement = db.update(Comment).where(condition).values(**values)
+    # RETURNING يعيد التعليقات والأفكار المتأثرة من نفس الجملة لتحديث لقطاتها (وأيام التعليقات المحذوفة لعداداتها)
+    affected = db.session.execute(
+        statement.returning(Comment.id, Comment.idea_id, Comment.created_at).execution_options(synchronize_session=False)
+    ).all()
+    idea_ids = [idea_id for _, idea_id, _ in affected]
+    if values is None:
+        discount_deleted_comments([(idea_id, created_at) for _, idea_id, created_at in affected])
+    invalidation_bus.publish_many('comment', [comment_id for comment_id, _, _ in affected])
+    schedule_snapshots(idea_ids)
+    db.session.commit()
+
+    flash(f'تم {label} {len(idea_ids)} تعليق', 'success')
+    return redirect(url_for('moderation', status=status))
+
+
+# سجل الزيارات في لوحة التحكم
+VISIT_LOG_PER_PAGE = 20
+VISIT_LOG_FILTERS = {
+    'path': lambda: Visit.page_path,
+    'ip': lambda: Visit.ip_address,
+    'browser': lambda: Visit.browser,
+    'device': lambda: Visit.device_type,
+}
+
+def estimate_row_count(model):
+    """عدد تقريبي لصفوف جدول بدون COUNT(*)
+
+    PostgreSQL: إحصائيات المخطط (pg_class.reltuples). غير ذلك: أكبر id (يتجاهل الصفوف المحذوفة).
+    """
+    table = model.__tablename__
+    if db.engine.dialect.name == 'postgresql':
+        estimate = db.session.execute(
+            db.text('SELECT reltuples::bigint FROM pg_class WHERE relname = :table'), {'table': table}
+        ).scalar()
+        if estimate is not None and estimate >= 0:
+            return int(estimate)
+    return db.session.query(db.func.max(model.id)).scalar() or 0
+
+def estimate_query_count(query):
+    """عدد تقريبي لنتائج استعلام من مخطط التنفيذ (PostgreSQL فقط، وإلا None)"""
+    if db.engine.dialect.name != 'postgresql':
+        return None
+    # قيم الفلاتر تبقى معاملات مربوطة يمررها المشغل؛ لا تُدمج في نص SQL
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    plan = db.session.connection().exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+# صف في جدول الزيارات بلوحة التحكم (أعمدة فقط مع اسم المستخدم بدلاً من كائنات Visit و User)
+VisitRow = namedtuple('VisitRow', ['id', 'created_at', 'ip_address', 'browser', 'device_type', 'page_path', 'username'])
+
+def load_visit_log_page(filters, before=None, after=None, per_page=VISIT_LOG_PER_PAGE):
+    """صفحة من سجل الزيارات (الأحدث أولاً) بترقيم keyset على (created_at, id)
+
+    before: cursor لآخر صف معروض (الصفحة الأقدم)، after: cursor لأول صف معروض (الصفحة الأحدث).
+    """
+    conditions = [VISIT_LOG_FILTERS[key]() == value for key, value in filters.items()]
+    base_query = Visit.query.filter(*conditions)
+    query = db.session.query(
+        Visit.id, Visit.created_at, Visit.ip_address, Visit.browser, Visit.device_type, Visit.page_path, User.username
+    ).outerjoin(User, User.id == Visit.user_id).filter(*conditions)
+
+    cursor = before or after
+    if cursor:
+        created_at, visit_id = decode_time_cursor(cursor)
+        key = db.tuple_(Visit.created_at, Visit.id)
+        query = query.filter(key < (created_at, visit_id) if before else key > (created_at, visit_id))
+
+    if after and not before:
+        rows = [VisitRow._make(row) for row in query
+                .order_by(Visit.created_at.asc(), Visit.id.asc()).limit(per_page + 1)]
+        has_more_newer = len(rows) > per_page
+        visits = list(reversed(rows[:per_page]))
+        has_newer, has_older = has_more_newer, True
+    else:
+        rows = [VisitRow._make(row) for row in query
+                .order_by(Visit.created_at.desc(), Visit.id.desc()).limit(per_page + 1)]
+        visits = rows[:per_page]
+        has_newer, has_older = bool(before), len(rows) > per_page
+
+    if filters:
+        estimated_total = estimate_query_count(base_query)
+    else:
+        estimated_total = estimate_row_count(Visit)
+
+    page = {
+        'newer': encode_cursor([visits[0].created_at, visits[0].id]) if visits and has_newer else None,
+        'older': encode_cursor([visits[-1].created_at, visits[-1].id]) if visits and has_older else None,
+        'estimated_total': estimated_total,
+        'per_page': per_page,
+    }
+    return visits, page
 
 @app.route('/dashboard')
 @login_required
@@ -713,179 +3314,196 @@ def dashboard():
         flash('ليس لديك صلاحية للوصول إلى لوحة التحكم', 'danger')
         return redirect(url_for('home'))
     
-    # الإحصائيات العامة
-    total_users = User.query.count()
-    total_ideas = Idea.query.count()
-    total_comments = Comment.query.count()
-    total_visits = Visit.query.count()
-    
-    # الزيارات اليوم
     today = datetime.utcnow().date()
-    visits_today = Visit.query.filter(Visit.created_at >= today).count()
-    
-    # الزيارات هذا الأسبوع
     week_ago = datetime.utcnow() - timedelta(days=7)
-    visits_this_week = Visit.query.filter(Visit.created_at >= week_ago).count()
-    
-    # الزيارات هذا الشهر
     month_ago = datetime.utcnow() - timedelta(days=30)
-    visits_this_month = Visit.query.filter(Visit.created_at >= month_ago).count()
-    
-    # الإحصائيات حسب المتصفح
-    browser_stats = db.session.query(
-        Visit.browser, 
-        db.func.count(Visit.id).label('count')
-    ).group_by(Visit.browser).all()
-    
-    # الإحصائيات حسب نوع الجهاز
-    device_stats = db.session.query(
-        Visit.device_type, 
-        db.func.count(Visit.id).label('count')
-    ).group_by(Visit.device_type).all()
-    
-    # Pagination للزيارات
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
-    visits_pagination = Visit.query.order_by(Visit.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
-    recent_visits = visits_pagination.items
-    
-    # أكثر الصفحات زيارة
-    popular_pages = db.session.query(
-        Visit.page_path,
-        db.func.count(Visit.id).label('count')
-    ).group_by(Visit.page_path).order_by(db.func.count(Visit.id).desc()).limit(10).all()
-    
-    # IPs الفريدة
-    unique_ips = db.session.query(db.func.count(db.func.distinct(Visit.ip_address))).scalar()
-    
-    # المستخدمون الجدد هذا الشهر
-    new_users_month = User.query.filter(User.created_at >= month_ago).count()
 
-    # الأفكار الجديدة هذا الشهر
-    new_ideas_month = Idea.query.filter(Idea.created_at >= month_ago).count()
-    
-    # حساب Bounce Rate (معدل الارتداد)
-    # الزيارات التي لها صفحة واحدة فقط
-    try:
-        single_page_visits = db.session.query(
-            Visit.ip_address
-        ).group_by(Visit.ip_address).having(db.func.count(Visit.id) == 1).count()
-        
-        bounce_rate = (single_page_visits / total_visits * 100) if total_visits > 0 else 0
-    except Exception as e:
-        app.logger.error(f"Error calculating bounce rate: {e}")
-        bounce_rate = 0
-    
-    # حساب Organic Percentage (نسبة الزيارات المباشرة/العضوية)
-    # نفترض أن الزيارات بدون referrer هي زيارات عضوية
-    try:
-        organic_visits = Visit.query.filter(
-            (Visit.referrer == None) | (Visit.referrer == '')
-        ).count()
-        organic_visits_month = Visit.query.filter(
-            Visit.created_at >= month_ago,
-            (Visit.referrer == None) | (Visit.referrer == '')
-        ).count()
-        organic_percentage = (organic_visits / total_visits * 100) if total_visits > 0 else 0
-    except Exception as e:
-        app.logger.error(f"Error calculating organic percentage: {e}")
-        organic_visits = 0
-        organic_visits_month = 0
-        organic_percentage = 0
-    
-    # حساب CTR (Click-Through Rate) - نفترض قيمة تقديرية
-    ctr = 15.5  # نسبة تقديرية - يمكن تحسينها لاحقاً
-    ctr_status = "جيد" if ctr >= 20 else "متوسط" if ctr >= 14 else "يحتاج تحسين"
-    
-    # حساب Bounce Rate Status
-    bounce_rate_status = "ممتاز" if bounce_rate < 40 else "جيد" if bounce_rate < 60 else "يحتاج تحسين"
-    
-    # حساب Indexed Pages (الصفحات المفهرسة)
-    indexed_pages = total_ideas + 4  # الأفكار + الصفحات الثابتة
-    
-    # حساب Direct & Referral Traffic
-    try:
-        direct_visits = Visit.query.filter(Visit.referrer == None).count()
-        referral_visits = Visit.query.filter(Visit.referrer != None).count()
-        direct_percentage = (direct_visits / total_visits * 100) if total_visits > 0 else 0
-        referral_percentage = (referral_visits / total_visits * 100) if total_visits > 0 else 0
-    except:
-        direct_visits = 0
-        referral_visits = 0
-        direct_percentage = 0
-        referral_percentage = 0
-    
-    # Core Web Vitals (تقديرات)
-    estimated_lcp = 2.1  # Largest Contentful Paint in seconds
-    estimated_fid = 80   # First Input Delay in ms
-    estimated_cls = 0.08  # Cumulative Layout Shift
-    lcp_status = "جيد" if estimated_lcp < 2.5 else "يحتاج تحسين"
-    fid_status = "جيد" if estimated_fid < 100 else "يحتاج تحسين"
-    cls_status = "جيد" if estimated_cls < 0.1 else "يحتاج تحسين"
-    
-    # Conversion Rate & Session Stats (تقديرات)
-    conversion_rate = 3.5  # نسبة تحويل المستخدمين لمشاركين
-    avg_session_duration = 4.2  # متوسط مدة الجلسة بالدقائق
-    avg_pages_per_session = 2.8  # متوسط الصفحات لكل جلسة
-    
+    # سجل الزيارات: ترقيم keyset بدلاً من OFFSET و COUNT(*) الكامل
+    # الـ cursor يُتحقق منه قبل بدء البث؛ التالف يعيد إلى الصفحة الأولى من السجل
+    visit_filters = {key: request.args.get(key, '').strip() for key in VISIT_LOG_FILTERS}
+    visit_filters = {key: value for key, value in visit_filters.items() if value}
+    before, after = request.args.get('before'), request.args.get('after')
+    if before or after:
+        try:
+            decode_time_cursor(before or after)
+        except CursorError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('dashboard', **visit_filters))
+
+    # كل قسم يُحسب عندما يصل إليه القالب، بعد إرسال ما قبله للمتصفح
+    def load_totals():
+        # الإحصائيات العامة
+        return {
+            'total_users': User.query.count(),
+            'total_ideas': Idea.query.count(),
+            'total_comments': Comment.query.count(),
+            'total_visits': Visit.query.count(),
+        }
+
+    def load_visit_periods():
+        # الزيارات اليوم وهذا الأسبوع وهذا الشهر
+        return {
+            'visits_today': Visit.query.filter(Visit.created_at >= today).count(),
+            'visits_this_week': Visit.query.filter(Visit.created_at >= week_ago).count(),
+            'visits_this_month': Visit.query.filter(Visit.created_at >= month_ago).count(),
+        }
+
+    def load_breakdowns():
+        # الإحصائيات حسب المتصفح ونوع الجهاز
+        browser_stats = db.session.query(
+            Visit.browser,
+            db.func.count(Visit.id).label('count')
+        ).group_by(Visit.browser).all()
+        device_stats = db.session.query(
+            Visit.device_type,
+            db.func.count(Visit.id).label('count')
+        ).group_by(Visit.device_type).all()
+
+        # أكثر الصفحات زيارة
+        popular_pages = db.session.query(
+            Visit.page_path,
+            db.func.count(Visit.id).label('count')
+        ).group_by(Visit.page_path).order_by(db.func.count(Visit.id).desc()).limit(10).all()
+
+        return {
+            'browser_stats': browser_stats,
+            'device_stats': device_stats,
+            'popular_pages': popular_pages,
+            # IPs الفريدة
+            'unique_ips': db.session.query(db.func.count(db.func.distinct(Visit.ip_address))).scalar(),
+            # المستخدمون والأفكار الجديدة هذا الشهر
+            'new_users_month': User.query.filter(User.created_at >= month_ago).count(),
+            'new_ideas_month': Idea.query.filter(Idea.created_at >= month_ago).count(),
+        }
+
+    def load_visit_log():
+        recent_visits, visits_page = load_visit_log_page(visit_filters, before=before, after=after)
+        return {'recent_visits': recent_visits, 'visits_page': visits_page}
+
+    def load_seo():
+        total_visits = sections.totals['total_visits']
+
+        # حساب Bounce Rate (معدل الارتداد)
+        # الزيارات التي لها صفحة واحدة فقط
+        try:
+            single_page_visits = db.session.query(
+                Visit.ip_address
+            ).group_by(Visit.ip_address).having(db.func.count(Visit.id) == 1).count()
+
+            bounce_rate = (single_page_visits / total_visits * 100) if total_visits > 0 else 0
+        except Exception as e:
+            app.logger.error(f"Error calculating bounce rate: {e}")
+            bounce_rate = 0
+
+        # مصادر الزيارات (مصنفة عند التسجيل: GROUP BY على عمود مفهرس)
+        source_counts = traffic_source_counts()
+        organic_visits = source_counts['organic']
+
+        # حساب CTR (Click-Through Rate) - نفترض قيمة تقديرية
+        ctr = 15.5  # نسبة تقديرية - يمكن تحسينها لاحقاً
+
+        # حساب Direct & Referral Traffic
+        direct_visits = source_counts['direct']
+        referral_visits = source_counts['referral'] + source_counts['social']
+
+        # Core Web Vitals (تقديرات)
+        estimated_lcp = 2.1  # Largest Contentful Paint in seconds
+        estimated_fid = 80   # First Input Delay in ms
+        estimated_cls = 0.08  # Cumulative Layout Shift
+
+        return {
+            'bounce_rate': bounce_rate,
+            'bounce_rate_status': "ممتاز" if bounce_rate < 40 else "جيد" if bounce_rate < 60 else "يحتاج تحسين",
+            'organic_visits': organic_visits,
+            'organic_visits_month': traffic_source_counts(since=month_ago)['organic'],
+            'organic_percentage': (organic_visits / total_visits * 100) if total_visits > 0 else 0,
+            'ctr': ctr,
+            'ctr_status': "جيد" if ctr >= 20 else "متوسط" if ctr >= 14 else "يحتاج تحسين",
+            # حساب Indexed Pages (الصفحات المفهرسة): الأفكار + الصفحات الثابتة
+            'indexed_pages': sections.totals['total_ideas'] + 5,
+            'direct_visits': direct_visits,
+            'referral_visits': referral_visits,
+            'direct_percentage': (direct_visits / total_visits * 100) if total_visits > 0 else 0,
+            'referral_percentage': (referral_visits / total_visits * 100) if total_visits > 0 else 0,
+            'estimated_lcp': estimated_lcp,
+            'estimated_fid': estimated_fid,
+            'estimated_cls': estimated_cls,
+            'lcp_status': "جيد" if estimated_lcp < 2.5 else "يحتاج تحسين",
+            'fid_status': "جيد" if estimated_fid < 100 else "يحتاج تحسين",
+            'cls_status': "جيد" if estimated_cls < 0.1 else "يحتاج تحسين",
+            # Conversion Rate & Session Stats (تقديرات)
+            'conversion_rate': 3.5,  # نسبة تحويل المستخدمين لمشاركين
+            'avg_session_duration': 4.2,  # متوسط مدة الجلسة بالدقائق
+            'avg_pages_per_session': 2.8,  # متوسط الصفحات لكل جلسة
+        }
+
+    sections = PageSections(totals=load_totals, visit_periods=load_visit_periods, breakdowns=load_breakdowns,
+                            visit_log=load_visit_log, seo=load_seo)
+    return stream_page('dashboard.html', sections=sections, visit_filters=visit_filters)
+
+PROFILE_IDEAS_PER_PAGE = 10
+# الحد الأعلى لاستعلامات SQL في صفحة البروفايل مهما كان عدد أفكار المستخدم وتعليقاته
+# (المستخدم الحالي + صاحب البروفايل + العدادات + صفحة الأفكار + تسجيل الزيارة + الرسم اليومي لصاحبه)؛
+# يتحقق منه tests/test_profile_queries.py
+PROFILE_QUERY_BUDGET = 7
+
+def load_profile_page(user, cursor=None, per_page=PROFILE_IDEAS_PER_PAGE):
+    """بيانات صفحة البروفايل في استعلامين: العدادات المجمعة ثم صفحة من الأفكار مع عدد تعليقات كل فكرة
+
+    الترقيم keyset على (created_at, id) مثل التعليقات. صاحب البروفايل يرى عدد كل التعليقات
+    على أفكاره، والآخرون يرون عدد المنشورة فقط (كما في صفحة الفكرة).
+    يعيد (عدد الأفكار، عدد التعليقات، [(فكرة، عدد تعليقاتها)]، cursor الصفحة التالية أو None).
+    """
+    ideas_total = db.session.query(db.func.count(Idea.id)).filter(Idea.user_id == user.id).scalar_subquery()
+    comments_total = db.session.query(db.func.count(Comment.id)).filter(Comment.user_id == user.id).scalar_subquery()
+    idea_count, comment_count = db.session.query(ideas_total, comments_total).one()
+
+    # عدد التعليقات لكل فكرة كاستعلام فرعي مرتبط (يستخدم ix_comment_idea_published_created)
+    comments_count = db.session.query(db.func.count(Comment.id)).filter(Comment.idea_id == Idea.id)
+    if not (current_user.is_authenticated and current_user.id == user.id):
+        comments_count = comments_count.filter(Comment.is_published.is_(True))
+    comments_count = comments_count.correlate(Idea).scalar_subquery()
+
+    query = db.session.query(Idea, comments_count).filter(Idea.user_id == user.id)
+    if cursor:
+        last_created_at, last_id = decode_time_cursor(cursor)
+        query = query.filter(db.or_(
+            Idea.created_at < last_created_at,
+            db.and_(Idea.created_at == last_created_at, Idea.id < last_id)
+        ))
+    ideas = query.order_by(Idea.created_at.desc(), Idea.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(ideas) > per_page:
+        ideas = ideas[:per_page]
+        next_cursor = encode_cursor([ideas[-1][0].created_at, ideas[-1][0].id])
+    return idea_count, comment_count, ideas, next_cursor
+
+def render_profile(user):
+    cursor = request.args.get('cursor')
     try:
-        return render_template('dashboard.html',
-                         total_users=total_users,
-                         total_ideas=total_ideas,
-                         total_comments=total_comments,
-                         total_visits=total_visits,
-                         visits_today=visits_today,
-                         visits_this_week=visits_this_week,
-                         visits_this_month=visits_this_month,
-                         browser_stats=browser_stats,
-                         device_stats=device_stats,
-                         recent_visits=recent_visits,
-                         visits_pagination=visits_pagination,
-                         popular_pages=popular_pages,
-                         unique_ips=unique_ips,
-                         new_users_month=new_users_month,
-                         new_ideas_month=new_ideas_month,
-                         bounce_rate=bounce_rate,
-                         bounce_rate_status=bounce_rate_status,
-                         organic_visits=organic_visits,
-                         organic_visits_month=organic_visits_month,
-                         organic_percentage=organic_percentage,
-                         ctr=ctr,
-                         ctr_status=ctr_status,
-                         indexed_pages=indexed_pages,
-                         direct_visits=direct_visits,
-                         referral_visits=referral_visits,
-                         direct_percentage=direct_percentage,
-                         referral_percentage=referral_percentage,
-                         estimated_lcp=estimated_lcp,
-                         estimated_fid=estimated_fid,
-                         estimated_cls=estimated_cls,
-                         lcp_status=lcp_status,
-                         fid_status=fid_status,
-                         cls_status=cls_status,
-                         conversion_rate=conversion_rate,
-                         avg_session_duration=avg_session_duration,
-                         avg_pages_per_session=avg_pages_per_session)
-    except Exception as e:
-        app.logger.error(f"Error rendering dashboard: {e}", exc_info=True)
-        flash('حدث خطأ في تحميل لوحة التحكم. يرجى المحاولة مرة أخرى.', 'danger')
-        return redirect(url_for('home'))
+        idea_count, comment_count, ideas, next_cursor = load_profile_page(user, cursor)
+    except CursorError as e:
+        # cursor تالف: العودة إلى الصفحة الأولى من أفكار المستخدم
+        flash(str(e), 'danger')
+        return redirect(request.path)
+    # رسم مشاهدات جميع الأفكار لصاحب البروفايل فقط
+    daily_stats = None
+    if current_user.is_authenticated and current_user.id == user.id:
+        daily_stats = load_daily_stats(IdeaDailyStat.user_id, user.id)
+    return render_template('profile.html', user=user, ideas=ideas,
+                           idea_count=idea_count, comment_count=comment_count,
+                           is_first_page=not cursor, next_cursor=next_cursor, daily_stats=daily_stats)
 
 @app.route('/profile')
 @login_required
 def profile():
-    user = current_user
-    user_ideas = Idea.query.filter_by(user_id=user.id).order_by(Idea.created_at.desc()).all()
-    return render_template('profile.html', user=user, ideas=user_ideas)
+    return render_profile(current_user)
 
 @app.route('/user/<int:user_id>')
 def user_profile(user_id):
     """عرض بروفايل أي مستخدم"""
     user = User.query.get_or_404(user_id)
-    user_ideas = Idea.query.filter_by(user_id=user.id).order_by(Idea.created_at.desc()).all()
-    return render_template('profile.html', user=user, ideas=user_ideas)
+    return render_profile(user)
 
 @app.route('/profile/edit', methods=['GET', 'POST'])
 @login_required
@@ -917,8 +3535,8 @@ def edit_profile():
                 file_path = os.path.join(upload_path, unique_filename)
                 file.save(file_path)
                 
-                # ضغط الصورة لتحسين الأداء
-                compress_image(file_path, max_size=(800, 800), quality=85)
+                # ضغط الصورة لتحسين الأداء (في الخلفية بواسطة flask worker)
+                enqueue_job('compress_image', {'path': file_path, 'max_size': [800, 800], 'quality': 85})
                 
                 user.profile_picture = unique_filename
         
@@ -951,7 +3569,12 @@ def admin_users():
             'visits_count': visits_count
         })
     
-    return render_template('admin_users.html', users_data=users_data)
+    # عمليات الحذف الجارية والأخيرة
+    deletions = UserDeletion.query.order_by(UserDeletion.created_at.desc()).limit(10).all()
+    deleting_user_ids = {d.user_id for d in deletions if d.status in ('pending', 'running')}
+
+    return render_template('admin_users.html', users_data=users_data,
+                           deletions=deletions, deleting_user_ids=deleting_user_ids)
 
 @app.route('/admin/users/<int:user_id>/toggle-admin', methods=['POST'])
 @login_required
@@ -996,7 +3619,7 @@ def edit_user(user_id):
         # تحديث كلمة المرور إذا تم إدخالها
         new_password = request.form.get('password', '')
         if new_password:
-            user.password = generate_password_hash(new_password)
+            user.password = password_hasher.hash(new_password)
         
         # تحديث صلاحيات الأدمن
         is_admin = request.form.get('is_admin') == 'on'
@@ -1060,7 +3683,7 @@ def add_user():
             return redirect(url_for('add_user'))
         
         # إنشاء المستخدم الجديد
-        hashed_password = generate_password_hash(password)
+        hashed_password = password_hasher.hash(password)
         new_user = User(
             username=username,
             email=email,
@@ -1105,26 +3728,161 @@ def delete_user(user_id):
         return redirect(url_for('admin_users'))
     
     user = User.query.get_or_404(user_id)
-    username = user.username
-    
-    # حذف جميع الأفكار والتعليقات والزيارات المرتبطة بالمستخدم
-    Idea.query.filter_by(user_id=user.id).delete()
-    Comment.query.filter_by(user_id=user.id).delete()
-    Visit.query.filter_by(user_id=user.id).delete()
-    
-    # حذف الصورة الشخصية إن وجدت
-    if user.profile_picture:
-        old_file_path = os.path.join(app.config['UPLOAD_FOLDER'], user.profile_picture)
-        if os.path.exists(old_file_path):
-            os.remove(old_file_path)
-    
-    # حذف المستخدم
-    db.session.delete(user)
-    db.session.commit()
-    
-    flash(f'تم حذف المستخدم {username} بنجاح!', 'success')
+
+    if UserDeletion.query.filter(UserDeletion.user_id == user.id, UserDeletion.status.in_(['pending', 'running'])).first():
+        flash(f'حذف المستخدم {user.username} قيد التنفيذ بالفعل', 'info')
+        return redirect(url_for('admin_users'))
+
+    # الحذف يتم على دفعات في الخلفية حتى لا يُحجز الطلب ولا تُقفل الجداول
+    start_user_deletion(user)
+
+    flash(f'بدأ حذف المستخدم {user.username} وجميع بياناته في الخلفية', 'success')
     return redirect(url_for('admin_users'))
 
+@app.route('/admin/jobs')
+@login_required
+def admin_jobs():
+    """حالة طوابير المهام الخلفية"""
+    if not current_user.is_admin:
+        flash('ليس لديك صلاحية للوصول إلى هذه الصفحة', 'danger')
+        return redirect(url_for('home'))
+
+    now = datetime.utcnow()
+    # عدد المهام لكل طابور وحالة
+    counts = db.session.query(Job.queue, Job.status, db.func.count(Job.id))\
+        .group_by(Job.queue, Job.status).all()
+    queues = {name: {'queued': 0, 'running': 0, 'done': 0, 'failed': 0, 'oldest_wait': None, 'avg_latency': None}
+              for name in JOB_QUEUE_CONCURRENCY}
+    for queue, status, count in counts:
+        queues.setdefault(queue, {'queued': 0, 'running': 0, 'done': 0, 'failed': 0, 'oldest_wait': None, 'avg_latency': None})
+        queues[queue][status] = count
+
+    # أقدم مهمة مستحقة تنتظر في كل طابور
+    oldest = db.session.query(Job.queue, db.func.min(Job.run_at))\
+        .filter(Job.status == 'queued', Job.run_at <= now).group_by(Job.queue).all()
+    for queue, run_at in oldest:
+        queues[queue]['oldest_wait'] = (now - run_at).total_seconds()
+
+    # متوسط زمن الانتظار (من الاستحقاق حتى البدء) لآخر 200 مهمة منتهية
+    recent_done = Job.query.filter(Job.status == 'done', Job.started_at.isnot(None))\
+        .order_by(Job.finished_at.desc()).limit(200).all()
+    latencies = {}
+    for job in recent_done:
+        latencies.setdefault(job.queue, []).append((job.started_at - job.run_at).total_seconds())
+    for queue, values in latencies.items():
+        queues[queue]['avg_latency'] = sum(values) / len(values)
+
+    recent_jobs = Job.query.order_by(Job.id.desc()).limit(50).all()
+    return render_template('admin_jobs.html', queues=queues, recent_jobs=recent_jobs,
+                           concurrency=JOB_QUEUE_CONCURRENCY)
+
+@app.route('/admin/duplicates')
+@login_required
+def admin_duplicates():
+    """مجموعات الأفكار المتشابهة (آخر تشغيل لمهمة cluster_duplicate_ideas)"""
+    if not current_user.is_admin:
+        flash('ليس لديك صلاحية للوصول إلى هذه الصفحة', 'danger')
+        return redirect(url_for('home'))
+
+    clusters = DuplicateCluster.query.order_by(DuplicateCluster.similarity.desc()).limit(100).all()
+    idea_ids = {idea_id for cluster in clusters for idea_id in cluster.idea_ids}
+    ideas = {idea.id: idea for idea in Idea.query.options(db.joinedload(Idea.author)).filter(Idea.id.in_(idea_ids))}
+    groups = []
+    for cluster in clusters:
+        members = [ideas[idea_id] for idea_id in cluster.idea_ids if idea_id in ideas]
+        # الأفكار المحذوفة بعد آخر تجميع لا تُعرض
+        if len(members) > 1:
+            groups.append((cluster, members))
+    pending = Job.query.filter(Job.name == 'cluster_duplicate_ideas', Job.status.in_(['queued', 'running'])).count()
+    return render_template('admin_duplicates.html', groups=groups, pending=pending, threshold=DUPLICATE_THRESHOLD)
+
+@app.route('/admin/duplicates/refresh', methods=['POST'])
+@login_required
+def refresh_duplicates():
+    """جدولة إعادة تجميع الأفكار المتشابهة الآن"""
+    if not current_user.is_admin:
+        flash('ليس لديك صلاحية لتنفيذ هذا الإجراء', 'danger')
+        return redirect(url_for('home'))
+    enqueue_job('cluster_duplicate_ideas')
+    db.session.commit()
+    flash('تمت جدولة تجميع الأفكار المتشابهة، حدّث الصفحة بعد قليل', 'info')
+    return redirect(url_for('admin_duplicates'))
+
+@app.route('/admin/ingress-stats')
+@login_required
+def admin_ingress_stats():
+    """عدادات فلتر الطلبات في هذا العامل (JSON)"""
+    if not current_user.is_admin:
+        return {'error': 'forbidden'}, 403
+    with _ingress_counters_lock:
+        counters = dict(ingress_counters)
+    counters['backend'] = type(rate_limiter).__name__
+    counters['worker_pid'] = os.getpid()
+    return counters
+
+@app.route('/admin/compression-stats')
+@login_required
+def admin_compression_stats():
+    """عدادات ضغط الاستجابات في هذا العامل (JSON)"""
+    if not current_user.is_admin:
+        return {'error': 'forbidden'}, 403
+    with _compression_stats_lock:
+        stats = dict(compression_stats)
+    stats['ratio'] = round(stats['bytes_out'] / stats['bytes_in'], 3) if stats['bytes_in'] else None
+    stats['brotli'] = brotli is not None
+    stats['cache_bytes'] = compressed_bodies.size
+    stats['worker_pid'] = os.getpid()
+    return stats
+
+@app.route('/admin/render-stats')
+@login_required
+def admin_render_stats():
+    """متوسط زمن أول بايت والزمن الكلي للصفحات المتدفقة والكاملة في هذا العامل (JSON)"""
+    if not current_user.is_admin:
+        return {'error': 'forbidden'}, 403
+    pages = {
+        key: {
+            'count': stats['count'],
+            'avg_ttfb_ms': round(stats['ttfb_ms'] / stats['count'], 2),
+            'avg_total_ms': round(stats['total_ms'] / stats['count'], 2),
+        }
+        for key, stats in page_timing_stats.items()
+    }
+    return {'pages': pages, 'streaming': app.config['STREAM_RENDERING'], 'worker_pid': os.getpid()}
+
+@app.route('/admin/export/<kind>')
+@login_required
+def admin_export(kind):
+    """تصدير متدفق للزيارات/الأفكار/التعليقات/المستخدمين"""
+    if not current_user.is_admin:
+        flash('ليس لديك صلاحية للوصول إلى هذه الصفحة', 'danger')
+        return redirect(url_for('home'))
+
+    fmt = request.args.get('format', 'csv')
+    if kind not in EXPORT_MODELS or fmt not in EXPORT_FORMATS:
+        return 'نوع أو صيغة تصدير غير مدعومة', 400
+    try:
+        fields = parse_export_fields(kind, request.args.get('fields'))
+        start = parse_export_date(request.args.get('start'))
+        end = parse_export_date(request.args.get('end'))
+    except ValueError as e:
+        return str(e), 400
+
+    use_gzip = request.args.get('gzip', '1') != '0'
+    chunks = iter_export(kind, fields, fmt, start, end)
+    filename = f'{kind}-{datetime.utcnow().strftime("%Y%m%d%H%M%S")}.{fmt}'
+    if use_gzip:
+        body = gzip_chunks(chunks)
+        mimetype = 'application/gzip'
+        filename += '.gz'
+    else:
+        body = (chunk.encode('utf-8') for chunk in chunks)
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
 @app.after_request
 def add_cache_control_headers(response):
     """إضافة Cache-Control headers للموارد الثابتة"""
@@ -1179,6 +3937,12 @@ def sitemap():
                 'changefreq': 'daily',
                 'priority': '0.8'
             },
+            {
+                'loc': f'{base_url}/trending',
+                'lastmod': datetime.utcnow().strftime('%Y-%m-%d'),
+                'changefreq': 'hourly',
+                'priority': '0.8'
+            },
             {
                 'loc': f'{base_url}/most-commented',
                 'lastmod': datetime.utcnow().strftime('%Y-%m-%d'),
@@ -1238,6 +4002,7 @@ Allow: /
 Disallow: /dashboard
 Disallow: /admin/
 Disallow: /profile/edit
+Disallow: /moderation
 Disallow: /login
 Disallow: /register
 Disallow: /static/uploads/
@@ -1247,6 +4012,243 @@ Sitemap: {base_url}/sitemap.xml
     return Response(robots_content, mimetype='text/plain')
 
 
+@app.route('/dashboard/live')
+@login_required
+def dashboard_live():
+    """بث عدادات الزيارات الحية (Server-Sent Events) من ذاكرة العمال بدون استعلامات"""
+    if not current_user.is_admin:
+        return Response(status=403)
+
+    def stream():
+        # المتصفح يعيد الاتصال بعد ثانية عند إغلاق البث
+        yield 'retry: 1000\n\n'
+        deadline = time.monotonic() + LIVE_STREAM_MAX_SECONDS
+        last_payload = None
+        while time.monotonic() < deadline:
+            payload = json.dumps(live_traffic.snapshot(), ensure_ascii=False, separators=(',', ':'))
+            # البيانات تُرسل عند تغيرها فقط، وإلا تعليق keep-alive من بايتين
+            yield f'data: {payload}\n\n' if payload != last_payload else ':\n\n'
+            last_payload = payload
+            time.sleep(LIVE_STREAM_INTERVAL)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# مخزن تحليلات عمودي للزيارات على القرص المحلي
+# الزيارات تُصدَّر دورياً (بعد آخر id مُصدَّر) إلى ملفات segments عمودية في ANALYTICS_DIR:
+# كل عمود نصي مُرمَّز بقاموس (array من أرقام صحيحة) ومضغوط بـ zlib، ويُقرأ فقط العمود المطلوب.
+# الاستعلامات تجمع بـ Counter على أعمدة الأرقام (حلقة C) ثم تفك القاموس للمفاتيح الناتجة فقط،
+# ولا تلمس قاعدة البيانات. الحذف اللاحق لزيارات مستخدم لا يُطبق على segments (لا تحتوي IP ولا user_id).
+ANALYTICS_SEGMENT_MAGIC = b'VSEG1\n'
+ANALYTICS_EXPORT_BATCH = 50000
+ANALYTICS_SEGMENT_ROWS = int(os.environ.get('ANALYTICS_SEGMENT_ROWS', 1000000))  # حجم الـ segment بعد الدمج
+ANALYTICS_COMPACT_MIN_SEGMENTS = 8
+ANALYTICS_DICT_COLUMNS = ('page_path', 'browser', 'device_type', 'traffic_source', 'referrer_host')
+# الأبعاد المتاحة للتجميع: العمود المخزن ودالة تحويل القيمة بعد التجميع
+ANALYTICS_EPOCH = datetime(1970, 1, 1)
+ANALYTICS_DIMENSIONS = {
+    'page_path': ('page_path', None),
+    'browser': ('browser', None),
+    'device_type': ('device_type', None),
+    'traffic_source': ('traffic_source', None),
+    'referrer_host': ('referrer_host', None),
+    'member': ('member', lambda value: 'مسجل' if value else 'زائر'),
+    'day': ('day', lambda value: (ANALYTICS_EPOCH + timedelta(days=value)).strftime('%Y-%m-%d')),
+    # الأسبوع يبدأ يوم الاثنين (1970-01-01 كان خميساً)
+    'week': ('day', lambda value: (ANALYTICS_EPOCH + timedelta(days=value - (value + 3) % 7)).strftime('%Y-%m-%d')),
+    'month': ('day', lambda value: (ANALYTICS_EPOCH + timedelta(days=value)).strftime('%Y-%m')),
+}
+
+def analytics_day(when):
+    return (when - ANALYTICS_EPOCH).days
+
+class VisitSegmentStore:
+    """ملفات segments عمودية للزيارات مع manifest (آخر id مُصدَّر وقائمة الملفات)"""
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.manifest_file = os.path.join(state_dir, 'manifest.json')
+
+    def manifest(self):
+        try:
+            with open(self.manifest_file, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'last_visit_id': 0, 'segments': []}
+
+    def _write_manifest(self, manifest):
+        tmp_path = f'{self.manifest_file}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_file)
+
+    def write_segment(self, rows):
+        """كتابة segment من صفوف (day, member, page_path, ...) مرتبة باليوم، وإرجاع اسم الملف"""
+        rows.sort(key=lambda row: row[0])
+        columns = {'day': array('i', (row[0] for row in rows)), 'member': array('B', (row[1] for row in rows))}
+        dictionaries = {}
+        for index, name in enumerate(ANALYTICS_DICT_COLUMNS, start=2):
+            codes = {}
+            columns[name] = array('I', (codes.setdefault(row[index], len(codes)) for row in rows))
+            dictionaries[name] = list(codes)
+        blobs, header_columns, offset = [], {}, 0
+        for name, values in columns.items():
+            blob = zlib.compress(values.tobytes(), 1)
+            header_columns[name] = {'typecode': values.typecode, 'offset': offset, 'length': len(blob),
+                                    'dictionary': dictionaries.get(name)}
+            blobs.append(blob)
+            offset += len(blob)
+        header = json.dumps({'rows': len(rows), 'min_day': columns['day'][0], 'max_day': columns['day'][-1],
+                             'columns': header_columns}, ensure_ascii=False).encode('utf-8')
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        name = f'{datetime.utcnow():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}.seg'
+        path = os.path.join(self.state_dir, name)
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(ANALYTICS_SEGMENT_MAGIC + len(header).to_bytes(4, 'little') + header)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(f'{path}.tmp', path)
+        return name
+
+    def read_segment(self, name, column_names):
+        """قراءة header الـ segment والأعمدة المطلوبة فقط"""
+        with open(os.path.join(self.state_dir, name), 'rb') as f:
+            if f.read(len(ANALYTICS_SEGMENT_MAGIC)) != ANALYTICS_SEGMENT_MAGIC:
+                raise ValueError(f'ملف segment غير صالح: {name}')
+            header = json.loads(f.read(int.from_bytes(f.read(4), 'little')))
+            data_start = f.tell()
+            columns = {}
+            for column_name in column_names:
+                meta = header['columns'][column_name]
+                f.seek(data_start + meta['offset'])
+                values = array(meta['typecode'])
+                values.frombytes(zlib.decompress(f.read(meta['length'])))
+                columns[column_name] = values
+        return header, columns
+
+    def export_new_visits(self):
+        """تصدير الزيارات الجديدة (بعد آخر id) إلى segments بحجم ANALYTICS_EXPORT_BATCH صف"""
+        manifest = self.manifest()
+        exported = 0
+        while True:
+            batch = db.session.query(
+                Visit.id, Visit.created_at, Visit.user_id, Visit.page_path, Visit.browser,
+                Visit.device_type, Visit.traffic_source, Visit.referrer_host
+            ).filter(Visit.id > manifest['last_visit_id']).order_by(Visit.id).limit(ANALYTICS_EXPORT_BATCH).all()
+            if not batch:
+                return exported
+            rows = [(analytics_day(created_at), int(user_id is not None), *dims)
+                    for _, created_at, user_id, *dims in batch]
+            manifest['segments'].append(self.write_segment(rows))
+            manifest['last_visit_id'] = batch[-1][0]
+            self._write_manifest(manifest)
+            exported += len(batch)
+            job_heartbeat()
+
+    def compact(self):
+        """دمج الـ segments الصغيرة المتتالية في segments بحجم ANALYTICS_SEGMENT_ROWS"""
+        manifest = self.manifest()
+        small = []
+        for name in manifest['segments']:
+            header, _ = self.read_segment(name, [])
+            if header['rows'] < ANALYTICS_SEGMENT_ROWS:
+                small.append((name, header['rows']))
+        if len(small) < ANALYTICS_COMPACT_MIN_SEGMENTS:
+            return 0
+
+        groups, group, group_rows = [], [], 0
+        for name, rows in small:
+            group.append(name)
+            group_rows += rows
+            if group_rows >= ANALYTICS_SEGMENT_ROWS:
+                groups.append(group)
+                group, group_rows = [], 0
+        if len(group) > 1:
+            groups.append(group)
+
+        merged = 0
+        for group in groups:
+            rows = []
+            for name in group:
+                header, columns = self.read_segment(name, ('day', 'member') + ANALYTICS_DICT_COLUMNS)
+                decoded = [columns['day'], columns['member']] + [
+                    [header['columns'][column]['dictionary'][code] for code in columns[column]]
+                    for column in ANALYTICS_DICT_COLUMNS
+                ]
+                rows.extend(zip(*decoded))
+            new_name = self.write_segment(rows)
+            segments = manifest['segments']
+            position = segments.index(group[0])
+            manifest['segments'] = segments[:position] + [new_name] + [s for s in segments[position:] if s not in group]
+            self._write_manifest(manifest)
+            # القراءات الجارية قد تحمل manifest قديماً: query يعيد المحاولة عند اختفاء ملف
+            for name in group:
+                os.remove(os.path.join(self.state_dir, name))
+            merged += len(group)
+            job_heartbeat()
+        return merged
+
+    def query(self, group_by, start=None, end=None, filters=None, limit=100):
+        """عدد الزيارات مجمعة حسب الأبعاد المطلوبة (start/end تواريخ شاملة، filters: {بعد: قيمة})"""
+        for attempt in range(2):
+            try:
+                return self._query(group_by, start, end, filters or {}, limit)
+            except FileNotFoundError:
+                if attempt:
+                    raise
+
+    def _query(self, group_by, start, end, filters, limit):
+        dimensions = list(group_by) + [name for name in filters if name not in group_by]
+        stored = list(dict.fromkeys(ANALYTICS_DIMENSIONS[name][0] for name in dimensions))
+        start_day = analytics_day(datetime.combine(start, datetime.min.time())) if start else None
+        end_day = analytics_day(datetime.combine(end, datetime.min.time())) if end else None
+
+        totals = Counter()
+        scanned = segments = 0
+        for name in self.manifest()['segments']:
+            header, _ = self.read_segment(name, [])
+            if (start_day is not None and header['max_day'] < start_day) or \
+                    (end_day is not None and header['min_day'] > end_day):
+                continue
+            header, columns = self.read_segment(name, set(stored) | {'day'})
+            # الصفوف مرتبة باليوم: نطاق التاريخ شريحة واحدة
+            days = columns['day']
+            lo = bisect_left(days, start_day) if start_day is not None else 0
+            hi = bisect_right(days, end_day) if end_day is not None else len(days)
+            if lo >= hi:
+                continue
+            sliced = [columns[column][lo:hi] for column in stored]
+            counts = Counter(sliced[0]) if len(sliced) == 1 else Counter(zip(*sliced))
+            # فك القاموس للمفاتيح الناتجة فقط (عددها صغير مقارنة بالصفوف)
+            decoders = [header['columns'][column]['dictionary'] for column in stored]
+            for key, count in counts.items():
+                key = (key,) if len(stored) == 1 else key
+                totals[tuple(values[code] if values is not None else code
+                             for values, code in zip(decoders, key))] += count
+            scanned += hi - lo
+            segments += 1
+
+        positions = {column: index for index, column in enumerate(stored)}
+        results = Counter()
+        for key, count in totals.items():
+            values = {}
+            for name in dimensions:
+                column, transform = ANALYTICS_DIMENSIONS[name]
+                value = key[positions[column]]
+                values[name] = transform(value) if transform else value
+            if all(str(values[name]) == str(value) for name, value in filters.items()):
+                results[tuple(values[name] for name in group_by)] += count
+        return {'rows': results.most_common(limit), 'groups': len(results), 'scanned': scanned, 'segments': segments}
+
+visit_segments = VisitSegmentStore(os.environ.get('ANALYTICS_DIR') or os.path.join(app.instance_path, 'analytics'))
+
+@job_handler('export_visit_segments', queue='maintenance', every=timedelta(minutes=15))
+def export_visit_segments_job():
+    """تصدير الزيارات الجديدة إلى مخزن التحليلات ثم دمج الـ segments الصغيرة"""
+    visit_segments.export_new_visits()
+    visit_segments.compact()
+
 @app.route('/dashboard/analytics')
 @login_required
 def dashboard_analytics():
@@ -1260,18 +4262,16 @@ def dashboard_analytics():
         month_ago = datetime.utcnow() - timedelta(days=30)
         unique_ips = db.session.query(db.func.count(db.func.distinct(Visit.ip_address))).scalar()
 
-        # الزيارات العضوية
-        search_engines = ['google', 'bing', 'yahoo', 'yandex', 'duckduckgo', 'baidu']
-        organic_visits = Visit.query.filter(
-            db.or_(*[Visit.referrer.like(f'%{engine}%') for engine in search_engines])
-        ).count()
+        # مصادر الزيارات (مصنفة عند التسجيل)
+        source_counts = traffic_source_counts()
+        organic_visits = source_counts['organic']
         
         # الصفحات الأكثر شعبية من محركات البحث
         organic_popular_pages = db.session.query(
             Visit.page_path,
             db.func.count(Visit.id).label('count')
         ).filter(
-            db.or_(*[Visit.referrer.like(f'%{engine}%') for engine in search_engines])
+            Visit.traffic_source == 'organic'
         ).group_by(Visit.page_path).order_by(db.func.count(Visit.id).desc()).limit(10).all()
 
         # معدل الارتداد - محسّن
@@ -1303,12 +4303,10 @@ def dashboard_analytics():
         
         organic_percentage = (organic_visits / total_visits * 100) if total_visits > 0 else 0
         
-        direct_visits = Visit.query.filter(
-            db.or_(Visit.referrer.is_(None), Visit.referrer == '')
-        ).count()
+        direct_visits = source_counts['direct']
         direct_percentage = (direct_visits / total_visits * 100) if total_visits > 0 else 0
         
-        referral_visits = total_visits - organic_visits - direct_visits
+        referral_visits = source_counts['referral'] + source_counts['social']
         referral_percentage = (referral_visits / total_visits * 100) if total_visits > 0 else 0
 
         # Core Web Vitals
@@ -1323,7 +4321,7 @@ def dashboard_analytics():
         ctr_status = "ممتاز" if ctr >= 20 else "جيد" if ctr >= 14 else "يحتاج تحسين"
         
         total_ideas = Idea.query.count()
-        indexed_pages = 4 + total_ideas
+        indexed_pages = 5 + total_ideas
 
         return render_template('dashboard_analytics.html',
                              organic_visits=organic_visits,
@@ -1348,6 +4346,7 @@ def dashboard_analytics():
                              ctr=ctr,
                              ctr_status=ctr_status,
                              total_visits=total_visits,
+                             source_counts=source_counts,
                              unique_ips=unique_ips)
 
     except Exception as e:
@@ -1355,6 +4354,40 @@ def dashboard_analytics():
         flash('حدث خطأ في تحميل الإحصائيات المتقدمة.', 'danger')
         return redirect(url_for('dashboard'))
 
+ANALYTICS_MAX_GROUP_BY = 3
+
+@app.route('/dashboard/analytics/query')
+@login_required
+def analytics_query():
+    """استعلامات تجميع حرة على مخزن التحليلات العمودي (بدون قاعدة البيانات)"""
+    if not current_user.is_admin:
+        flash('ليس لديك صلاحية للوصول إلى هذه الصفحة', 'danger')
+        return redirect(url_for('home'))
+
+    group_by = [name for name in request.args.getlist('group_by') if name in ANALYTICS_DIMENSIONS][:ANALYTICS_MAX_GROUP_BY]
+    try:
+        start = parse_export_date(request.args.get('start'))
+        end = parse_export_date(request.args.get('end'))
+    except ValueError:
+        flash('صيغة التاريخ غير صحيحة (YYYY-MM-DD)', 'danger')
+        start = end = None
+    filters = {}
+    filter_dimension = request.args.get('filter_dimension')
+    filter_value = request.args.get('filter_value', '').strip()
+    if filter_dimension in ANALYTICS_DIMENSIONS and filter_value:
+        filters[filter_dimension] = filter_value
+
+    result = elapsed_ms = None
+    if group_by:
+        started = time.perf_counter()
+        result = visit_segments.query(group_by, start=start and start.date(), end=end and end.date(), filters=filters)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+    manifest = visit_segments.manifest()
+    return render_template('analytics_query.html', dimensions=list(ANALYTICS_DIMENSIONS), group_by=group_by,
+                           result=result, elapsed_ms=elapsed_ms, manifest=manifest,
+                           max_group_by=ANALYTICS_MAX_GROUP_BY)
+
 # Route للتحقق من إعدادات Google OAuth (للتطوير فقط)
 @app.route('/debug/google-oauth')
 def debug_google_oauth():
@@ -1375,10 +4408,344 @@ def debug_google_oauth():
     from flask import jsonify
     return jsonify(info)
 
+def dispose_engines_after_fork():
+    """إسقاط اتصالات العملية الأم في العامل الجديد بعد fork (gunicorn --preload)"""
+    with app.app_context():
+        for engine in db.engines.values():
+            # close=False: الاتصالات ما زالت مستخدمة في العملية الأم، نتركها لها ونبدأ pool جديداً
+            engine.dispose(close=False)
+
+def create_app(config=None):
+    """نقطة دخول التطبيق: قراءة الإعدادات وربط قاعدة البيانات وتسجيل الدخول و Google OAuth
+
+    لا تُستدعى عند استيراد الملف؛ يستدعيها gunicorn (app:create_app()) وأوامر flask (FLASK_APP في
+    .flaskenv) والاختبارات. config يتجاوز إعدادات البيئة (مثل قاعدة بيانات مؤقتة للاختبارات).
+    المسارات مسجلة على كائن app واحد لكل عملية، لذلك الاستدعاءات التالية تعيده كما هو.
+    """
+    if 'sqlalchemy' in app.extensions:
+        return app
+    load_config(app)
+    if config:
+        app.config.update(config)
+    db.init_app(app)
+    login_manager.init_app(app)
+    init_google_oauth(app)
+    os.register_at_fork(after_in_child=dispose_engines_after_fork)
+    return app
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """إنشاء/تحديث الجداول والفهارس وملء البيانات المشتقة للسجلات القديمة"""
+    upgrade_schema()
+    click.echo(f'تم ربط {backfill_categories()} فكرة بجدول التصنيفات')
+    click.echo(f'تم حساب slug لـ {backfill_idea_slugs()} فكرة')
+    click.echo(f'تم حساب درجة الرواج لـ {backfill_trending_scores()} فكرة')
+    # تصنيف مصادر الزيارات القديمة قد يطول على الجداول الكبيرة، فيتم في الخلفية
+    if db.session.query(Visit.id).filter(Visit.traffic_source.is_(None)).first():
+        enqueue_job('backfill_visit_sources')
+        db.session.commit()
+        click.echo('تمت جدولة تصنيف مصادر الزيارات القديمة (flask worker)')
+    if not db.session.query(IdeaDailyStat.id).first() and db.session.query(Idea.id).first():
+        enqueue_job('backfill_idea_daily_stats')
+        db.session.commit()
+        click.echo('تمت جدولة ملء الإحصائيات اليومية للأفكار من سجل الزيارات (flask worker)')
+    if db.session.query(Idea.id).filter(Idea.minhash.is_(None)).first():
+        enqueue_job('backfill_idea_minhash')
+        db.session.commit()
+        click.echo('تمت جدولة فهرسة الأفكار القديمة لكشف التشابه (flask worker)')
+
+@app.cli.command('snapshot')
+@click.option('--idea', 'idea_ids', multiple=True, type=int, help='إعادة لقطات أفكار محددة فقط')
+def snapshot_command(idea_ids):
+    """بناء لقطات HTML الثابتة للصفحات العامة في SNAPSHOT_DIR"""
+    if idea_ids:
+        written = regenerate_snapshots(list(idea_ids))
+    else:
+        written = build_all_snapshots()
+    click.echo(f"تمت كتابة {written} لقطة في {app.config['SNAPSHOT_DIR']}")
+
+analytics_cli = click.Group('analytics', help='مخزن التحليلات العمودي للزيارات')
+app.cli.add_command(analytics_cli)
+
+@analytics_cli.command('export')
+def analytics_export_command():
+    """تصدير الزيارات الجديدة إلى segments ثم دمج الصغيرة منها"""
+    click.echo(f'تم تصدير {visit_segments.export_new_visits()} زيارة')
+    click.echo(f'تم دمج {visit_segments.compact()} segment')
+
+@analytics_cli.command('query')
+@click.argument('group_by', nargs=-1, required=True, type=click.Choice(list(ANALYTICS_DIMENSIONS)))
+@click.option('--start', default=None, help='من تاريخ (YYYY-MM-DD)')
+@click.option('--end', default=None, help='إلى تاريخ (YYYY-MM-DD)')
+@click.option('--limit', default=20)
+def analytics_query_command(group_by, start, end, limit):
+    """تجميع الزيارات حسب الأبعاد المطلوبة من الـ segments"""
+    started = time.perf_counter()
+    result = visit_segments.query(group_by, start=start and parse_export_date(start).date(),
+                                  end=end and parse_export_date(end).date(), limit=limit)
+    for key, count in result['rows']:
+        click.echo(f"{count:>10}  {' | '.join(str(value) for value in key)}")
+    click.echo(f"{result['scanned']} زيارة من {result['segments']} segment في {(time.perf_counter() - started) * 1000:.0f}ms")
+
+@app.cli.command('backfill-visit-sources')
+@click.option('--site-host', default=None, help='نطاق الموقع لتمييز الزيارات الداخلية (الافتراضي SERVER_NAME)')
+def backfill_visit_sources_command(site_host):
+    """تصنيف مصادر الزيارات القديمة مباشرة"""
+    click.echo(f'تم تصنيف {backfill_visit_sources(site_host)} زيارة')
+
+@app.cli.command('resume-deletions')
+def resume_deletions_command():
+    """استئناف عمليات حذف المستخدمين التي توقفت (مثلاً بسبب إعادة تشغيل العامل)"""
+    pending = UserDeletion.query.filter(UserDeletion.status.in_(['pending', 'running', 'failed'])).all()
+    for deletion in pending:
+        click.echo(f'استئناف حذف المستخدم {deletion.username}...')
+        try:
+            run_user_deletion(deletion.id)
+        except Exception as e:
+            click.echo(f'فشل: {e}', err=True)
+
+@app.cli.command('worker')
+@click.option('--queues', default='default,maintenance', help='الطوابير المطلوب تنفيذها مفصولة بفواصل')
+@click.option('--concurrency', default=2, help='عدد الخيوط المنفذة')
+@click.option('--once', is_flag=True, help='تنفيذ المهام المستحقة الآن ثم الخروج')
+def worker_command(queues, concurrency, once):
+    """تشغيل عامل المهام الخلفية"""
+    queues = [q.strip() for q in queues.split(',') if q.strip()]
+    worker_name = f'{socket.gethostname()}:{os.getpid()}'
+    requeued = requeue_stale_jobs(worker_name)
+    if requeued:
+        click.echo(f'أعيدت {requeued} مهمة متروكة إلى الطابور')
+    ensure_periodic_jobs()
+    db.session.remove()
+
+    stop_event = threading.Event()
+    threads = [
+        threading.Thread(target=run_worker_loop, args=(queues, f'{worker_name}:{i}', stop_event, once), daemon=True)
+        for i in range(concurrency)
+    ]
+    click.echo(f'العامل {worker_name} يعمل على الطوابير: {", ".join(queues)}')
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1)
+    except KeyboardInterrupt:
+        click.echo('إيقاف العامل...')
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+@app.cli.command('export')
+@click.argument('kind', type=click.Choice(list(EXPORT_MODELS)))
+@click.option('--format', 'fmt', type=click.Choice(EXPORT_FORMATS), default='csv')
+@click.option('--fields', default=None, help='حقول مفصولة بفواصل')
+@click.option('--start', default=None, help='من تاريخ (YYYY-MM-DD)')
+@click.option('--end', default=None, help='حتى تاريخ (غير شامل)')
+@click.option('--output', '-o', type=click.Path(), required=True, help='ملف الإخراج (- للإخراج القياسي)')
+@click.option('--gzip/--no-gzip', 'use_gzip', default=True)
+def export_command(kind, fmt, fields, start, end, output, use_gzip):
+    """تصدير جدول إلى CSV/JSONL بذاكرة ثابتة"""
+    try:
+        fields = parse_export_fields(kind, fields)
+        chunks = iter_export(kind, fields, fmt, parse_export_date(start), parse_export_date(end))
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    body = gzip_chunks(chunks) if use_gzip else (chunk.encode('utf-8') for chunk in chunks)
+    with click.open_file(output, 'wb') as f:
+        for data in body:
+            f.write(data)
+
+bench_cli = click.Group('bench', help='قياس أداء أجزاء التطبيق')
+app.cli.add_command(bench_cli)
+
+@bench_cli.command('render')
+@click.option('--iterations', default=50, help='عدد مرات العرض لكل صفحة')
+def bench_render_command(iterations):
+    """قياس زمن عرض صفحة الفكرة وصفحات القوائم"""
+    idea = Idea.query.order_by(Idea.views.desc()).first()
+    paths = ['/latest', '/most-viewed', '/most-commented']
+    if idea:
+        paths.append(f'/idea/{idea.id}/{idea.get_slug()}')
+    # القياس يرسل طلبات كثيرة من نفس العنوان
+    app.config['RATE_LIMIT_ENABLED'] = False
+    client = app.test_client()
+    template_render_stats.clear()
+    for path in paths:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            client.get(path)
+        elapsed_ms = (time.perf_counter() - started) * 1000 / iterations
+        click.echo(f'{path}: {elapsed_ms:.2f}ms للطلب')
+    for name, stats in sorted(template_render_stats.items()):
+        click.echo(f"  {name}: متوسط {stats['total_ms'] / stats['count']:.2f}ms، أقصى {stats['max_ms']:.2f}ms")
+
+@bench_cli.command('ttfb')
+@click.option('--iterations', default=10, help='عدد الطلبات لكل صفحة ووضع')
+def bench_ttfb_command(iterations):
+    """مقارنة زمن أول بايت والزمن الكلي للوحة التحكم وصفحة الفكرة بين العرض الكامل والمتدفق"""
+    admin = User.query.filter_by(is_admin=True).first()
+    idea = Idea.query.order_by(Idea.views.desc()).first()
+    pages = []
+    if admin:
+        pages.append(('/dashboard', admin))
+    if idea:
+        pages.append((f'/idea/{idea.id}/{idea.get_slug()}', idea.author))
+    if not pages:
+        raise click.ClickException('لا توجد بيانات للقياس')
+    app.config['RATE_LIMIT_ENABLED'] = False
+    streaming = app.config['STREAM_RENDERING']
+    try:
+        for path, user in pages:
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['_user_id'] = str(user.id)
+                sess['_fresh'] = True
+            for mode, enabled in (('buffered', False), ('streamed', True)):
+                app.config['STREAM_RENDERING'] = enabled
+                ttfb_ms = total_ms = 0.0
+                for _ in range(iterations):
+                    started = time.perf_counter()
+                    response = client.get(path, buffered=False)
+                    chunks = iter(response.response)
+                    next(chunks, None)
+                    ttfb_ms += (time.perf_counter() - started) * 1000
+                    for _ in chunks:
+                        pass
+                    response.close()
+                    total_ms += (time.perf_counter() - started) * 1000
+                click.echo(f'{path} [{mode}]: أول بايت {ttfb_ms / iterations:.1f}ms، الكل {total_ms / iterations:.1f}ms')
+    finally:
+        app.config['STREAM_RENDERING'] = streaming
+
+@bench_cli.command('compression')
+@click.option('--iterations', default=20, help='عدد الطلبات لكل صفحة وترميز')
+def bench_compression_command(iterations):
+    """مقارنة حجم وزمن الصفحات الكبيرة بدون ضغط ومع gzip و brotli"""
+    idea = Idea.query.order_by(Idea.views.desc()).first()
+    paths = ['/latest', '/sitemap.xml']
+    if idea:
+        paths.insert(0, f'/idea/{idea.id}/{idea.get_slug()}')
+    app.config['RATE_LIMIT_ENABLED'] = False
+    client = app.test_client()
+    encodings = ['identity', 'gzip'] + (['br'] if brotli is not None else [])
+    for path in paths:
+        for encoding in encodings:
+            started = time.perf_counter()
+            for _ in range(iterations):
+                response = client.get(path, headers={'Accept-Encoding': encoding})
+                size = len(response.get_data())
+            elapsed_ms = (time.perf_counter() - started) * 1000 / iterations
+            click.echo(f'{path} [{encoding}]: {size / 1024:.1f}KB، {elapsed_ms:.2f}ms للطلب')
+    click.echo(f'الكاش: {compression_stats["cache_hits"]} إصابة، {compressed_bodies.size / 1024:.0f}KB')
+
+@bench_cli.command('listings')
+@click.option('--iterations', default=20, help='عدد مرات التحميل لكل طريقة')
+def bench_listings_command(iterations):
+    """مقارنة تحميل قائمة الأفكار كبطاقات IdeaCard مقابل كائنات ORM (الزمن وذروة الذاكرة)"""
+    import tracemalloc
+
+    def load_orm():
+        ideas = Idea.query.options(db.joinedload(Idea.author)).order_by(Idea.views.desc()).limit(LISTING_LIMIT).all()
+        # ما كانت القوالب تقرؤه: الكاتب وعدد التعليقات (تحميل كسول لكل فكرة)
+        return [(idea.author.username, len(idea.comments), idea.description[:IDEA_CARD_EXCERPT]) for idea in ideas]
+
+    def load_cards():
+        return [(card.author_name, card.comment_count, card.description) for card in listing_cards(Idea.views.desc())]
+
+    for label, loader in (('ORM', load_orm), ('IdeaCard', load_cards)):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            loader()
+            db.session.expunge_all()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / iterations
+        tracemalloc.start()
+        loader()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        db.session.expunge_all()
+        click.echo(f'{label}: {elapsed_ms:.2f}ms، ذروة الذاكرة {peak / 1024:.0f}KB')
+
+@bench_cli.command('analytics')
+@click.option('--rows', default=5000000, help='عدد الزيارات الاصطناعية')
+def bench_analytics_command(rows):
+    """قياس استعلامات التجميع على segments اصطناعية (في مجلد مؤقت، دون قاعدة البيانات)"""
+    import tempfile
+    store = VisitSegmentStore(tempfile.mkdtemp(prefix='visit-segments-'))
+    rng = random.Random(42)
+    pages = ['/', '/latest', '/most-viewed', '/trending'] + [f'/idea/{i}' for i in range(5000)]
+    browsers, devices = ['Chrome', 'Firefox', 'Safari', 'Edge', 'Opera'], ['Mobile', 'Desktop', 'Tablet']
+    sources = ['direct', 'organic', 'social', 'referral', 'internal']
+    hosts = [None, 'google.com', 'bing.com', 'facebook.com', 't.co', 'example.com']
+    today = analytics_day(datetime.utcnow())
+    manifest = store.manifest()
+    started = time.perf_counter()
+    for offset in range(0, rows, ANALYTICS_SEGMENT_ROWS):
+        count = min(ANALYTICS_SEGMENT_ROWS, rows - offset)
+        manifest['segments'].append(store.write_segment([
+            (today - rng.randrange(365), rng.random() < 0.2, rng.choice(pages), rng.choice(browsers),
+             rng.choice(devices), rng.choice(sources), rng.choice(hosts))
+            for _ in range(count)
+        ]))
+    store._write_manifest(manifest)
+    size_mb = sum(os.path.getsize(os.path.join(store.state_dir, name)) for name in manifest['segments']) / 2 ** 20
+    click.echo(f'كتابة {rows} زيارة: {time.perf_counter() - started:.1f}s، الحجم {size_mb:.1f}MB')
+
+    month_ago = (datetime.utcnow() - timedelta(days=30)).date()
+    for group_by, start in ((['referrer_host', 'week'], None), (['page_path', 'device_type'], None),
+                            (['traffic_source'], month_ago), (['browser', 'device_type', 'month'], None)):
+        started = time.perf_counter()
+        result = store.query(group_by, start=start)
+        label = ', '.join(group_by) + (f' منذ {start}' if start else '')
+        click.echo(f"{label}: {(time.perf_counter() - started):.2f}s ({result['groups']} مجموعة، {result['scanned']} صف)")
+    shutil.rmtree(store.state_dir, ignore_errors=True)
+
+# يُنفذ في عملية جديدة: يقيس استيراد app.py وتهيئته (ما يدفعه كل عامل gunicorn أو أمر CLI عند الإقلاع)
+IMPORT_BENCH_CODE = (
+    'import sys, time\n'
+    't = time.perf_counter()\n'
+    'import app\n'
+    'app.create_app()\n'
+    'print((time.perf_counter() - t) * 1000, "PIL" in sys.modules, "flask_dance" in sys.modules)\n'
+)
+
+@bench_cli.command('import')
+@click.option('--runs', default=5, help='عدد مرات القياس')
+@click.option('--top', default=10, help='عدد أبطأ الحزم المعروضة (من python -X importtime)')
+def bench_import_command(runs, top):
+    """قياس زمن استيراد التطبيق وتهيئته في عملية جديدة"""
+    timings = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', IMPORT_BENCH_CODE], cwd=app.root_path,
+                                capture_output=True, text=True, check=True)
+        elapsed_ms, pil_loaded, dance_loaded = result.stdout.strip().splitlines()[-1].split()
+        timings.append(float(elapsed_ms))
+    timings.sort()
+    click.echo(f'import app: أدنى {timings[0]:.1f}ms، وسيط {timings[len(timings) // 2]:.1f}ms، أقصى {timings[-1]:.1f}ms')
+    click.echo(f'Pillow محمّل: {pil_loaded}، Flask-Dance محمّل: {dance_loaded}')
+
+    # أبطأ الحزم (بدون الوحدات الفرعية) بحسب الزمن التراكمي لاستيرادها
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=app.root_path,
+                            capture_output=True, text=True, check=True)
+    packages = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        name = name.strip()
+        if cumulative.strip().isdigit() and '.' not in name and name not in ('app', 'site'):
+            packages.append((int(cumulative), name))
+    for cumulative, name in sorted(packages, reverse=True)[:top]:
+        click.echo(f'  {name}: {cumulative / 1000:.1f}ms')
+
 if __name__ == '__main__':
+    create_app()
     with app.app_context():
-        # إنشاء الجداول إذا لم تكن موجودة
-        db.create_all()
+        # إنشاء الجداول إذا لم تكن موجودة وإضافة الأعمدة الجديدة
+        upgrade_schema()
+        backfill_categories()
+        backfill_idea_slugs()
+        backfill_trending_scores()
         # إنشاء مجلد رفع الملفات
         os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
         
@@ -0,0 +1,25 @@
+# إعدادات Gunicorn للإنتاج (يقرأها gunicorn تلقائياً من مجلد العمل)
+import gc
+import os
+
+bind = '0.0.0.0:4000'
+# عدد العمال (processes)
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+# خيوط لكل عامل (gthread) حتى لا يحجز بث الحركة المباشرة (/dashboard/live) عاملاً كاملاً
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+# زيادة timeout للصفحات الثقيلة مثل Dashboard
+timeout = 300
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'debug')
+# طباعة access logs إلى stdout و error logs إلى stderr
+accesslog = '-'
+errorlog = '-'
+
+# تحميل التطبيق مرة واحدة في العملية الأم ثم fork للعمال (copy-on-write)
+# اتصالات قاعدة البيانات تُسقط في كل عامل جديد عبر dispose_engines_after_fork في app.py
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # نقل كائنات التطبيق المحمّلة إلى الجيل الدائم حتى لا يلمسها جامع القمامة في العمال
+    # فتبقى صفحات الذاكرة مشتركة بدل أن تُنسخ في كل عامل
+    gc.freeze()
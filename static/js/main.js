@@ -59,3 +59,88 @@ function previewImage(input) {
         reader.readAsDataURL(input.files[0]);
     }
 }
+
+// تحميل المزيد من التعليقات في صفحة الفكرة
+document.addEventListener('DOMContentLoaded', function() {
+    const loadMoreButton = document.getElementById('load-more-comments');
+    const commentsList = document.getElementById('comments-list');
+    if (!loadMoreButton || !commentsList) return;
+
+    loadMoreButton.addEventListener('click', function() {
+        const url = loadMoreButton.dataset.url + '?cursor=' + encodeURIComponent(loadMoreButton.dataset.cursor);
+        loadMoreButton.disabled = true;
+
+        fetch(url, { headers: { 'X-Requested-With': 'fetch' } })
+            .then(response => {
+                if (!response.ok) throw new Error(response.status);
+                const nextCursor = response.headers.get('X-Next-Cursor');
+                return response.text().then(html => ({ html, nextCursor }));
+            })
+            .then(({ html, nextCursor }) => {
+                commentsList.insertAdjacentHTML('beforeend', html);
+                if (nextCursor) {
+                    loadMoreButton.dataset.cursor = nextCursor;
+                    loadMoreButton.disabled = false;
+                } else {
+                    loadMoreButton.remove();
+                }
+            })
+            .catch(() => {
+                loadMoreButton.disabled = false;
+            });
+    });
+});
+
+// الحركة المباشرة في لوحة التحكم (Server-Sent Events)
+document.addEventListener('DOMContentLoaded', function() {
+    const container = document.getElementById('live-traffic');
+    if (!container || !window.EventSource) return;
+
+    const status = document.getElementById('live-status');
+    const bars = document.getElementById('live-per-minute');
+    const pagesList = document.getElementById('live-pages');
+
+    function renderCounts(element, counts) {
+        const entries = Object.entries(counts).sort((a, b) => b[1] - a[1]);
+        element.textContent = entries.length ? entries.map(([name, count]) => name + ': ' + count).join(' · ') : '-';
+    }
+
+    const source = new EventSource(container.dataset.url);
+    source.onopen = function() {
+        status.textContent = 'مباشر';
+        status.className = 'badge bg-success';
+    };
+    source.onerror = function() {
+        // EventSource يعيد الاتصال تلقائياً (البث يُغلق دورياً من الخادم)
+        status.textContent = 'إعادة الاتصال...';
+        status.className = 'badge bg-secondary';
+    };
+    source.onmessage = function(event) {
+        const data = JSON.parse(event.data);
+        document.getElementById('live-current-minute').textContent = data.current_minute;
+
+        const max = Math.max(1, ...data.per_minute);
+        bars.replaceChildren(...data.per_minute.map(count => {
+            const bar = document.createElement('div');
+            bar.className = 'bg-primary flex-fill rounded-top';
+            bar.style.height = Math.max(2, Math.round(count / max * 100)) + '%';
+            bar.title = count;
+            return bar;
+        }));
+
+        pagesList.replaceChildren(...(data.active_pages.length ? data.active_pages.map(([path, count]) => {
+            const item = document.createElement('li');
+            item.className = 'd-flex justify-content-between';
+            const code = document.createElement('code');
+            code.textContent = path;
+            const badge = document.createElement('span');
+            badge.className = 'badge bg-info';
+            badge.textContent = count;
+            item.append(code, badge);
+            return item;
+        }) : [Object.assign(document.createElement('li'), { className: 'text-muted', textContent: 'لا توجد زيارات' })]));
+
+        renderCounts(document.getElementById('live-devices'), data.devices);
+        renderCounts(document.getElementById('live-browsers'), data.browsers);
+    };
+});
@@ -0,0 +1,55 @@
+import pytest
+
+import app as app_module
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """التطبيق مرة واحدة لكل جلسة اختبارات على قاعدة SQLite مؤقتة"""
+    db_path = tmp_path_factory.mktemp('db') / 'test.db'
+    return app_module.create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{db_path}',
+        'SQLALCHEMY_ENGINE_OPTIONS': {'connect_args': {'check_same_thread': False}},
+        'RATE_LIMIT_ENABLED': False,
+        'SNAPSHOT_ENABLED': False,
+        'WTF_CSRF_ENABLED': False,
+    })
+
+
+@pytest.fixture
+def db(app):
+    """جداول فارغة لكل اختبار"""
+    with app.app_context():
+        app_module.db.drop_all()
+        app_module.upgrade_schema()
+        yield app_module.db
+        app_module.db.session.remove()
+
+
+@pytest.fixture
+def client(app, db):
+    return app.test_client()
+
+
+def login(client, user):
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user.id)
+        sess['_fresh'] = True
+
+
+def make_user(db, username, is_admin=False):
+    user = app_module.User(username=username, email=f'{username}@example.com', password='x', is_admin=is_admin)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def make_ideas(db, user, count):
+    ideas = [app_module.Idea(title=f'فكرة {i}', description='وصف', category='تقنية', user_id=user.id)
+             for i in range(count)]
+    db.session.add_all(ideas)
+    db.session.commit()
+    app_module.backfill_categories()
+    app_module.backfill_idea_slugs()
+    return ideas
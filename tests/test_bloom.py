@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+import uuid
+
+import pytest
+
+import app as app_module
+from conftest import make_ideas, make_user
+
+WINDOW = 30 * 60
+CAPACITY = 20000
+
+
+@pytest.fixture(scope='module')
+def full_bloom():
+    """مرشح امتلأت كل أجياله بسعتها (أسوأ حالة للإيجابيات الكاذبة)"""
+    bloom = app_module.RotatingBloomFilter(WINDOW, CAPACITY, app_module.UNIQUE_VIEW_ERROR_RATE)
+    generations = len(bloom._filters)
+    for generation in range(generations):
+        for i in range(CAPACITY):
+            bloom.add_if_new(f'seen:{generation}:{i}', now=generation * bloom.generation_seconds)
+    bloom.now = (generations - 1) * bloom.generation_seconds
+    return bloom
+
+
+def test_false_positive_rate_within_target(full_bloom):
+    probes = 50000
+    false_positives = sum(f'probe:{i}' in full_bloom for i in range(probes))
+    assert false_positives / probes <= 2 * app_module.UNIQUE_VIEW_ERROR_RATE
+
+
+def test_repeat_within_window_is_not_new(full_bloom):
+    generation = len(full_bloom._filters) - 1
+    assert not any(full_bloom.add_if_new(f'seen:{generation}:{i}', now=full_bloom.now) for i in range(1000))
+
+
+def test_keys_are_forgotten_after_window():
+    bloom = app_module.RotatingBloomFilter(WINDOW, 1000, app_module.UNIQUE_VIEW_ERROR_RATE)
+    assert all(bloom.add_if_new(f'key:{i}', now=0) for i in range(1000))
+    assert not any(bloom.add_if_new(f'key:{i}', now=WINDOW - 1) for i in range(1000))
+    assert all(bloom.add_if_new(f'key:{i}', now=WINDOW + bloom.generation_seconds) for i in range(1000))
+
+
+def test_idea_view_counted_once_per_visitor(client, db):
+    idea = make_ideas(db, make_user(db, 'author'), 1)[0]
+    # المرشح على مستوى العملية: User-Agent فريد حتى لا يتأثر بالاختبارات السابقة
+    headers = {'User-Agent': f'Mozilla/5.0 test-{uuid.uuid4()}'}
+    for _ in range(3):
+        assert client.get(f'/idea/{idea.id}', headers=headers).status_code == 200
+    db.session.refresh(idea)
+    assert idea.views == 1
+
+    client.get(f'/idea/{idea.id}', headers={'User-Agent': f'Mozilla/5.0 test-{uuid.uuid4()}'})
+    db.session.refresh(idea)
+    assert idea.views == 2
+
+
+def test_daily_visitor_counted_once_across_workers(client, db, monkeypatch):
+    idea = make_ideas(db, make_user(db, 'author'), 1)[0]
+    headers = {'User-Agent': f'Mozilla/5.0 test-{uuid.uuid4()}'}
+    for _ in range(2):
+        # عامل آخر: مرشحات فارغة لم ترَ الزائر، والجدول المشترك وحده يمنع احتسابه مرتين
+        monkeypatch.setattr(app_module, 'unique_views', app_module.RotatingBloomFilter(WINDOW, 1000, 0.001))
+        monkeypatch.setattr(app_module, 'daily_visitors', app_module.RotatingBloomFilter(WINDOW, 1000, 0.001))
+        assert client.get(f'/idea/{idea.id}', headers=headers).status_code == 200
+    stat = app_module.IdeaDailyStat.query.filter_by(idea_id=idea.id).one()
+    assert (stat.views, stat.visitors) == (2, 1)
+
+
+def test_prune_daily_visitors_keeps_recent_days(db):
+    idea = make_ideas(db, make_user(db, 'author'), 1)[0]
+    today = datetime.utcnow().date()
+    for days_ago in range(4):
+        app_module.record_daily_visitor(idea, 'u1', today - timedelta(days=days_ago))
+    db.session.commit()
+    app_module.prune_daily_visitors_job()
+    days = sorted(day for (day,) in db.session.query(app_module.IdeaDailyVisitor.day))
+    assert days == [today - timedelta(days=1), today]
@@ -0,0 +1,34 @@
+import pytest
+
+import app as app_module
+from conftest import make_ideas, make_user
+
+TAMPERED = ['not-a-cursor', app_module.encode_cursor(['x:y', 'a']), app_module.encode_cursor([1, 2, 3])]
+
+
+@pytest.fixture
+def idea(db):
+    return make_ideas(db, make_user(db, 'author'), 1)[0]
+
+
+@pytest.mark.parametrize('cursor', TAMPERED)
+def test_tampered_profile_cursor_falls_back_to_first_page(client, idea, cursor):
+    response = client.get(f'/user/{idea.user_id}', query_string={'cursor': cursor})
+    assert response.status_code == 302
+    assert response.location == f'/user/{idea.user_id}'
+    assert client.get(response.location).mimetype == 'text/html'
+
+
+@pytest.mark.parametrize('cursor', TAMPERED)
+def test_tampered_comments_cursor_returns_html_error(client, idea, cursor):
+    response = client.get(f'/idea/{idea.id}/comments', query_string={'cursor': cursor})
+    assert response.status_code == 400
+    assert response.mimetype == 'text/html'
+    assert 'alert-danger' in response.get_data(as_text=True)
+
+
+@pytest.mark.parametrize('cursor', TAMPERED)
+def test_tampered_api_cursor_returns_json_error(client, idea, cursor):
+    response = client.get('/api/v1/ideas', query_string={'cursor': cursor})
+    assert response.status_code == 400
+    assert response.is_json
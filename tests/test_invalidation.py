@@ -0,0 +1,82 @@
+import pytest
+
+import app as app_module
+from conftest import login, make_ideas, make_user
+
+
+@pytest.fixture
+def events(db, monkeypatch, tmp_path):
+    """أحداث الإبطال التي تصل لمشترك في idea و comment و user (بعد commit)"""
+    bus = app_module.invalidation_bus
+    monkeypatch.setattr(bus, '_handlers', {topic: list(handlers) for topic, handlers in bus._handlers.items()})
+    monkeypatch.setattr(bus, 'log_file', str(tmp_path / 'invalidation.log'))
+    received = []
+    for topic in ('idea', 'comment', 'user'):
+        bus.subscribe(topic, lambda key, topic=topic: received.append((topic, key)))
+    return received
+
+
+def add_comments(db, idea, user, count):
+    comments = [app_module.Comment(content=f'تعليق {i}', idea_id=idea.id, user_id=user.id) for i in range(count)]
+    db.session.add_all(comments)
+    db.session.commit()
+    return [comment.id for comment in comments]
+
+
+def test_has_subscribers():
+    assert app_module.invalidation_bus.has_subscribers('category')
+    assert not app_module.invalidation_bus.has_subscribers('no-such-topic')
+
+
+@pytest.mark.parametrize('action', ['hide', 'delete'])
+def test_moderation_bulk_publishes_comments(client, db, events, action):
+    owner = make_user(db, 'owner')
+    idea = make_ideas(db, owner, 1)[0]
+    comment_ids = add_comments(db, idea, owner, 3)
+    login(client, owner)
+    events.clear()
+
+    client.post('/moderation/bulk', data={'action': action, 'comment_ids': comment_ids[:2]})
+
+    assert sorted(events) == [('comment', comment_id) for comment_id in comment_ids[:2]]
+
+
+def test_user_deletion_publishes_each_chunk(db, events):
+    author = make_user(db, 'author')
+    idea_ids = [idea.id for idea in make_ideas(db, author, 3)]
+    comment_ids = add_comments(db, db.session.get(app_module.Idea, idea_ids[0]), make_user(db, 'reader'), 2)
+    deletion = app_module.UserDeletion(user_id=author.id, username=author.username)
+    db.session.add(deletion)
+    db.session.commit()
+    events.clear()
+
+    app_module.run_user_deletion(deletion.id, chunk_size=2)
+
+    assert {key for topic, key in events if topic == 'idea'} == set(idea_ids)
+    assert {key for topic, key in events if topic == 'comment'} == set(comment_ids)
+    assert ('user', author.id) in events
+
+
+def test_slug_backfill_publishes_ideas(db, events):
+    idea_ids = [idea.id for idea in make_ideas(db, make_user(db, 'author'), 2)]
+    db.session.execute(db.update(app_module.Idea).values(slug=None))
+    db.session.commit()
+    events.clear()
+
+    app_module.backfill_idea_slugs()
+
+    assert sorted(events) == [('idea', idea_id) for idea_id in idea_ids]
+
+
+def test_too_many_keys_invalidate_whole_topic(db, events):
+    with app_module.db.session.begin():
+        app_module.invalidation_bus.publish_many('idea', range(app_module.INVALIDATION_MAX_EVENTS + 1))
+    assert events == [('idea', None)]
+
+
+def test_rollback_discards_bulk_events(db, events):
+    db.session.execute(db.select(app_module.Comment.id))
+    app_module.invalidation_bus.publish_many('comment', [1, 2])
+    db.session.rollback()
+    db.session.commit()
+    assert events == []
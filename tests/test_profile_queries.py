@@ -0,0 +1,59 @@
+import pytest
+
+import app as app_module
+from conftest import login, make_ideas, make_user
+
+
+@pytest.fixture
+def statements(db):
+    """نصوص SQL المنفذة أثناء الاختبار"""
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    app_module.db.event.listen(db.engine, 'before_cursor_execute', record)
+    yield executed
+    app_module.db.event.remove(db.engine, 'before_cursor_execute', record)
+
+
+@pytest.fixture
+def author(db):
+    user = make_user(db, 'author')
+    ideas = make_ideas(db, user, app_module.PROFILE_IDEAS_PER_PAGE + 3)
+    db.session.add_all([app_module.Comment(content='تعليق', idea_id=idea.id, user_id=user.id) for idea in ideas])
+    db.session.commit()
+    return user
+
+
+def profile_paths(author):
+    _, _, _, next_cursor = app_module.load_profile_page(author)
+    assert next_cursor
+    return [f'/user/{author.id}', f'/user/{author.id}?cursor={next_cursor}']
+
+
+@pytest.mark.parametrize('logged_in', [False, True], ids=['visitor', 'owner'])
+def test_profile_pages_stay_within_query_budget(app, client, author, statements, logged_in):
+    with app.test_request_context():
+        paths = profile_paths(author)
+    if logged_in:
+        login(client, author)
+    for path in paths:
+        statements.clear()
+        assert client.get(path).status_code == 200
+        assert len(statements) <= app_module.PROFILE_QUERY_BUDGET, path
+
+
+def test_profile_query_count_does_not_grow_with_ideas(app, client, db, author, statements):
+    with app.test_request_context():
+        first_page = profile_paths(author)[0]
+    client.get(first_page)
+    statements.clear()
+    client.get(first_page)
+    before = len(statements)
+
+    make_ideas(db, author, 20)
+    client.get(first_page)
+    statements.clear()
+    client.get(first_page)
+    assert len(statements) == before
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+import app as app_module
+from conftest import login, make_ideas, make_user
+
+
+def fail(*args, **kwargs):
+    raise RuntimeError('فشل مقصود في القسم')
+
+
+@pytest.fixture
+def streaming(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'STREAM_RENDERING', True)
+
+
+@pytest.fixture
+def idea(db):
+    return make_ideas(db, make_user(db, 'admin', is_admin=True), 1)[0]
+
+
+def assert_closed_with_error(body):
+    assert body.count(app_module.STREAM_ERROR_HTML) == 1
+    assert body.count('<footer') == 1
+    assert body.rstrip().endswith('</html>')
+    assert app_module.STREAM_FLUSH_MARKER not in body
+
+
+@pytest.mark.usefixtures('streaming')
+def test_streamed_pages_render_completely(client, idea):
+    login(client, idea.author)
+    for path in ('/dashboard', f'/idea/{idea.id}'):
+        response = client.get(path)
+        body = response.get_data(as_text=True)
+        assert response.headers['X-Accel-Buffering'] == 'no'
+        assert app_module.STREAM_ERROR_HTML not in body
+        assert body.rstrip().endswith('</html>')
+
+
+@pytest.mark.usefixtures('streaming')
+def test_dashboard_section_failure_closes_layout(client, idea, monkeypatch):
+    # سجل الزيارات قسم في منتصف لوحة التحكم: ما قبله أُرسل بالفعل
+    monkeypatch.setattr(app_module, 'load_visit_log_page', fail)
+    login(client, idea.author)
+    response = client.get('/dashboard')
+    body = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert 'card-gradient-primary' in body  # بطاقات الإحصائيات قبل القسم الذي فشل
+    assert_closed_with_error(body)
+
+
+@pytest.mark.usefixtures('streaming')
+def test_idea_section_failure_closes_layout(client, idea, monkeypatch):
+    monkeypatch.setattr(app_module, 'count_visible_comments', fail)
+    body = client.get(f'/idea/{idea.id}').get_data(as_text=True)
+    assert idea.title in body
+    assert_closed_with_error(body)
+
+
+@pytest.mark.usefixtures('streaming')
+def test_snapshot_of_failing_page_is_not_written(app, idea, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'SNAPSHOT_DIR', str(tmp_path))
+    monkeypatch.setattr(app_module, 'count_visible_comments', fail)
+    with pytest.raises(RuntimeError):
+        app_module.write_snapshot(f'/idea/{idea.id}')
+    assert not os.listdir(tmp_path)